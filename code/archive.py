@@ -0,0 +1,175 @@
+"""
+Index of the data files, to query rows by label and time range without
+opening every file.
+
+The index is a small SQLite database with one entry per file: label,
+start timestamp, number of rows, first and last timestamps (absolute, ms)
+and the minimum and maximum of each column. update() only reads the
+files added or changed since the previous update (by size and
+modification time), and forgets the files that are gone.
+
+A query opens only the files overlapping the time range. Segments are
+memory-mapped and only the records within the range are read and
+decoded (copied, unless the segment holds float32 values). Rows are
+returned block by block (blocks()), or copied once into a single array
+(rows()).
+
+Environment variables:
+ARCHIVE_PATH         folder of the uploaded files
+COMPLETE_DATA_PATH   folder of the files waiting to be uploaded
+ARCHIVE_INDEX_PATH   SQLite file of the index
+"""
+
+import logging, os, sqlite3, threading
+from collections import namedtuple
+import numpy as np
+
+import compact, datafile, segment
+
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", os.path.abspath(os.getcwd())+'/archive/')
+COMPLETE_DATA_PATH = os.getenv("COMPLETE_DATA_PATH", os.path.abspath(os.getcwd())+'/data/')
+ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", os.path.abspath(os.getcwd())+'/archive-index.sqlite')
+
+# An indexed file, timestamps are absolute (ms), minimum and maximum are float32 arrays (one value per column)
+Entry = namedtuple("Entry", ["name", "path", "label", "start", "first", "last", "rows", "columns", "minimum", "maximum"])
+
+def read_range(path, start_timestamp, since=None, until=None):
+    """Rows of a data file with since <= timestamp < until: (absolute timestamps, values)"""
+    if path.endswith(".seg"):
+        # only the records within the range are read from the mapped file
+        start_timestamp, records = segment.open_segment(path)
+        timestamps = records["timestamp"]
+        begin = 0 if since is None else np.searchsorted(timestamps, since)
+        end = len(records) if until is None else np.searchsorted(timestamps, until)
+        records = records[begin:end]
+        if "imu" in records.dtype.names:
+            return np.array(records["timestamp"]), compact.decode(records["imu"], records["fsr"])
+        return np.array(records["timestamp"]), records["values"]
+    timestamps, values = datafile.load(path)
+    timestamps = start_timestamp + timestamps.astype(np.int64)
+    begin = 0 if since is None else np.searchsorted(timestamps, since)
+    end = len(timestamps) if until is None else np.searchsorted(timestamps, until)
+    return timestamps[begin:end], values[begin:end]
+
+class ArchiveIndex:
+    """ Label, time span and range of values of every data file of some folders """
+    def __init__(self, path=ARCHIVE_INDEX_PATH, folders=(ARCHIVE_PATH, COMPLETE_DATA_PATH)):
+        self.folders = folders
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                            name TEXT PRIMARY KEY,
+                            path TEXT NOT NULL,
+                            size INTEGER NOT NULL,
+                            mtime INTEGER NOT NULL,
+                            label TEXT NOT NULL,
+                            start INTEGER NOT NULL,
+                            first INTEGER NOT NULL,
+                            last INTEGER NOT NULL,
+                            rows INTEGER NOT NULL,
+                            columns INTEGER NOT NULL,
+                            minimum BLOB NOT NULL,
+                            maximum BLOB NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_label_time ON files (label, first, last)")
+        self.db.commit()
+
+    def update(self):
+        """Index the new and changed files, forget the removed ones
+        Return the number of files (indexed, removed).
+        """
+        with self.lock:
+            known = {name: (path, size, mtime) for name, path, size, mtime
+                     in self.db.execute("SELECT name, path, size, mtime FROM files")}
+        found = {}
+        for folder in self.folders:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if entry.name.endswith(datafile.SUFFIXES):
+                    stat = entry.stat()
+                    found[entry.name] = (entry.path, stat.st_size, stat.st_mtime_ns)
+        # unchanged files are not opened again, even when moved from the data folder to the archive
+        changed = [name for name, (path, size, mtime) in found.items()
+                   if name not in known or known[name][1:] != (size, mtime)]
+        moved = [(path, name) for name, (path, size, mtime) in found.items()
+                 if name in known and known[name][1:] == (size, mtime) and known[name][0] != path]
+        removed = [(name,) for name in known if name not in found]
+        entries = []
+        for name in changed:
+            try:
+                entries.append(self.describe(*found[name]))
+            except (OSError, ValueError, KeyError) as error:
+                # e.g. a file being written, retried on the next update
+                logging.error(f"Cannot index {name}: {error}")
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+            self.db.executemany("UPDATE files SET path = ? WHERE name = ?", moved)
+            self.db.executemany("DELETE FROM files WHERE name = ?", removed)
+            self.db.commit()
+        return len(entries), len(removed)
+
+    def describe(self, path, size, mtime):
+        """Row of the index for a data file"""
+        label, start_timestamp = datafile.parse_file_name(path)
+        timestamps, values = read_range(path, start_timestamp)
+        if len(timestamps) == 0:
+            first = last = start_timestamp
+            minimum = maximum = np.zeros(values.shape[1], dtype=np.float32)
+        else:
+            first, last = int(timestamps[0]), int(timestamps[-1])
+            minimum, maximum = values.min(axis=0), values.max(axis=0)
+        return (os.path.basename(path), path, size, mtime, label, start_timestamp, first, last, len(timestamps),
+                values.shape[1], minimum.astype(np.float32).tobytes(), maximum.astype(np.float32).tobytes())
+
+    def files(self, label=None, since=None, until=None):
+        """Entries of the files with rows of label (any if None) with since <= timestamp < until, in time order"""
+        query = "SELECT name, path, label, start, first, last, rows, columns, minimum, maximum FROM files WHERE 1"
+        parameters = []
+        if label is not None:
+            query += " AND label = ?"
+            parameters.append(label)
+        if since is not None:
+            query += " AND last >= ?"
+            parameters.append(since)
+        if until is not None:
+            query += " AND first < ?"
+            parameters.append(until)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY first", parameters).fetchall()
+        return [Entry(*row[:8], np.frombuffer(row[8], dtype=np.float32), np.frombuffer(row[9], dtype=np.float32))
+                for row in rows]
+
+    def labels(self):
+        """[(label, files, rows, first, last)] of the indexed files"""
+        with self.lock:
+            return self.db.execute("""SELECT label, COUNT(*), SUM(rows), MIN(first), MAX(last)
+                                      FROM files GROUP BY label ORDER BY label""").fetchall()
+
+    def blocks(self, label=None, since=None, until=None):
+        """Rows of the matching files, one (timestamps, values) block per file, read as they are consumed"""
+        for entry in self.files(label, since, until):
+            timestamps, values = read_range(entry.path, entry.start, since, until)
+            if len(timestamps) > 0:
+                yield timestamps, values
+
+    def rows(self, label=None, since=None, until=None):
+        """Rows of the matching files in a single (timestamps, values) pair"""
+        entries = self.files(label, since, until)
+        if len(set(entry.columns for entry in entries)) > 1:
+            raise ValueError("Files with different columns, query them separately (see files())")
+        # at most the rows of the whole files, filled block by block without intermediate copies
+        total = sum(entry.rows for entry in entries)
+        timestamps = np.empty(total, dtype=np.int64)
+        values = np.empty((total, entries[0].columns if entries else 0), dtype=np.float32)
+        count = 0
+        for entry in entries:
+            block_timestamps, block_values = read_range(entry.path, entry.start, since, until)
+            timestamps[count:count + len(block_timestamps)] = block_timestamps
+            values[count:count + len(block_timestamps)] = block_values
+            count += len(block_timestamps)
+        return timestamps[:count], values[:count]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
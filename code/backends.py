@@ -0,0 +1,64 @@
+"""
+Hardware backends of the collection pipeline: the GPIO and ADC of the
+FSR mux, and the BLE interface of the IMUs.
+
+HARDWARE_BACKEND selects the real hardware ("device", default) or the
+simulators of simulators.py ("simulator"), to run and measure the whole
+pipeline on any Linux machine. Hardware modules are only imported when
+used, so the pipeline imports without them.
+
+Simulator settings:
+SIMULATOR_RATE               IMU samples per second, per device
+SIMULATOR_FRAMES_PER_PACKET  frames per BLE notification (1 as unbuffered firmware)
+SIMULATOR_REPLAY             .npz or .seg recording to replay (IMU and FSR values),
+                             instead of a constant signal
+"""
+
+import os
+
+import datafile
+from devices import DEVICE_COLUMNS, IMU_COLUMNS
+
+HARDWARE_BACKEND = os.getenv("HARDWARE_BACKEND", "device")
+SIMULATOR_RATE = float(os.getenv("SIMULATOR_RATE", 100))
+SIMULATOR_FRAMES_PER_PACKET = int(os.getenv("SIMULATOR_FRAMES_PER_PACKET", 1))
+SIMULATOR_REPLAY = os.getenv("SIMULATOR_REPLAY", None)
+
+def replay_values(path=SIMULATOR_REPLAY):
+    """Values of the recording to replay, None for a constant signal"""
+    if not path:
+        return None
+    return datafile.load(path)[1]
+
+def gpio(backend=HARDWARE_BACKEND):
+    if backend == "simulator":
+        from simulators import FakeGPIO
+        return FakeGPIO()
+    import RPi.GPIO as GPIO #GPIO for mux selection
+    return GPIO
+
+def adc(gpio, mux_pins, backend=HARDWARE_BACKEND, replay=SIMULATOR_REPLAY):
+    if backend == "simulator":
+        from simulators import FakeADS1115
+        values = replay_values(replay)
+        if values is not None and values.shape[1] > IMU_COLUMNS:
+            # FSR columns of the recording, one row per IMU sample period
+            return FakeADS1115(gpio, mux_pins, values[:, IMU_COLUMNS:], rate=SIMULATOR_RATE)
+        return FakeADS1115(gpio, mux_pins, [26000] * 16)
+    import Adafruit_ADS1x15 #AD converter
+    return Adafruit_ADS1x15.ADS1115() #pls check ADS1115
+
+def ble_interface(backend=HARDWARE_BACKEND, rate=SIMULATOR_RATE, frames_per_packet=SIMULATOR_FRAMES_PER_PACKET, replay=SIMULATOR_REPLAY):
+    """Class or factory of BLE interfaces, called with (adapter, service UUID)"""
+    if backend == "simulator":
+        from simulators import FakeBLE, FakeIMUDevice
+        values = replay_values(replay)
+        def create_device(index):
+            # device i replays the i-th block of IMU columns, if the recording has it
+            imu = None
+            if values is not None and values.shape[1] >= (index + 1) * DEVICE_COLUMNS:
+                imu = values[:, index * DEVICE_COLUMNS:(index + 1) * DEVICE_COLUMNS]
+            return FakeIMUDevice(1 / rate, frames_per_packet=frames_per_packet, values=imu)
+        return FakeBLE({}, create_device)
+    from ble_serial.bluetooth.ble_interface import BLE_interface
+    return BLE_interface
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Host-side benchmarks of the data pipeline. They run on any machine,
+no sensor or BLE adapter needed.
+
+Usage:
+python benchmark.py [protocol] [upload] [storage] [fsr] [devices] [pipeline]
+"""
+
+import os, sys, time
+import numpy as np
+
+from imu_protocol import FrameParser, decode_text, pack_frame, unpack_frames, ENCODING_FLOAT32, ENCODING_INT16
+
+def report(name, count, duration, unit="samples"):
+    print(f"{name:<40} {count / duration:>14,.0f} {unit}/s")
+
+def best_of(function, repeat=3):
+    """Shortest duration of several runs, to limit the noise of other processes"""
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+def random_samples(number_samples):
+    rng = np.random.default_rng(0)
+    acc = rng.normal(0, 9.81, (number_samples, 3))
+    gyro = rng.normal(0, 1, (number_samples, 3))
+    return np.hstack((acc, gyro))
+
+def bench_protocol(number_samples=20000):
+    """Parse throughput of the legacy text format vs binary frames"""
+    samples = random_samples(number_samples)
+
+    # Legacy format: 6 notifications per sample
+    notifications = [f"{i}#{v}".encode() for sample in samples for i, v in enumerate(sample)]
+    imu_data = [0]*6
+    start = time.perf_counter()
+    for value in notifications:
+        imu_data = decode_text(value, imu_data)
+    report("text (6 notifications per sample)", number_samples, time.perf_counter() - start)
+
+    for encoding, name in ((ENCODING_FLOAT32, "float32"), (ENCODING_INT16, "int16")):
+        frames = [pack_frame(seq, 0, sample, encoding) for seq, sample in enumerate(samples)]
+
+        parser = FrameParser()
+        start = time.perf_counter()
+        for value in frames:
+            parser.feed(value)
+        report(f"binary {name}, struct per frame", number_samples, time.perf_counter() - start)
+
+        buffer = b"".join(frames)
+        start = time.perf_counter()
+        unpack_frames(buffer, encoding)
+        report(f"binary {name}, frombuffer on a block", number_samples, time.perf_counter() - start)
+
+        # Buffered firmware: as many frames per notification as a 247-byte MTU allows
+        per_packet = 244 // len(frames[0])
+        packets = [buffer[i:i + per_packet * len(frames[0])] for i in range(0, len(buffer), per_packet * len(frames[0]))]
+        parser = FrameParser()
+        start = time.perf_counter()
+        for value in packets:
+            parser.feed(value)
+        report(f"binary {name}, {per_packet} frames per notification", number_samples, time.perf_counter() - start)
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test-data", "test-1680201263000.complete.npz")
+
+def legacy_convert(data, start_timestamp, label, number_fsr, properties):
+    """Row-by-row conversion as bucket_thing.py used to do it"""
+    for values in data:
+        ts = start_timestamp + int(values[0])
+        if (values[1:7].sum() != 0):
+            properties["acc_left"].update_values([float(i) for i in values[1:4]], ts, mode='a')
+            properties["gyro_left"].update_values([float(i) for i in values[4:7]], ts, mode='a')
+        if (values[7:13].sum() != 0):
+            properties["acc_right"].update_values([float(i) for i in values[7:10]], ts, mode='a')
+            properties["gyro_right"].update_values([float(i) for i in values[10:13]], ts, mode='a')
+        if (number_fsr>0 and values[13:13+number_fsr].sum() != 0):
+            properties["fsr"].update_values([int(i) for i in values[13:13+number_fsr]], ts, mode='a')
+        properties["label"].update_values([label], ts, mode="a")
+
+def bench_upload(repeat=300):
+    """Conversion of a data file into property values, before upload"""
+    from dcd.bucket.properties.property import Property
+    from bucket_thing import convert_data
+
+    data = np.load(TEST_FILE)["data"]
+    # a day of 100-row files is far larger than the test file, repeat it
+    data = np.tile(data, (repeat, 1))
+    timestamps, values = data[:, 0].astype(np.int64), data[:, 1:].astype(np.float32)
+    number_fsr = data.shape[1] - 13
+    names = ["acc_left", "gyro_left", "acc_right", "gyro_right", "fsr", "label"]
+
+    def legacy():
+        properties = {name: Property(name=name, values=[]) for name in names}
+        legacy_convert(data, 1680201263000, "test", number_fsr, properties)
+
+    def vectorized():
+        properties = {name: Property(name=name, values=[]) for name in names}
+        for name, rows in convert_data(timestamps, values, 1680201263000, "test", number_fsr).items():
+            properties[name].values.extend(rows)
+
+    legacy_time = best_of(legacy)
+    report("row by row (update_values)", len(data), legacy_time, "rows")
+    vectorized_time = best_of(vectorized)
+    report("vectorized (convert_data)", len(data), vectorized_time, "rows")
+    print(f"speed-up: x{legacy_time / vectorized_time:.1f}")
+
+def bench_storage(repeat=300):
+    """Size, write and read time of a data file, and JSON bytes uploaded, per format"""
+    import json, tempfile
+    import compact, datafile
+    from bucket_thing import to_rows
+
+    data = np.load(TEST_FILE)["data"]
+    data = np.tile(data, (repeat, 1))
+    # test file timestamps are in seconds, files now hold milliseconds
+    timestamps = np.arange(len(data), dtype=np.int64) * 100
+    # sensor noise, otherwise the tiled rows compress far better than real recordings
+    rng = np.random.default_rng(0)
+    data[:, 1:13] += rng.normal(0, 0.05, (len(data), 12))
+    data[:, 13:] += rng.integers(-20, 20, (len(data), data.shape[1] - 13))
+    values = data[:, 1:].astype(np.float32)
+    legacy = np.column_stack((timestamps, data[:, 1:]))
+
+    formats = [
+        ("legacy float64 'data'", lambda path: np.savez(path, data=legacy)),
+        ("float32, no compression", lambda path: datafile.write(path, timestamps, values, "float32", "none")),
+        ("compact, no compression", lambda path: datafile.write(path, timestamps, values, "compact", "none")),
+        ("compact, fast", lambda path: datafile.write(path, timestamps, values, "compact", "fast")),
+        ("compact, deflate", lambda path: datafile.write(path, timestamps, values, "compact", "deflate")),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        for name, write in formats:
+            path = os.path.join(folder, "test-0.npz")
+            write_time = best_of(lambda: write(path))
+            read_time = best_of(lambda: datafile.load(path))
+            size = os.path.getsize(path)
+            print(f"{name:>26}: {size / 1024:8.1f} KiB ({size / len(data):5.1f} B/row), "
+                  f"write {write_time * 1000:6.1f} ms, read {read_time * 1000:6.1f} ms")
+
+    # one IMU property: float32 values as read before, compact values rounded as uploaded now
+    imu, fsr = compact.encode(values)
+    for name, rows in [("float32", to_rows(timestamps, values[:, 0:3])),
+                       ("compact, rounded", to_rows(timestamps, compact.decode(imu, fsr)[:, 0:3], 3))]:
+        size = len(json.dumps({"values": rows}))
+        print(f"{'JSON ' + name:>26}: {size / 1024:8.1f} KiB ({size / len(data):5.1f} B/row) for acc_left")
+
+def legacy_scan(gpio, adc, mux_pins, number_fsr):
+    """Scan as fsr.py used to: all 4 select pins written for every channel"""
+    values = [0] * number_fsr
+    for chanel in range(number_fsr):
+        for pin_index in range(4):
+            gpio.output(mux_pins[pin_index], (chanel >> pin_index) & 1)
+        values[chanel] = adc.read_adc(0, gain=1, data_rate=128)
+    return values
+
+def bench_fsr(scans=20, number_fsr=16):
+    """Scan rate, select pin writes and noise of a full pressure map, on fake GPIO/ADC"""
+    from fsr import FSR
+    from simulators import FakeGPIO, FakeADS1115
+
+    pressure = np.linspace(1000, 26000, 16)
+    gpio = FakeGPIO()
+    adc = FakeADS1115(gpio, [5, 6, 14, 19], pressure)
+    start = time.perf_counter()
+    maps = np.array([legacy_scan(gpio, adc, [5, 6, 14, 19], number_fsr) for i in range(scans)])
+    duration = time.perf_counter() - start
+    print(f"{'legacy, 128 SPS':<28} {scans / duration:6.1f} scans/s, {gpio.writes / scans:4.0f} pin writes/scan, "
+          f"noise {np.std(maps - pressure[:number_fsr], axis=0).mean():.2f} counts")
+
+    for data_rate, oversampling in [(128, 1), (860, 1), (860, 2), (860, 4)]:
+        gpio = FakeGPIO()
+        adc = FakeADS1115(gpio, [5, 6, 14, 19], pressure)
+        fsr = FSR(number_fsr, gpio, adc, data_rate, oversampling)
+        start = time.perf_counter()
+        maps = np.array([fsr.read_fsrs().copy() for i in range(scans)])
+        duration = time.perf_counter() - start
+        print(f"{f'gray code, {data_rate} SPS x{oversampling}':<28} {scans / duration:6.1f} scans/s, "
+              f"{gpio.writes / scans:4.0f} pin writes/scan, noise {np.std(maps - pressure[:number_fsr], axis=0).mean():.2f} counts")
+
+def rss():
+    """Resident memory of this process, in MiB"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def run_pipeline(count, rate, duration=5, number_fsr=0, replay=None):
+    """Run simulated IMUs -> BLE_Devices -> DataAggregator -> Writer, then convert the files for upload
+    Return the measurements of the run.
+    """
+    import asyncio, glob, logging, tempfile, threading
+    import backends, datafile
+    from bluetooth import BLE_Devices
+    from bucket_thing import convert_data, UPLOAD_DECIMALS
+    from devices import make_devices
+    from fsr import FSR
+    from save import DataAggregator
+
+    logging.getLogger().setLevel(logging.WARNING)
+    devices = make_devices([(f"imu{i}", f"sim-{i}") for i in range(count)])
+    # buffered firmware: a notification every 20 ms at most
+    interface = backends.ble_interface("simulator", rate, max(1, int(rate / 50)), replay)
+    ble_devices = BLE_Devices(devices, interface)
+    gpio = backends.gpio("simulator")
+    fsr = FSR(number_fsr, gpio, backends.adc(gpio, [5, 6, 14, 19], "simulator", replay) if number_fsr > 0 else None)
+    with tempfile.TemporaryDirectory() as folder:
+        aggregator = DataAggregator(0, "Data Aggregator Thread", 0, fsr, ble_devices, folder, 0.1, None)
+        aggregator.start()
+        threading.Timer(duration, ble_devices.stop).start()
+        start, cpu = time.perf_counter(), time.process_time()
+        asyncio.run(ble_devices.connect())
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+        aggregator.stop_collection()
+        aggregator.join()
+        memory = rss()
+
+        start = time.perf_counter()
+        converted = 0
+        for path in glob.glob(os.path.join(folder, "*.seg")):
+            timestamps, values, imu_columns, encoding = datafile.read(path)
+            # rounded as by the uploader
+            convert_data(timestamps, values, 0, "benchmark", number_fsr, devices, UPLOAD_DECIMALS if encoding == "compact" else None)
+            converted += len(timestamps)
+        conversion = time.perf_counter() - start
+
+    stats = ble_devices.stats().values()
+    sent = sum(fake.sent for fake in interface.devices.values())
+    received = sum(stat["received"] for stat in stats)
+    # samples missing from the sequence (dropped) are not received, samples lost on a full ring were received
+    overflows = sum(stat["overflows"] for stat in stats)
+    return {
+        "sent": sent / wall,
+        "received": received / wall,
+        "drop_rate": (sent - received + overflows) / sent if sent > 0 else 0.0,
+        "rows": aggregator.writer.written_rows / wall,
+        "converted": converted / conversion if conversion > 0 else 0.0,
+        "cpu": 100 * cpu / wall,
+        "rss": memory,
+    }
+
+def print_run(name, run):
+    print(f"{name:<18} {run['received']:7.0f} samples/s ({run['sent']:7.0f} sent), drop {100 * run['drop_rate']:5.2f}%, "
+          f"{run['rows']:5.0f} rows/s written, {run['converted']:8.0f} rows/s converted, "
+          f"CPU {run['cpu']:3.0f}%, RSS {run['rss']:4.0f} MiB")
+
+def bench_devices(duration=5, counts=(2, 4, 8)):
+    """Simulated IMUs at 200 Hz, from 2 to 8 devices"""
+    for count in counts:
+        print_run(f"{count} devices", run_pipeline(count, 200, duration))
+
+def bench_pipeline(duration=5, rates=(100, 200, 400, 800, 1600)):
+    """Whole pipeline at rising IMU rates: 2 devices and 10 FSRs replaying the test file"""
+    for rate in rates:
+        print_run(f"2 x {rate} Hz", run_pipeline(2, rate, duration, 10, TEST_FILE))
+
+BENCHMARKS = {
+    "protocol": bench_protocol,
+    "upload": bench_upload,
+    "storage": bench_storage,
+    "fsr": bench_fsr,
+    "devices": bench_devices,
+    "pipeline": bench_pipeline,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
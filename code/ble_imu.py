@@ -6,6 +6,7 @@ BLE GATT Notification service.
 
 # general
 import time
+import struct
 import board
 import digitalio
 import busio
@@ -16,6 +17,7 @@ from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
 from adafruit_ble.services.nordic import UARTService
 
 #IMU
+from adafruit_lsm6ds import Rate
 from adafruit_lsm6ds.lsm6ds3 import LSM6DS3
 
 #here we define a new class of imu
@@ -31,6 +33,9 @@ class IMU(LSM6DS3):
 
 #IMU
 sensor = IMU()
+# the sensor must produce new data at least as fast as we sample it
+sensor.accelerometer_data_rate = Rate.RATE_208_HZ
+sensor.gyro_data_rate = Rate.RATE_208_HZ
 
 #BLE
 ble = BLERadio()
@@ -44,6 +49,26 @@ led.direction = digitalio.Direction.OUTPUT
 
 sendRate = 0.1
 
+# Frame protocol, see imu_protocol.py on the host
+# "binary": one packed frame per sample, "text": legacy "index#value" per axis
+protocol = "binary"
+FRAME_MAGIC = 0xA5
+PROTOCOL_VERSION = 1
+ENCODING_FLOAT32 = 0x01
+ENCODING_INT16 = 0x02
+# int16 frames (20 bytes) fit the default BLE payload, float32 frames take 32 bytes
+encoding = ENCODING_INT16
+ACC_SCALE = 100.0
+GYRO_SCALE = 1000.0
+FRAME_FORMAT = "<BBHI6h" if encoding == ENCODING_INT16 else "<BBHI6f"
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+# Buffered mode (binary protocol only): sample every sampleRate seconds into a ring
+# of ringSize frames, and send as many frames per notification as the MTU allows.
+buffered = True
+sampleRate = 0.005 # 200 Hz
+ringSize = 64
+
 blinkRate = 0.5
 
 blinkTime = time.monotonic() + blinkRate
@@ -56,40 +81,38 @@ def debugPrint(*p):  # * enables a list of arguments (tuple)
         return
     print(p)
 
-
+def clamp16(value):
+    return max(-32768, min(32767, round(value)))
+
+def pack_frame_into(buffer, offset, seq, acc, gyro):
+    """Pack one sample: magic, version, sequence number, device time (ms) and 6 values"""
+    time_ms = (time.monotonic_ns() // 1000000) & 0xFFFFFFFF
+    version = (PROTOCOL_VERSION << 4) | encoding
+    if encoding == ENCODING_INT16:
+        struct.pack_into(FRAME_FORMAT, buffer, offset, FRAME_MAGIC, version, seq & 0xFFFF, time_ms,
+                         clamp16(acc[0] * ACC_SCALE), clamp16(acc[1] * ACC_SCALE), clamp16(acc[2] * ACC_SCALE),
+                         clamp16(gyro[0] * GYRO_SCALE), clamp16(gyro[1] * GYRO_SCALE), clamp16(gyro[2] * GYRO_SCALE))
+    else:
+        struct.pack_into(FRAME_FORMAT, buffer, offset, FRAME_MAGIC, version, seq & 0xFFFF, time_ms,
+                         acc[0], acc[1], acc[2], gyro[0], gyro[1], gyro[2])
+
+def max_packet_length(connection):
+    """Bytes per notification negotiated with the host (20 with the default MTU)"""
+    try:
+        return connection._bleio_connection.max_packet_length
+    except AttributeError:
+        return 20
 
 data = [None] * 6
 
 tag = [0,1,2,3,4,5]
 
-while True:
-
-    #switch off LED, donot be strange, it is True -> Off
-    led.value = True
-
-    # Advertise when not connected.
-    debugPrint("Wait for connection")
-    ble.start_advertising(advertisement)
-    while not ble.connected:
-        if time.monotonic() > blinkTime:
-            led.value = not (led.value)
-            blinkTime = time.monotonic() + blinkRate
-            time.sleep(0.1)
-        pass
-
-     # Connected
-    ble.stop_advertising()
-    debugPrint("Connection established")
+frame = bytearray(FRAME_SIZE)
+ring = bytearray(ringSize * FRAME_SIZE)
 
-    # Loop and read packets
+def run_unbuffered(count):
+    """Legacy loop: read and send one sample every sendRate seconds"""
     sendTime = time.monotonic() + sendRate
-
-    count = 0
-
-    max_records = 30
-
-    xx = ble.connections[0]
-
     while ble.connected:
         #switch on LED
         led.value = False
@@ -114,28 +137,100 @@ while True:
         el
         '''
         if time.monotonic() > sendTime:
-
-            data[0]  = sensor.acceleration[0]
-            data[1]  = sensor.acceleration[1]
-            data[2]  = sensor.acceleration[2]
-            data[3]  = sensor.gyro[0]
-            data[4]  = sensor.gyro[1]
-            data[5]  = sensor.gyro[2]
-
-            for i in range(0,6):
-                #we use a # to seperate data
-                text = "{}#{}".format(tag[i], data[i])
-                uart_server.write(text.encode())
-                debugPrint("TX:", text.strip())
+            acc = sensor.acceleration
+            gyro = sensor.gyro
+
+            if protocol == "binary":
+                # one notification per sample
+                pack_frame_into(frame, 0, count, acc, gyro)
+                uart_server.write(frame)
+                debugPrint("TX:", count, acc, gyro)
+            else:
+                data[0:3] = acc
+                data[3:6] = gyro
+                for i in range(0,6):
+                    #we use a # to seperate data
+                    text = "{}#{}".format(tag[i], data[i])
+                    uart_server.write(text.encode())
+                    debugPrint("TX:", text.strip())
 
             count += 1
             sendTime = time.monotonic() + sendRate
             led.value = not (led.value)
             time.sleep(0.01)
 
-        #if count > max_records:
-        #    xx.disconnect()
-        #    break
+def run_buffered(count, connection):
+    """Sample at sampleRate into the ring, flush full packets of frames"""
+    frames_per_packet = max(1, max_packet_length(connection) // FRAME_SIZE)
+    debugPrint("Frames per notification:", frames_per_packet)
+    head = 0     # next slot to write
+    pending = 0  # frames waiting in the ring
+    dropped = 0  # frames overwritten before being sent
+    led.value = False
+    sampleTime = time.monotonic()
+    while ble.connected:
+        now = time.monotonic()
+        if now >= sampleTime:
+            pack_frame_into(ring, head * FRAME_SIZE, count, sensor.acceleration, sensor.gyro)
+            head = (head + 1) % ringSize
+            if pending < ringSize:
+                pending += 1
+            else:
+                dropped += 1
+            count += 1
+            if count % 200 == 0:
+                led.value = not (led.value)
+                if dropped > 0:
+                    debugPrint("Dropped frames:", dropped)
+            # deadline-based pacing, skip missed samples rather than bursting
+            sampleTime += sampleRate
+            if sampleTime < now:
+                sampleTime = now + sampleRate
+
+        if pending >= frames_per_packet:
+            tail = (head - pending) % ringSize
+            n = frames_per_packet
+            if tail + n <= ringSize:
+                packet = ring[tail * FRAME_SIZE:(tail + n) * FRAME_SIZE]
+            else:
+                packet = ring[tail * FRAME_SIZE:] + ring[:(tail + n - ringSize) * FRAME_SIZE]
+            uart_server.write(packet)
+            pending -= n
+
+while True:
+
+    #switch off LED, donot be strange, it is True -> Off
+    led.value = True
+
+    # Advertise when not connected.
+    debugPrint("Wait for connection")
+    ble.start_advertising(advertisement)
+    while not ble.connected:
+        if time.monotonic() > blinkTime:
+            led.value = not (led.value)
+            blinkTime = time.monotonic() + blinkRate
+            time.sleep(0.1)
+        pass
+
+     # Connected
+    ble.stop_advertising()
+    debugPrint("Connection established")
+
+    count = 0
+
+    max_records = 30
+
+    xx = ble.connections[0]
+
+    # Loop and read packets
+    if buffered and protocol == "binary":
+        run_buffered(count, xx)
+    else:
+        run_unbuffered(count)
+
+    #if count > max_records:
+    #    xx.disconnect()
+    #    break
 
     #switch off LED
     led.value = False
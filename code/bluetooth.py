@@ -1,80 +1,185 @@
+import asyncio, logging, os, time
 
-import asyncio, time
-from ble_serial.bluetooth.ble_interface import BLE_interface
+import backends
+from devices import Device
+from imu_protocol import FrameParser, IMUSample, SequenceTracker, decode_text
+from metrics import counter, gauge
+from ring import SampleRing
 
 # None uses default/autodetection, insert values if needed
 ADAPTER = "hci0"
 SERVICE_UUID = None
 WRITE_UUID = None
 READ_UUID = None
+# number of decoded samples waiting for the aggregator, per device
+SAMPLE_BUFFER = 1024
+# seconds to find and connect a device, and between reconnection attempts (doubled after each failure)
+BLE_CONNECT_TIMEOUT = float(os.getenv("BLE_CONNECT_TIMEOUT", 10))
+BLE_RECONNECT_MIN = float(os.getenv("BLE_RECONNECT_MIN", 1))
+BLE_RECONNECT_MAX = float(os.getenv("BLE_RECONNECT_MAX", 30))
+
+class IMUStream:
+    """ Complete samples of one IMU, checked for sequence gaps and queued for the aggregator
+    Each sample is an immutable IMUSample, so a row never mixes axes of two samples.
+    """
+    def __init__(self, capacity=SAMPLE_BUFFER):
+        # binary frame decoder, the legacy text format is detected per notification
+        self.parser = FrameParser()
+        self.sequence = SequenceTracker()
+        # filled from the BLE callbacks, drained by the aggregator thread
+        self.ring = SampleRing(capacity)
+        self.latest = None
+        # axes of the legacy text format, received one per notification
+        self.text_values = [0]*6
+        self.text_seq = 0
+        self.notifications = 0
+
+    def receive(self, value: bytes, host_time=None):
+        self.notifications += 1
+        if host_time is None:
+            host_time = round(time.time()*1000)
+        if self.parser.is_binary(value):
+            samples = self.parser.feed(value, host_time)
+            if len(samples) == 0:
+                return
+            # frames of one notification arrive together, date them back from their device time
+            last_time = samples[-1].device_time
+            for sample in samples:
+                if self.sequence.check(sample.seq):
+                    self.publish(sample._replace(host_time=host_time - ((last_time - sample.device_time) & 0xFFFFFFFF)))
+            return
+        self.text_values = decode_text(value, self.text_values)
+        # axes are sent in order, the sample is complete with the last one
+        if value.startswith(b"5#"):
+            self.sequence.check(self.text_seq)
+            self.publish(IMUSample(self.text_seq, 0, host_time, tuple(self.text_values)))
+            self.text_seq = (self.text_seq + 1) & 0xFFFF
+
+    def publish(self, sample: IMUSample):
+        self.latest = sample
+        self.ring.push(sample)
+
+    def drain(self):
+        """All the samples received since the last drain, oldest first"""
+        return self.ring.drain()
+
+    def restart(self):
+        """Start over on a new connection: the device counts its frames from 0 again"""
+        self.parser.buffer.clear()
+        self.sequence.restart()
+
+    def stats(self):
+        return {
+            "notifications": self.notifications,
+            "received": self.sequence.received,
+            "dropped": self.sequence.dropped,
+            "duplicated": self.sequence.duplicated,
+            "overflows": self.ring.overflows,
+            "errors": self.parser.errors,
+        }
 
 class BLE_Devices:
+    """ Connect all the IMUs of the registry at the same time, and reconnect each of them on its own
+    A device out of range is retried with an exponential backoff, without
+    interrupting the others. interface builds the BLE connections
+    (BLE_interface, or a fake one, see backends.py).
+    """
+    def __init__(self, devices, interface=None) -> None:
+        self.devices = devices # list of Device, see devices.py
+        # ble_serial's BLE_interface, or the simulator, depending on HARDWARE_BACKEND
+        self.interface = interface if interface is not None else backends.ble_interface()
+        # current BLE connection per device
+        self.interfaces = {}
+        # IMU samples per device, in column order
+        self.streams = {device.name: IMUStream() for device in devices}
+        self.connections = {device.name: 0 for device in devices}
+        self.connected = {device.name: False for device in devices}
+        self.loop = None
+        self.enabled = True
+
+    def drain(self):
+        """Samples received since the last drain, per device"""
+        return {name: stream.drain() for name, stream in self.streams.items()}
+
+    def stats(self):
+        stats = {}
+        for name, stream in self.streams.items():
+            stats[name] = stream.stats()
+            stats[name]["connections"] = self.connections[name]
+        return stats
 
-    def __init__(self, mac_left, mac_right) -> None:
-        self.mac_left = mac_left
-        self.mac_right = mac_right
-        # bluetooth left and right
-        self.ble_left = None
-        self.ble_right = None
-        self.imu_left = [0]*6 # IMU data
-        self.imu_right = [0]*6 # IMU data
-
-    def update_imu_data(self, value, imu_data):
-        res = value.split(b"#")# split input
-        if len(res) == 2: #if there are two parts
-            index_string = res[0].decode("utf-8");index = int(index_string)  # first is index and value
-            value_string = res[1].decode("utf-8");value = float(value_string)# second is value
-            imu_data[index] = value 
-        return  imu_data
-        
-    def receive_callback_left(self, value: bytes):
-        self.imu_left = self.update_imu_data(value, self.imu_left)
-
-    def receive_callback_right(self, value: bytes):
-        self.imu_right = self.update_imu_data(value, self.imu_right)
+    def metrics(self):
+        stats = self.stats()
+        def per_device(key):
+            return [({"device": name}, values[key]) for name, values in stats.items()]
+        return [
+            counter("ble_notifications_total", "BLE notifications received", per_device("notifications")),
+            counter("ble_parse_errors_total", "Discarded bytes or invalid frames", per_device("errors")),
+            counter("ble_connections_total", "Successful connections", per_device("connections")),
+            gauge("ble_connected", "1 while the device is connected", [({"device": name}, int(status)) for name, status in self.connected.items()]),
+            counter("imu_samples_total", "IMU samples received", per_device("received")),
+            counter("imu_dropped_samples_total", "IMU samples missing from the frame sequence", per_device("dropped")),
+            counter("imu_duplicated_samples_total", "IMU samples received twice", per_device("duplicated")),
+            counter("imu_overflows_total", "IMU samples lost on a full buffer", per_device("overflows")),
+        ]
 
     def stop(self):
-        if self.mac_left:
-            # Stop listening to BLE notification, leading to BLE disconnection
-            self.ble_left.stop_loop()
-        if self.mac_right:
-            # Stop listening to BLE notification, leading to BLE disconnection
-            self.ble_right.stop_loop()
+        """Stop the connections and the reconnections, from any thread"""
+        self.enabled = False
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_loops)
+
+    def stop_loops(self):
+        # Stop listening to BLE notification, leading to BLE disconnection
+        for ble in self.interfaces.values():
+            ble.stop_loop()
+        self.stopped.set()
 
     async def ble_disconnect(self):
-        if self.mac_left:
-            await self.ble_left.disconnect()
-        if self.mac_right:
-            await self.ble_right.disconnect()
+        for ble in self.interfaces.values():
+            await ble.disconnect()
+
+    async def supervise(self, device: Device):
+        """Keep one device connected until stop()"""
+        name = device.name
+        stream = self.streams[name]
+        delay = BLE_RECONNECT_MIN
+        while self.enabled:
+            ble = self.interface(ADAPTER, SERVICE_UUID)
+            ble.set_receiver(stream.receive)
+            self.interfaces[name] = ble
+            try:
+                await ble.connect(device.mac, "public", BLE_CONNECT_TIMEOUT)
+                await ble.setup_chars(WRITE_UUID, READ_UUID, "rw")
+                stream.restart()
+                self.connections[name] += 1
+                self.connected[name] = True
+                logging.info(f"BLE {name} connected")
+                delay = BLE_RECONNECT_MIN
+                # runs until the device disconnects or stop() is called
+                await ble.send_loop()
+            except Exception as error:
+                logging.error(f"BLE {name}: {error}")
+            finally:
+                self.connected[name] = False
+                try:
+                    await ble.disconnect()
+                except Exception as error:
+                    logging.error(f"BLE {name} disconnection: {error}")
+            if not self.enabled:
+                break
+            logging.info(f"BLE {name} reconnecting in {delay:g} s")
+            try:
+                await asyncio.wait_for(self.stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, BLE_RECONNECT_MAX)
 
     async def connect(self):
-        if self.mac_left:
-            self.ble_left = BLE_interface(ADAPTER, SERVICE_UUID)
-            self.ble_left.set_receiver(self.receive_callback_left)
-
-        if self.mac_right:
-            self.ble_right = BLE_interface(ADAPTER, SERVICE_UUID)
-            self.ble_right.set_receiver(self.receive_callback_right)
-
-        try:
-            if self.ble_left:
-                await self.ble_left.connect(self.mac_left, "public", 10.0)
-                await self.ble_left.setup_chars(WRITE_UUID, READ_UUID, "rw")
-            
-            if self.mac_right:
-                await self.ble_right.connect(self.mac_right, "public", 10.0)
-                await self.ble_right.setup_chars(WRITE_UUID, READ_UUID, "rw")
-            
-            if self.mac_left and self.mac_right:
-                await asyncio.gather(self.ble_left.send_loop(), self.ble_right.send_loop()) #triger bluetooth
-            elif self.mac_left:
-                await asyncio.gather(self.ble_left.send_loop())
-            elif self.mac_right: 
-                await asyncio.gather(self.ble_right.send_loop())
-    
-        except Exception as error:
-            print(error)
-    
-        finally:
-            # stop_recording = True # stop recording
-            await self.ble_disconnect()
\ No newline at end of file
+        """Connect the devices and keep them connected, until stop()"""
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if not self.enabled:
+            return
+        # all devices on this event loop, the ones without MAC keep zeros in their columns
+        await asyncio.gather(*(self.supervise(device) for device in self.devices if device.mac))
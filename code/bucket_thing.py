@@ -15,38 +15,392 @@ LOG_PATH=/home/pi/wheelchair/logs
 COMPLETE_DATA_PATH=/home/pi/wheelchair/data/
 ARCHIVE_PATH=/home/pi/wheelchair/archive/
 UPLOAD_FREQUENCY=10
+UPLOAD_WORKERS=4
+UPLOAD_MAX_IN_FLIGHT=8
+UPLOAD_CHUNK_ROWS=5000
+UPLOAD_BATCH_FILES=200
+UPLOAD_BATCH_ROWS=200000
+UPLOAD_BATCH_DELAY=10
+UPLOAD_LABEL_GAP=60
+UPLOAD_DECIMALS=3
+# upload the window summaries of inference.py, see INFERENCE_SUMMARY_PATH
+UPLOAD_SUMMARY_PATH=
+UPLOAD_RAW=1
+BLE_DEVICES=left=...,right=...
+JOURNAL_PATH=/home/pi/wheelchair/upload-journal.sqlite
+# Prometheus metrics, see metrics.py
+UPLOAD_METRICS_PORT=9102
+METRICS_TEXTFILE_DIR=/var/lib/node_exporter/textfile_collector/
 
 """
 
 import numpy as np
-import os, glob
+import os
 from os.path import join
-import time
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# before the modules reading their settings from the environment
+from dotenv import load_dotenv
+load_dotenv()
+
+import datafile
+import metrics
+from devices import DEVICES, DEVICE_COLUMNS
+from inference import SUMMARY_LABEL
+from journal import UploadJournal
+from metrics import counter, gauge, histogram
+from scheduler import Histogram
+from watcher import create_watcher, PollingWatcher
 
 # Import Thing from the Data-Centric Design
 from dcd.bucket.thing import Thing
+from dcd.bucket.properties.property import Property
 
 COMPLETE_DATA_PATH = os.getenv("COMPLETE_DATA_PATH", os.path.abspath(os.getcwd())+'/data/')
 ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", os.path.abspath(os.getcwd())+'/archive/')
 UPLOAD_FREQUENCY = int(os.getenv("UPLOAD_FREQUENCY", "10"))
 NUMBER_FSR = int(os.getenv("NUMBER_FSR", "0"))
+# number of concurrent property updates, and maximum number of updates waiting or running
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_MAX_IN_FLIGHT = int(os.getenv("UPLOAD_MAX_IN_FLIGHT", "8"))
+# rows per request, across files, upload progress is recorded in the journal after each of them
+UPLOAD_CHUNK_ROWS = int(os.getenv("UPLOAD_CHUNK_ROWS", "5000"))
+# files uploaded together, at most, and their rows, and seconds to wait for more files before uploading the ones found
+UPLOAD_BATCH_FILES = int(os.getenv("UPLOAD_BATCH_FILES", "200"))
+UPLOAD_BATCH_ROWS = int(os.getenv("UPLOAD_BATCH_ROWS", "200000"))
+UPLOAD_BATCH_DELAY = float(os.getenv("UPLOAD_BATCH_DELAY", "10"))
+# seconds between two files of the same label still counted as one run
+UPLOAD_LABEL_GAP = float(os.getenv("UPLOAD_LABEL_GAP", "60"))
+# decimals of the IMU values of compact files sent to the server, 3 keeps their resolution,
+# values of other files are sent as stored
+UPLOAD_DECIMALS = int(os.getenv("UPLOAD_DECIMALS", "3"))
+# folder of the summary segments to upload (INFERENCE_SUMMARY_PATH), none by default
+UPLOAD_SUMMARY_PATH = os.getenv("UPLOAD_SUMMARY_PATH", None)
+# 0 to upload only the labels of the data files (and the summaries), not their sensor values
+UPLOAD_RAW = os.getenv("UPLOAD_RAW", "1") != "0"
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", os.path.abspath(os.getcwd())+'/upload-journal.sqlite')
+# port of the metrics endpoint, 0 for none
+UPLOAD_METRICS_PORT = int(os.getenv("UPLOAD_METRICS_PORT", "0"))
+
+# bucket upper bounds of the request latency, in seconds
+SYNC_BUCKETS = [0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, float("inf")]
 
-def initialize_properties(thing):
-    """Retrieve or create properties on the server
+def initialize_properties(thing, devices=DEVICES, summary=bool(UPLOAD_SUMMARY_PATH)):
+    """Retrieve or create properties on the server, two per IMU device of the registry
+    and one for the window summaries if they are uploaded
     Return dictionary of properties
     """
     thing.logger.info("Retrieve or create properties")
-    properties = {
-        "acc_left": thing.find_or_create_property("Accelerometer Left", "ACCELEROMETER"),
-        "acc_right": thing.find_or_create_property("Accelerometer Right", "ACCELEROMETER"),
-        "gyro_left": thing.find_or_create_property("Gyroscope Left", "GYROSCOPE"),
-        "gyro_right": thing.find_or_create_property("Gyroscope Right", "GYROSCOPE"),
-        "fsr": thing.find_or_create_property("Force Distribution 10", "FSR10"),
-        "label": thing.find_or_create_property("Test Label", "TEXT")
-    }
+    properties = {}
+    for device in devices:
+        properties["acc_" + device.name] = thing.find_or_create_property("Accelerometer " + device.name.title(), "ACCELEROMETER")
+        properties["gyro_" + device.name] = thing.find_or_create_property("Gyroscope " + device.name.title(), "GYROSCOPE")
+    properties["fsr"] = thing.find_or_create_property("Force Distribution 10", "FSR10")
+    properties["label"] = thing.find_or_create_property("Test Label", "TEXT")
+    if summary:
+        properties["summary"] = thing.find_or_create_property("Activity Summary", "ACTIVITY_SUMMARY")
     return properties
 
 
+def to_rows(timestamps, values, decimals=None):
+    """Build [ts, v1, v2, ...] rows in one pass, keeping integer timestamps
+    Rounding in float64 keeps float32 noise (9.8100004196167) out of the JSON.
+    """
+    if decimals is not None:
+        values = values.astype(np.float64).round(decimals)
+    return np.hstack((timestamps[:, None].astype(object), values)).tolist()
+
+
+def convert_data(timestamps, values, start_timestamp, label, number_fsr=NUMBER_FSR, devices=DEVICES, decimals=None):
+    """Convert the whole content of a data file into rows of values per property
+    Sensor groups with only zeros (e.g. device not connected) are filtered out.
+    IMU values are rounded to decimals, unless None.
+    Return dictionary of rows per property name
+    """
+    # Convert relative time to absolute, in milliseconds
+    timestamps = start_timestamp + timestamps.astype(np.int64)
+    rows = {}
+    for device in devices:
+        imu = values[:, device.columns]
+        connected = imu.sum(axis=1) != 0
+        rows["acc_" + device.name] = to_rows(timestamps[connected], imu[connected, 0:3], decimals)
+        rows["gyro_" + device.name] = to_rows(timestamps[connected], imu[connected, 3:6], decimals)
+    # the label is constant over the file, it is sent as a run: first and last rows only
+    ends = timestamps[[0, -1]] if len(timestamps) > 1 else timestamps
+    rows["label"] = [[ts, label] for ts in ends.tolist()]
+    if number_fsr > 0:
+        imu_columns = DEVICE_COLUMNS * len(devices)
+        fsr = values[:, imu_columns:imu_columns+number_fsr]
+        pressed = fsr.sum(axis=1) != 0
+        rows["fsr"] = to_rows(timestamps[pressed], fsr[pressed].astype(np.int64))
+    return rows
+
+
+def run_length(rows, max_gap):
+    """Start and end points of the runs of a constant value in [ts, value] rows (in time order)
+    Rows inside a run, less than max_gap ms apart, are dropped.
+    """
+    runs = []
+    for row in rows:
+        if len(runs) >= 2 and runs[-1][1] == row[1] and runs[-2][1] == row[1] and row[0] - runs[-1][0] <= max_gap:
+            # extend the current run
+            runs[-1] = row
+        else:
+            runs.append(row)
+    return runs
+
+
+def convert_blocks(timestamps, values, start_timestamp, label, block_rows, decimals=None, raw=True):
+    """Rows of convert_data() for blocks of block_rows rows of a file, one block at a time
+    The blocks of rows of each property add up to the rows of the whole file.
+    Only the label is converted unless raw. Rows of summary segments (see
+    inference.py) go as they are to the summary property.
+    """
+    for start in range(0, len(timestamps), block_rows):
+        if label == SUMMARY_LABEL:
+            yield {"summary": to_rows(start_timestamp + timestamps[start:start + block_rows].astype(np.int64), values[start:start + block_rows])}
+            continue
+        rows = {}
+        if raw:
+            rows = convert_data(timestamps[start:start + block_rows], values[start:start + block_rows], start_timestamp, label,
+                                decimals=decimals)
+        # the label run covers the whole file, it comes with the first block
+        ends = timestamps[[0, -1]] if len(timestamps) > 1 else timestamps
+        rows["label"] = [[start_timestamp + int(ts), label] for ts in ends.tolist()] if start == 0 else []
+        yield rows
+
+
+def take(pieces, count):
+    """Remove up to count rows from the front of a deque of (file path, rows acknowledged after, rows)
+    Return them as a request, a list of pieces.
+    """
+    request, size = [], 0
+    while len(pieces) > 0 and size < count:
+        file_path, end, rows = pieces[0]
+        if len(rows) <= count - size:
+            request.append(pieces.popleft())
+            size += len(rows)
+        else:
+            # split the piece, the rest stays in front
+            taken = count - size
+            request.append((file_path, end - len(rows) + taken, rows[:taken]))
+            pieces[0] = (file_path, end, rows[taken:])
+            size += taken
+    return request
+
+
+def sync_property(thing, prop):
+    """Upload the values of a property over HTTP and clean up the local values
+    Unlike Property.sync(), raise an error if the server does not accept them.
+    """
+    status = thing.http.update_property(prop)
+    if status < 200 or status >= 300:
+        raise IOError(f"Upload of {prop.name} failed with status {status}")
+    prop.values = []
+
+
+def backlog_metrics(folder=COMPLETE_DATA_PATH):
+    """Number and size of the complete files waiting to be uploaded"""
+    files = [entry for entry in os.scandir(folder) if entry.name.endswith(datafile.SUFFIXES)]
+    return [
+        gauge("upload_backlog_files", "Complete data files waiting to be uploaded", len(files)),
+        gauge("upload_backlog_bytes", "Size of the complete data files waiting to be uploaded", sum(entry.stat().st_size for entry in files)),
+    ]
+
+
+class Batch:
+    """ Files uploaded together, and the rows converted but not sent yet """
+    def __init__(self):
+        self.files = []
+        self.rows = 0 # rows of the data files
+        self.pieces = {} # property name -> deque of (file path, rows acknowledged after, rows)
+        self.buffered = {} # property name -> rows in pieces
+        self.previous = {} # property name -> future of its last request
+        self.failed = set() # files with rows not acknowledged
+
+
+class Uploader:
+    """ Upload the rows of many files together, with a bounded pool of threads
+    Files are read one at a time, oldest first, and their rows gathered per
+    property into requests of up to chunk_rows rows, spanning several files.
+    Requests of different properties are sent at the same time, the ones of
+    a property one after the other. Progress is recorded per file and
+    property in the journal once a request is acknowledged, an interrupted
+    upload resumes after it. Files are archived at the end of their batch
+    (up to batch_files files and batch_rows rows) once all their rows are
+    acknowledged. Only one block of rows per property is converted at a
+    time, whatever the size of the batch. Unless upload_raw, only the label
+    runs of the data files are uploaded.
+    """
+    def __init__(self, thing, properties, journal: UploadJournal, workers=UPLOAD_WORKERS, max_in_flight=UPLOAD_MAX_IN_FLIGHT,
+                 chunk_rows=UPLOAD_CHUNK_ROWS, batch_files=UPLOAD_BATCH_FILES, batch_rows=UPLOAD_BATCH_ROWS, upload_raw=UPLOAD_RAW):
+        self.thing = thing
+        self.properties = properties
+        self.journal = journal
+        self.upload_raw = upload_raw
+        self.chunk_rows = chunk_rows
+        self.batch_files = batch_files
+        self.batch_rows = batch_rows
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Upload")
+        # requests submitted and not finished yet
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.batch_size = 0 # files of the batch in progress
+        self.sync_latency = Histogram(SYNC_BUCKETS)
+        self.uploaded_rows = {} # property name -> rows acknowledged by the server
+        self.requests = 0
+        self.failed_updates = 0
+        self.archived_files = 0
+        self.invalid_files = 0
+
+    def upload_files(self, file_paths):
+        """Upload files oldest first, in batches of up to batch_files files and batch_rows rows
+        Block until the files are uploaded, or their upload failed.
+        """
+        files = []
+        for file_path in file_paths:
+            try:
+                files.append((datafile.parse_file_name(file_path), file_path))
+            except ValueError as error:
+                # would fail on every check, keep it aside for a look
+                self.set_aside(file_path, ".invalid", error)
+        files.sort(key=lambda file: file[0][1])
+        batch = Batch()
+        for (label, start_timestamp), file_path in files:
+            try:
+                timestamps, values, imu_columns, encoding = datafile.read(file_path)
+            except Exception as error:
+                self.thing.logger.error(f"Cannot read {file_path}: {error}")
+                continue
+            if label != SUMMARY_LABEL and imu_columns is not None and imu_columns != DEVICE_COLUMNS * len(DEVICES):
+                # written with another registry of devices, its columns would go to the wrong properties
+                self.set_aside(file_path, ".rejected", f"{imu_columns} IMU columns, {len(DEVICES)} devices in BLE_DEVICES")
+                continue
+            # float32 noise of the decoded values is rounded off, other values are sent as stored
+            decimals = UPLOAD_DECIMALS if encoding == "compact" else None
+            self.add_file(batch, file_path, timestamps, values, start_timestamp, label, decimals)
+            if len(batch.files) >= self.batch_files or batch.rows >= self.batch_rows:
+                self.finish_batch(batch)
+                batch = Batch()
+        self.finish_batch(batch)
+
+    def add_file(self, batch, file_path, timestamps, values, start_timestamp, label, decimals=None):
+        """Convert a file block by block, sending the requests filled on the way"""
+        file_name = os.path.basename(file_path)
+        batch.files.append(file_path)
+        batch.rows += len(timestamps)
+        with self.lock:
+            self.batch_size = len(batch.files)
+        # Skip the rows acknowledged before an interruption
+        acked = {name: self.journal.acked(file_name, name) for name in self.properties}
+        converted = {name: 0 for name in self.properties}
+        for block in convert_blocks(timestamps, values, start_timestamp, label, self.chunk_rows, decimals, self.upload_raw):
+            for name, rows in block.items():
+                skip = min(len(rows), max(0, acked[name] - converted[name]))
+                converted[name] += len(rows)
+                if len(rows) > skip:
+                    batch.pieces.setdefault(name, deque()).append((file_path, converted[name], rows[skip:]))
+                    batch.buffered[name] = batch.buffered.get(name, 0) + len(rows) - skip
+                while batch.buffered.get(name, 0) >= self.chunk_rows:
+                    self.send(batch, name)
+
+    def send(self, batch, name):
+        """Submit a request of the next rows of a property, once its previous request is acknowledged"""
+        request = take(batch.pieces[name], self.chunk_rows)
+        batch.buffered[name] -= sum(len(rows) for file_path, end, rows in request)
+        previous = batch.previous.get(name)
+        if previous is not None and previous.exception() is not None:
+            # the rows after a failed request are not sent, the journal only records the rows acknowledged in order
+            with self.lock:
+                batch.failed.update(file_path for file_path, end, rows in request)
+            return
+        self.in_flight.acquire()
+        future = self.pool.submit(self.upload_request, batch, name, request)
+        future.add_done_callback(lambda future: self.in_flight.release())
+        batch.previous[name] = future
+
+    def upload_request(self, batch, name, request):
+        """Upload rows of one property for one or several files, recording progress in the journal"""
+        rows = [row for file_path, end, file_rows in request for row in file_rows]
+        prop = self.properties[name]
+        # Fresh copy of the property, so that requests do not share values
+        # the label is constant over long runs, only their ends are sent
+        prop = Property(property_id=prop.property_id, name=prop.name, type_id=prop.type_id, thing=self.thing,
+                        values=run_length(rows, UPLOAD_LABEL_GAP * 1000) if name == "label" else rows)
+        count = len(prop.values)
+        sync_start = time.monotonic()
+        try:
+            sync_property(self.thing, prop)
+        except Exception as error:
+            self.thing.logger.error(error)
+            with self.lock:
+                self.failed_updates += 1
+                batch.failed.update(file_path for file_path, end, rows in request)
+            raise
+        with self.lock:
+            self.sync_latency.observe(time.monotonic() - sync_start)
+            self.uploaded_rows[name] = self.uploaded_rows.get(name, 0) + count
+            self.requests += 1
+        for file_path, end, file_rows in request:
+            self.journal.ack(os.path.basename(file_path), name, end)
+
+    def finish_batch(self, batch):
+        """Send the rows left, wait for the requests and archive the files fully acknowledged"""
+        for name in list(batch.pieces):
+            while batch.buffered[name] > 0:
+                self.send(batch, name)
+        for future in batch.previous.values():
+            # requests of a property finish in order, the last one finishes after the others
+            future.exception()
+        for file_path in batch.files:
+            try:
+                if file_path in batch.failed:
+                    # left in place, retried on the next check
+                    self.thing.logger.error(f"Upload of {file_path} incomplete, will try again.")
+                else:
+                    self.archive(file_path)
+            except Exception as error:
+                # left in place, its rows are acknowledged in the journal and it is archived on the next check
+                self.thing.logger.error(f"Cannot archive {file_path}: {error}")
+        with self.lock:
+            self.batch_size = 0
+
+    def archive(self, file_path):
+        # Move file to the archive folder, summaries apart from the data files indexed by archive.py
+        folder = ARCHIVE_PATH
+        if datafile.parse_file_name(file_path)[0] == SUMMARY_LABEL:
+            folder = os.path.join(ARCHIVE_PATH, SUMMARY_LABEL, "")
+            os.makedirs(folder, exist_ok=True)
+        os.rename(file_path, folder + os.path.basename(file_path))
+        self.journal.forget(os.path.basename(file_path))
+        self.archived_files += 1
+        self.thing.logger.info(f"Uploaded and archived {file_path}.")
+
+    def set_aside(self, file_path, suffix, reason):
+        """Rename a file that cannot be uploaded, so that it is no longer found as a data file"""
+        self.thing.logger.error(f"Cannot upload {file_path}, renamed to {file_path + suffix}: {reason}")
+        try:
+            os.rename(file_path, file_path + suffix)
+        except OSError as error:
+            self.thing.logger.error(f"Cannot rename {file_path}: {error}")
+        with self.lock:
+            self.invalid_files += 1
+
+    def metrics(self):
+        with self.lock:
+            return [
+                counter("upload_rows_total", "Rows acknowledged by the server", [({"property": name}, rows) for name, rows in self.uploaded_rows.items()]),
+                counter("upload_requests_total", "Property updates acknowledged by the server", self.requests),
+                histogram("upload_sync_seconds", "Time of a property update request", self.sync_latency),
+                counter("upload_failed_updates_total", "Property updates failed, retried later", self.failed_updates),
+                counter("upload_archived_files_total", "Files uploaded and archived", self.archived_files),
+                counter("upload_invalid_files_total", "Files set aside, not uploaded", self.invalid_files),
+                gauge("upload_pending_files", "Files of the batch being uploaded", self.batch_size),
+            ]
+
+
 if __name__ == "__main__":
     
     thing = None
@@ -65,44 +419,34 @@ if __name__ == "__main__":
             time.sleep(5)
             #exit()
     
+    uploader = Uploader(thing, properties, UploadJournal(JOURNAL_PATH))
+    # React to new complete files, and rescan every UPLOAD_FREQUENCY seconds for files to retry
+    watcher = create_watcher(COMPLETE_DATA_PATH, datafile.SUFFIXES)
+    # a few summary segments an hour, scanned along with the data folder
+    summary_watcher = PollingWatcher(UPLOAD_SUMMARY_PATH, (".seg",)) if UPLOAD_SUMMARY_PATH else None
+    metrics.REGISTRY.register("upload", uploader.metrics)
+    metrics.REGISTRY.register("backlog", backlog_metrics)
+    metrics.start("bucket_thing", UPLOAD_METRICS_PORT)
 
-    # Main loop. check the data file and upload all files ending with .complete.npz
+    # Main loop. upload the data files as they are completed, together with the ones
+    # completed within UPLOAD_BATCH_DELAY seconds
+    waiting = {} # file path -> time found
     while True:
         try:
-            file_list = glob.glob(COMPLETE_DATA_PATH + '*.npz')
-            #print(file_list)
-            #exit()
-            thing.logger.info("Checking for data files to upload...")
+            timeout = UPLOAD_FREQUENCY
+            if len(waiting) > 0:
+                timeout = min(timeout, max(0, min(waiting.values()) + UPLOAD_BATCH_DELAY - time.monotonic()))
+            file_list = watcher.wait(timeout)
+            if summary_watcher is not None:
+                file_list += summary_watcher.scan()
             for file_path in file_list:
-                thing.logger.info(f"Found file {file_path}.")
-                # Retrieve timestamp and label from file name
-                file_name = os.path.basename(file_path)
-                start_timestamp = int(file_name.split(".")[0].split("-")[1])
-                label = file_name.split(".")[0].split("-")[0]
-                # Load the npz data file
-                data = np.load(file_path)['data']
-                #print(data)
-                #exit()
-                for values in data:
-                    # Convert relative time to absolute, in milliseconds
-                    ts = start_timestamp + int(values[0])
-                    # Inject data in each property, filtering out complete lines of 0
-                    if (values[1:7].sum() != 0):
-                        properties["acc_left"].update_values([float(i) for i in values[1:4]], ts, mode='a')
-                        properties["gyro_left"].update_values([float(i) for i in values[4:7]], ts, mode='a')
-                    if (values[7:13].sum() != 0):
-                        properties["acc_right"].update_values([float(i) for i in values[7:10]], ts, mode='a')
-                        properties["gyro_right"].update_values([float(i) for i in values[10:13]], ts, mode='a')
-                    if (NUMBER_FSR>0 and values[13:13+NUMBER_FSR].sum() != 0):
-                        properties["fsr"].update_values([int(i) for i in values[13:13+NUMBER_FSR]], ts, mode='a')
-                    properties["label"].update_values([label], ts, mode="a")
-                #print(properties)
-                # Upload data to the server
-                for name in properties:
-                    properties[name].sync()
-                # Move file to the archive folder
-                os.rename(file_path, ARCHIVE_PATH + os.path.basename(file_path))
-            thing.logger.info("Done uploading data.")
+                if file_path not in waiting:
+                    thing.logger.info(f"Found file {file_path}.")
+                    waiting[file_path] = time.monotonic()
+            if len(waiting) > 0 and (len(waiting) >= UPLOAD_BATCH_FILES or time.monotonic() - min(waiting.values()) >= UPLOAD_BATCH_DELAY):
+                file_paths = list(waiting)
+                waiting.clear()
+                uploader.upload_files(file_paths)
         except Exception as error:
             thing.logger.error(error)
-        time.sleep(UPLOAD_FREQUENCY)
\ No newline at end of file
+            time.sleep(UPLOAD_FREQUENCY)
\ No newline at end of file
@@ -0,0 +1,40 @@
+import numpy as np
+
+class BlockBuffer:
+    """ Preallocated block of rows: int64 timestamps and float32 sensor values
+    Rows are written in place, the block is handed over whole once full.
+    """
+    def __init__(self, rows, columns):
+        self.timestamps = np.zeros(rows, dtype=np.int64)
+        self.values = np.zeros((rows, columns), dtype=np.float32)
+        self.length = 0
+
+    def next_row(self, timestamp):
+        """Reserve the next row, return its values to fill in place"""
+        row = self.values[self.length]
+        self.timestamps[self.length] = timestamp
+        self.length += 1
+        return row
+
+    def extend(self, timestamps, values):
+        """Copy as many rows as fit, return their number"""
+        count = min(len(timestamps), len(self.timestamps) - self.length)
+        self.timestamps[self.length:self.length + count] = timestamps[:count]
+        self.values[self.length:self.length + count] = values[:count]
+        self.length += count
+        return count
+
+    def grow(self):
+        """Double the capacity (copies the rows, only for unexpectedly long recordings)"""
+        self.timestamps = np.concatenate((self.timestamps, np.zeros_like(self.timestamps)))
+        self.values = np.concatenate((self.values, np.zeros_like(self.values)))
+
+    def is_full(self):
+        return self.length == len(self.timestamps)
+
+    def is_empty(self):
+        return self.length == 0
+
+    def rows(self):
+        """Views on the rows written so far (no copy)"""
+        return self.timestamps[:self.length], self.values[:self.length]
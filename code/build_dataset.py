@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Build a dataset of window features from the labelled recordings of
+collect_activities.py, for activity recognition.
+
+Usage:
+python build_dataset.py output_folder [--labels rolling,sitting] [--window 200] [--step 100] [--workers 8]
+
+Output folder:
+features.npy     float32 (windows, features), see features.py
+labels.npy       uint16 (windows,), index of the label of each window in dataset.json
+timestamps.npy   int64 (windows,), timestamp of the first row of each window (ms)
+dataset.json     label and feature names, window and step
+
+The files are listed from the index of archive.py (all labels but
+"continuous" by default) and processed by a pool of processes, one per
+core by default. The features of each file are written as they come to
+memory-mapped arrays sized from the row counts of the index, so the
+archive is never held in memory.
+
+Environment variables (.env file):
+COMPLETE_DATA_PATH=/home/pi/wheelchair/data/
+ARCHIVE_PATH=/home/pi/wheelchair/archive/
+ARCHIVE_INDEX_PATH=/home/pi/wheelchair/archive-index.sqlite
+FSR_POSITIONS=0,0;1,0;0,1;1,1
+"""
+
+import argparse, json, logging, os, time
+from multiprocessing import Pool
+import numpy as np
+
+# before the modules reading their settings from the environment
+from dotenv import load_dotenv
+load_dotenv()
+
+import datafile
+from archive import ArchiveIndex, read_range
+from devices import IMU_COLUMNS
+from features import feature_names, fsr_positions, window_count, window_features, windows
+
+logging.basicConfig(level=logging.INFO)
+
+def file_features(task):
+    """Features and first timestamp of the windows of one file, in a worker process
+    None for a file written with another registry of devices.
+    """
+    path, start_timestamp, size, step, positions = task
+    if datafile.layout(path) not in (None, IMU_COLUMNS):
+        return None
+    timestamps, values = read_range(path, start_timestamp)
+    return window_features(values, size, step, IMU_COLUMNS, positions), windows(timestamps[:, None], size, step)[:, 0, 0].copy()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a dataset of window features from the labelled recordings")
+    parser.add_argument("output", help="folder of the dataset")
+    parser.add_argument("--labels", help="comma-separated labels, all but continuous by default")
+    parser.add_argument("--window", type=int, default=200, help="rows per window")
+    parser.add_argument("--step", type=int, default=100, help="rows between the starts of two windows")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    arguments = parser.parse_args()
+
+    index = ArchiveIndex()
+    index.update()
+    entries = [entry for entry in index.files() if entry.label != "continuous"]
+    if arguments.labels:
+        entries = [entry for entry in entries if entry.label in arguments.labels.split(",")]
+    if len(set(entry.columns for entry in entries)) > 1:
+        raise SystemExit("Files with different columns (devices or FSRs), select them with --labels")
+    if len(entries) == 0:
+        raise SystemExit("No file to process")
+    number_fsr = entries[0].columns - IMU_COLUMNS
+    positions = fsr_positions(number_fsr)
+    names = feature_names(number_fsr)
+    labels = sorted(set(entry.label for entry in entries))
+    counts = [window_count(entry.rows, arguments.window, arguments.step) for entry in entries]
+    total = sum(counts)
+    logging.info(f"{len(entries)} files, {total} windows of {len(names)} features")
+
+    os.makedirs(arguments.output, exist_ok=True)
+    open_memmap = np.lib.format.open_memmap
+    features = open_memmap(os.path.join(arguments.output, "features.npy"), mode="w+", dtype=np.float32, shape=(total, len(names)))
+    window_labels = open_memmap(os.path.join(arguments.output, "labels.npy"), mode="w+", dtype=np.uint16, shape=(total,))
+    window_timestamps = open_memmap(os.path.join(arguments.output, "timestamps.npy"), mode="w+", dtype=np.int64, shape=(total,))
+
+    start = time.monotonic()
+    tasks = [(entry.path, entry.start, arguments.window, arguments.step, positions) for entry in entries]
+    offset = 0
+    with Pool(arguments.workers) as pool:
+        # results come back in the order of the files, while the workers go ahead with the next ones
+        results = pool.imap(file_features, tasks, chunksize=max(1, len(tasks) // (arguments.workers * 16)))
+        for number, (entry, count, result) in enumerate(zip(entries, counts, results)):
+            if result is None:
+                logging.warning(f"{entry.name}: not {IMU_COLUMNS} IMU columns as in BLE_DEVICES, skipped")
+                continue
+            block, block_timestamps = result
+            if len(block) != count:
+                # the file changed since it was indexed, its windows are skipped
+                logging.warning(f"{entry.name}: {len(block)} windows instead of {count}, skipped")
+                continue
+            features[offset:offset + count] = block
+            window_labels[offset:offset + count] = labels.index(entry.label)
+            window_timestamps[offset:offset + count] = block_timestamps
+            offset += count
+            if (number + 1) % 1000 == 0:
+                logging.info(f"{number + 1}/{len(entries)} files")
+    features.flush()
+    window_labels.flush()
+    window_timestamps.flush()
+    with open(os.path.join(arguments.output, "dataset.json"), "w") as file:
+        # windows of skipped files are left at the end, only the first "windows" rows are valid
+        json.dump({"labels": labels, "features": names, "window": arguments.window, "step": arguments.step, "windows": offset}, file, indent=2)
+    logging.info(f"{offset} windows written in {time.monotonic() - start:.1f} s")
@@ -9,29 +9,51 @@ License: MIT
 Environment variables (.env file):
 COMPLETE_DATA_PATH=/home/pi/wheelchair/data/
 SAMPLING_FREQUENCY=0.1
+SAMPLING_POLICY=skip
+DATA_ENCODING=compact
+DATA_COMPRESSION=fast
 COLLECTION_DURATION=5
 
+# use light blue in your phone to find the mac address of your seeeduino xiao
 BLE_MAC_DEVICE_LEFT=
 BLE_MAC_DEVICE_RIGHT=
+# or any number of devices, see devices.py
+BLE_DEVICES=left=...,right=...,seat=...
 NUMBER_FSR=
+# run on simulated sensors, see backends.py
+HARDWARE_BACKEND=device
+FSR_DATA_RATE=860
+FSR_OVERSAMPLING=1
+FSR_SAMPLING_PERIOD=0.02
+# write the samples as received, or e.g. 10 to align the streams
+# on a grid of 10 ms (100 rows per second), see fusion.py
+FUSION_PERIOD=0
+FUSION_TOLERANCE=50
+# Prometheus metrics, see metrics.py
+COLLECTION_METRICS_PORT=9101
+METRICS_TEXTFILE_DIR=/var/lib/node_exporter/textfile_collector/
 """
 
-import asyncio, logging, os # system functions
-
-from fsr import FSR
-from bluetooth import BLE_Devices
-from save import DataAggregator
-from timekeeper import TimerKeeper, count_down, colors
+import asyncio, logging, os, threading # system functions
 
+# before the modules reading their settings from the environment
 from dotenv import load_dotenv
 load_dotenv()
 
-# use light blue in your phone to find the mac address of your seeeduino xiao
-BLE_MAC_DEVICE_LEFT = os.getenv("BLE_MAC_DEVICE_LEFT", None)
-BLE_MAC_DEVICE_RIGHT = os.getenv("BLE_MAC_DEVICE_RIGHT", None)
+import metrics
+from devices import DEVICES
+from fsr import FSR
+from bluetooth import BLE_Devices, BLE_CONNECT_TIMEOUT
+from save import DataAggregator, Writer
+from timekeeper import TimerKeeper, count_down, colors
+
 NUMBER_FSR = int(os.getenv("NUMBER_FSR", 0))
 COMPLETE_DATA_PATH = os.getenv("COMPLETE_DATA_PATH", os.path.abspath(os.getcwd())+'/data/')
 SAMPLING_FREQUENCY = float(os.getenv("SAMPLING_FREQUENCY", 0.1))
+# late ticks: "skip" to drop missed samples, "catch_up" to take them back to back
+SAMPLING_POLICY = os.getenv("SAMPLING_POLICY", "skip")
+# port of the metrics endpoint, 0 for none
+COLLECTION_METRICS_PORT = int(os.getenv("COLLECTION_METRICS_PORT", 0))
 COLLECTION_DURATION = int(os.getenv("COLLECTION_DURATION", 10))
 
 if __name__ == "__main__":
@@ -40,35 +62,46 @@ if __name__ == "__main__":
     print(colors.BLUE + "\n= = = = = = = = = = = = = = = = = = = = = = = =\n")
     print("Data collection script. Setting found in .env:")
     print(f"Number of FSR: {NUMBER_FSR}")
-    print(f"BLE MAC device left: {BLE_MAC_DEVICE_LEFT}")
-    print(f"BLE MAC device right: {BLE_MAC_DEVICE_RIGHT}")
+    for device in DEVICES:
+        print(f"BLE MAC device {device.name}: {device.mac}")
     
+    # The sensors and BLE links stay up for the whole session,
+    # each activity only opens a labelled recording window on the running streams
+    fsr = FSR(NUMBER_FSR)
+    ble_devices = BLE_Devices(DEVICES)
+    ble_thread = threading.Thread(target=asyncio.run, args=(ble_devices.connect(),), name="BLE", daemon=True)
+    ble_thread.start()
+    writer = Writer(COMPLETE_DATA_PATH)
+    writer.start()
+    metrics.REGISTRY.register("ble", ble_devices.metrics)
+    metrics.REGISTRY.register("writer", writer.metrics)
+    metrics.start("collect_activities", COLLECTION_METRICS_PORT)
+
     # for each activity
     while True:
         print("\n= = = = = = = = = = = = = = = = = = = = = = = =\n" + colors.ENDC)
-        
+        connected = [name for name, status in ble_devices.connected.items() if status]
+        print(f"Connected devices: {', '.join(connected) if connected else 'none'}")
+
         activity_name = input("Please type in the name of the activity\nto collect (press ENTER to quit):")
         
         # If the user input is empty (Pressed ENTER), quit the loop, i.e. emd the program
         if (activity_name == ""):
             break
         
-        # set up FSR readings
-        fsr = FSR(NUMBER_FSR)
-        # Set up BLE devices
-        ble_devices = BLE_Devices(BLE_MAC_DEVICE_LEFT, BLE_MAC_DEVICE_RIGHT)
-        
         # logging for debug
         #logging.basicConfig(level=logging.ERROR)
         
         # Start timer thread
-        timeKeeper = TimerKeeper(0, "Timer Keeper Thread", 0, COLLECTION_DURATION, activity_name, ble_devices)
+        timeKeeper = TimerKeeper(0, "Timer Keeper Thread", 0, COLLECTION_DURATION, activity_name)
         timeKeeper.start()
 
-        # Start data thread
-        dataAggregator = DataAggregator(0, "Data Aggregator Thread", 0, fsr, ble_devices,  COMPLETE_DATA_PATH, SAMPLING_FREQUENCY, timeKeeper)
+        # Start data thread, it writes the activity file once the timer stops
+        dataAggregator = DataAggregator(0, "Data Aggregator Thread", 0, fsr, ble_devices,  COMPLETE_DATA_PATH, SAMPLING_FREQUENCY, timeKeeper, SAMPLING_POLICY, writer)
+        metrics.REGISTRY.register("aggregator", dataAggregator.metrics)
         dataAggregator.start()
-        
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(ble_devices.connect())
-        loop.close()
+        dataAggregator.join()
+
+    ble_devices.stop()
+    ble_thread.join(BLE_CONNECT_TIMEOUT)
+    writer.stop(5)
@@ -0,0 +1,46 @@
+"""
+Compact encoding of sensor values for storage.
+
+Rows hold IMU columns (groups of acc x, y, z in m/s^2 and gyro x, y, z in
+rad/s) followed by FSR ADC counts. In the compact encoding:
+
+    IMU  int16, scaled like the binary BLE frames (imu_protocol.py):
+         0.01 m/s^2 and 0.001 rad/s per unit, no precision is lost
+         for samples received as int16 frames
+    FSR  uint16 ADC counts (ADS1115 single-ended readings are positive)
+
+The encoding is lossy for other sources: values of the legacy text
+notifications, float32 frames or fused (interpolated) rows are rounded
+to these units, and out of range values are clipped (e.g. above
+327.67 m/s^2). Use DATA_ENCODING=float32 to keep them as received.
+
+DATA_ENCODING selects "compact" (default) or "float32" for new files.
+"""
+
+import os
+import numpy as np
+
+from devices import IMU_COLUMNS
+from imu_protocol import ACC_SCALE, GYRO_SCALE
+
+DATA_ENCODING = os.getenv("DATA_ENCODING", "compact")
+
+def imu_scales(imu_columns=IMU_COLUMNS):
+    """Scale of each IMU column, for groups of 3 acc and 3 gyro axes"""
+    return np.tile([ACC_SCALE] * 3 + [GYRO_SCALE] * 3, imu_columns // 6).astype(np.float32)
+
+def encode(values, imu_columns=IMU_COLUMNS):
+    """Return (int16 IMU, uint16 FSR) arrays of float sensor values"""
+    if imu_columns % 6 != 0 or imu_columns > values.shape[1]:
+        raise ValueError(f"{imu_columns} IMU columns do not fit rows of {values.shape[1]} values")
+    imu = np.clip(np.rint(values[:, :imu_columns] * imu_scales(imu_columns)), -32768, 32767).astype(np.int16)
+    fsr = np.clip(np.rint(values[:, imu_columns:]), 0, 65535).astype(np.uint16)
+    return imu, fsr
+
+def decode(imu, fsr):
+    """Return float32 sensor values from compact IMU and FSR arrays"""
+    imu_columns = imu.shape[1]
+    values = np.empty((len(imu), imu_columns + fsr.shape[1]), dtype=np.float32)
+    np.divide(imu, imu_scales(imu_columns), out=values[:, :imu_columns])
+    values[:, imu_columns:] = fsr
+    return values
@@ -9,38 +9,86 @@ License: MIT
 Environment variables (.env file):
 COMPLETE_DATA_PATH=/home/pi/wheelchair/data/
 SAMPLING_FREQUENCY=0.1
+SAMPLING_POLICY=skip
+DATA_ENCODING=compact
+DATA_COMPRESSION=fast
+SEGMENT_MAX_BYTES=8388608
+SEGMENT_MAX_AGE=300
+WRITER_QUEUE_SIZE=32
+WRITER_POLICY=block
+WRITER_SPILL_PATH=/home/pi/wheelchair/spill/
 COLLECTION_DURATION=5
 
+# use light blue in your phone to find the mac address of your seeeduino xiao
 BLE_MAC_DEVICE_LEFT=
 BLE_MAC_DEVICE_RIGHT=
+# or any number of devices, see devices.py
+BLE_DEVICES=left=...,right=...,seat=...
+BLE_CONNECT_TIMEOUT=10
+BLE_RECONNECT_MIN=1
+BLE_RECONNECT_MAX=30
 NUMBER_FSR=
+# run on simulated sensors, see backends.py
+HARDWARE_BACKEND=device
+FSR_DATA_RATE=860
+FSR_OVERSAMPLING=1
+FSR_SAMPLING_PERIOD=0.02
+# write the samples as received, or e.g. 10 to align the streams
+# on a grid of 10 ms (100 rows per second), see fusion.py
+FUSION_PERIOD=0
+FUSION_TOLERANCE=50
+# keep every row, or deadband / swinging_door to keep only the rows
+# needed within some tolerances, see reduction.py
+REDUCTION_METHOD=none
+REDUCTION_ACC=0.05
+REDUCTION_GYRO=0.01
+REDUCTION_FSR=20
+IDLE_AFTER=10
+IDLE_PERIOD=60
+# no activity inference, or e.g. 200 for windows of 200 rows, see inference.py
+INFERENCE_WINDOW=0
+INFERENCE_STEP=100
+INFERENCE_CLASSIFIER=threshold
+# e.g. /home/pi/wheelchair/summary/, apart from COMPLETE_DATA_PATH
+INFERENCE_SUMMARY_PATH=
+# Prometheus metrics, see metrics.py
+COLLECTION_METRICS_PORT=9101
+METRICS_TEXTFILE_DIR=/var/lib/node_exporter/textfile_collector/
 """
 
 import asyncio, logging, os, signal, sys, time # system functions
 
+# before the modules reading their settings from the environment
+from dotenv import load_dotenv
+load_dotenv()
+
+import metrics
+from devices import DEVICES
 from fsr import FSR
 from bluetooth import BLE_Devices
-from save import DataAggregator
+from save import DataAggregator, Writer
 from timekeeper import TimerKeeper
 
-from dotenv import load_dotenv
-load_dotenv()
-
 logging.basicConfig(level=logging.INFO)
 
-# use light blue in your phone to find the mac address of your seeeduino xiao
-BLE_MAC_DEVICE_LEFT = os.getenv("BLE_MAC_DEVICE_LEFT", None)
-BLE_MAC_DEVICE_RIGHT = os.getenv("BLE_MAC_DEVICE_RIGHT", None)
 NUMBER_FSR = int(os.getenv("NUMBER_FSR", 0))
 COMPLETE_DATA_PATH = os.getenv("COMPLETE_DATA_PATH", os.path.abspath(os.getcwd())+'/data/')
 SAMPLING_FREQUENCY = float(os.getenv("SAMPLING_FREQUENCY", 0.1))
+# late ticks: "skip" to drop missed samples, "catch_up" to take them back to back
+SAMPLING_POLICY = os.getenv("SAMPLING_POLICY", "skip")
+# port of the metrics endpoint, 0 for none
+COLLECTION_METRICS_PORT = int(os.getenv("COLLECTION_METRICS_PORT", 0))
 
 def signal_handler(sig, frame):
     print("Disconnecting...")
     global enabled
     enabled = False
-    dataAggregator.stop_collection()
-    ble_devices.stop()
+    if dataAggregator is not None:
+        dataAggregator.stop_collection()
+        ble_devices.stop()
+        # write the last rows and close the segment before leaving
+        dataAggregator.join(5)
+    writer.stop(5)
     sys.exit(0)
 
 if __name__ == "__main__":
@@ -51,6 +99,13 @@ if __name__ == "__main__":
 
     enabled = True
 
+    # A single writer for the whole service, it outlives the restarts below
+    writer = Writer(COMPLETE_DATA_PATH)
+    writer.start()
+    dataAggregator = None
+    metrics.REGISTRY.register("writer", writer.metrics)
+    metrics.start("data_collection", COLLECTION_METRICS_PORT)
+
     # As long as the Raspbeery Pi is running or an interruption is caught
     while enabled:
         try:
@@ -58,14 +113,17 @@ if __name__ == "__main__":
             # Set up FSR readings
             fsr = FSR(NUMBER_FSR)
             # Set up BLE devices
-            ble_devices = BLE_Devices(BLE_MAC_DEVICE_LEFT, BLE_MAC_DEVICE_RIGHT)
+            ble_devices = BLE_Devices(DEVICES)
+            metrics.REGISTRY.register("ble", ble_devices.metrics)
 
             # Start data thread
             logging.info('Set up the data aggregator')
-            dataAggregator = DataAggregator(0, "Data Aggregator Thread", 0, fsr, ble_devices, COMPLETE_DATA_PATH, SAMPLING_FREQUENCY, None)
+            dataAggregator = DataAggregator(0, "Data Aggregator Thread", 0, fsr, ble_devices, COMPLETE_DATA_PATH, SAMPLING_FREQUENCY, None, SAMPLING_POLICY, writer)
+            metrics.REGISTRY.register("aggregator", dataAggregator.metrics)
             dataAggregator.start()
             
-            if (BLE_MAC_DEVICE_LEFT is not None or BLE_MAC_DEVICE_RIGHT is not None):
+            if any(device.mac for device in DEVICES):
+                # Each device is reconnected on its own, this only returns once stopped
                 logging.info('Start BLE connections')
                 loop = asyncio.new_event_loop()
                 loop.run_until_complete(ble_devices.connect())
@@ -75,3 +133,8 @@ if __name__ == "__main__":
         except Exception as error:
             # catch errors and start again
             logging.error(error)
+        # Stop this aggregator before starting a new one
+        if dataAggregator is not None:
+            dataAggregator.stop_collection()
+            dataAggregator.join()
+            dataAggregator = None
@@ -0,0 +1,115 @@
+"""
+Read and write the data files produced by DataAggregator.
+
+A data file is named <label>-<start timestamp>.npz and contains either:
+    timestamp    int64 (n,)         milliseconds since the first row
+    values       float32 (n, 12+f)  6 IMU left, 6 IMU right, then f FSRs
+    imu_columns  int64 ()           IMU columns of values, 6 per device
+or, in the compact encoding (see compact.py):
+    timestamp_delta  int32 (n,)   milliseconds since the previous row
+    imu              int16 (n, 12)
+    fsr              uint16 (n, f)
+
+DATA_COMPRESSION compresses the .npz: "none", "fast" (deflate level 1,
+default) or "deflate" (np.savez_compressed).
+
+Files written before this layout hold a single 'data' array, with the
+relative timestamp in the first column. Continuous collection writes
+append-only segments (<label>-<start timestamp>.seg, see segment.py).
+read() and load() read all of them.
+
+The IMU columns stored with the data are the layout of the devices
+registry when it was written, which may have changed since. Readers
+check it (e.g. the uploader rejects files of another layout) rather than
+slicing the columns by the current registry.
+"""
+
+import os, zipfile
+from collections import namedtuple
+import numpy as np
+
+import compact, segment
+
+DATA_COMPRESSION = os.getenv("DATA_COMPRESSION", "fast")
+
+# complete data files, as reported to the uploader
+SUFFIXES = (".npz", ".seg")
+
+# Content of a data file: relative timestamps (ms), values, IMU columns of
+# the values (None for the files written before they were stored), and
+# encoding of the values: "compact", "float32" or "legacy" (single 'data' array)
+Content = namedtuple("Content", ["timestamps", "values", "imu_columns", "encoding"])
+
+def parse_file_name(file_path):
+    """Retrieve label and start timestamp from the file name
+    The label may contain dashes, the start timestamp follows the last one.
+    Raise ValueError if the name is not <label>-<start timestamp>.
+    """
+    file_name = os.path.basename(file_path)
+    parts = file_name.split(".")[0].rsplit("-", 1)
+    if len(parts) != 2:
+        raise ValueError(f"{file_name} is not named <label>-<start timestamp>")
+    label, start_timestamp = parts[0], int(parts[1])
+    return label, start_timestamp
+
+def save_arrays(file, arrays, compression=DATA_COMPRESSION):
+    if compression == "none":
+        np.savez(file, **arrays)
+    elif compression == "deflate":
+        np.savez_compressed(file, **arrays)
+    else:
+        # same container as np.savez_compressed, with the fastest deflate level
+        with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            for name, array in arrays.items():
+                with archive.open(name + ".npy", "w", force_zip64=True) as entry:
+                    np.lib.format.write_array(entry, np.asanyarray(array), allow_pickle=False)
+
+def write(path, timestamps, values, encoding=compact.DATA_ENCODING, compression=DATA_COMPRESSION, imu_columns=compact.IMU_COLUMNS):
+    """Write a data file under a temporary name, then rename it once complete"""
+    if encoding == "compact":
+        imu, fsr = compact.encode(values, imu_columns)
+        arrays = {"timestamp_delta": np.diff(timestamps, prepend=0).astype(np.int32), "imu": imu, "fsr": fsr}
+    else:
+        arrays = {"timestamp": timestamps, "values": values, "imu_columns": np.int64(imu_columns)}
+    with open(path + ".part", "wb") as file:
+        save_arrays(file, arrays, compression)
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(path + ".part", path)
+
+def read(path):
+    """Return the Content of a data file, whatever its layout
+    Timestamps are relative to the start timestamp of the file name, in a new array.
+    Values of float32 segments are a memory-mapped view of the file, other
+    layouts (compact, .npz) are decoded or read into a new array.
+    """
+    if path.endswith(".seg"):
+        start_timestamp, records = segment.open_segment(path)
+        imu_columns = segment.read_header(path)[4]
+        if "imu" in records.dtype.names:
+            return Content(records["timestamp"] - start_timestamp, compact.decode(records["imu"], records["fsr"]), imu_columns, "compact")
+        return Content(records["timestamp"] - start_timestamp, records["values"], imu_columns, "float32")
+    with np.load(path) as content:
+        if "data" in content:
+            data = content["data"]
+            return Content(data[:, 0].astype(np.int64), data[:, 1:], None, "legacy")
+        if "timestamp_delta" in content:
+            imu = content["imu"]
+            return Content(np.cumsum(content["timestamp_delta"], dtype=np.int64), compact.decode(imu, content["fsr"]), imu.shape[1], "compact")
+        imu_columns = int(content["imu_columns"]) if "imu_columns" in content else None
+        return Content(content["timestamp"], content["values"], imu_columns, "float32")
+
+def load(path):
+    """Return (timestamps, values) of a data file, see read()"""
+    return read(path)[:2]
+
+def layout(path):
+    """IMU columns stored in a data file, None if unknown"""
+    if path.endswith(".seg"):
+        return segment.read_header(path)[4]
+    with np.load(path) as content:
+        if "imu" in content:
+            return content["imu"].shape[1]
+        if "imu_columns" in content:
+            return int(content["imu_columns"])
+    return None
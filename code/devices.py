@@ -0,0 +1,55 @@
+"""
+Registry of the IMU devices (BLE nodes) of the wheelchair.
+
+BLE_DEVICES lists them as name=MAC pairs, in the order of their columns:
+
+    BLE_DEVICES=left=AA:BB:CC:DD:EE:01,right=AA:BB:CC:DD:EE:02,seat=AA:BB:CC:DD:EE:03
+
+A name without MAC (e.g. "frame=") keeps its columns in the data files,
+filled with zeros. Without BLE_DEVICES, the devices are left and right,
+from BLE_MAC_DEVICE_LEFT and BLE_MAC_DEVICE_RIGHT as before.
+
+Each device has a block of 6 columns (acc x, y, z, gyro x, y, z) in the
+rows of the data files, followed by the FSR columns. On the server, it
+has the properties "Accelerometer <Name>" and "Gyroscope <Name>".
+"""
+
+import os
+from collections import namedtuple
+
+# columns of one IMU sample
+DEVICE_COLUMNS = 6
+
+# name, MAC address (None if not connected) and columns in the data rows
+Device = namedtuple("Device", ["name", "mac", "columns"])
+
+def parse_devices(text):
+    """Return [(name, mac)] from a "name=MAC,name=MAC" list"""
+    devices = []
+    for entry in text.split(","):
+        if entry.strip() == "":
+            continue
+        name, _, mac = entry.partition("=")
+        name = name.strip().lower()
+        # fsr and label are the names of the other streams and properties
+        if name in ("", "fsr", "label") or name in [existing for existing, _ in devices]:
+            raise ValueError(f"Invalid or repeated device name in BLE_DEVICES: {entry}")
+        devices.append((name, mac.strip() or None))
+    return devices
+
+def load_devices(environ=os.environ):
+    """Devices configured in the environment, in column order"""
+    if environ.get("BLE_DEVICES"):
+        entries = parse_devices(environ["BLE_DEVICES"])
+    else:
+        entries = [("left", environ.get("BLE_MAC_DEVICE_LEFT") or None), ("right", environ.get("BLE_MAC_DEVICE_RIGHT") or None)]
+    return make_devices(entries)
+
+def make_devices(entries):
+    """Devices of [(name, mac)], with their block of columns"""
+    return [Device(name, mac, slice(index * DEVICE_COLUMNS, (index + 1) * DEVICE_COLUMNS))
+            for index, (name, mac) in enumerate(entries)]
+
+DEVICES = load_devices()
+# IMU columns of a data row, before the FSR columns
+IMU_COLUMNS = DEVICE_COLUMNS * len(DEVICES)
@@ -0,0 +1,79 @@
+"""
+Features of fixed-length windows of sensor rows, for activity recognition.
+
+Windows are views of the rows (numpy stride tricks), one every step
+rows. For each IMU axis (6 per device): mean, variance, RMS and spectral
+energy (sum of the squared FFT magnitudes without the DC component,
+divided by the window length). For the FSRs: mean total pressure and
+mean centre of pressure (x, y), from the position of each sensor.
+
+Environment variables:
+FSR_POSITIONS   x,y position of each FSR on the seat, e.g. "0,0;1,0;0,1;1,1",
+                by default a grid of 4 sensors per row
+"""
+
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from devices import DEVICES
+
+FSR_POSITIONS = os.getenv("FSR_POSITIONS", "")
+
+# windows computed at once, to bound the memory of the intermediate arrays
+BATCH_WINDOWS = 1024
+AXES = ["acc_x", "acc_y", "acc_z", "gyro_x", "gyro_y", "gyro_z"]
+STATISTICS = ["mean", "var", "rms", "energy"]
+
+def fsr_positions(number_fsr, text=FSR_POSITIONS):
+    """(number_fsr, 2) positions of the FSRs"""
+    if text:
+        positions = np.array([[float(value) for value in position.split(",")] for position in text.split(";")], dtype=np.float32)
+        if positions.shape != (number_fsr, 2):
+            raise ValueError(f"FSR_POSITIONS has {len(positions)} positions for {number_fsr} FSRs")
+        return positions
+    return np.array([(i % 4, i // 4) for i in range(number_fsr)], dtype=np.float32)
+
+def feature_names(number_fsr, devices=DEVICES):
+    names = [f"{statistic}_{axis}_{device.name}" for device in devices for axis in AXES for statistic in STATISTICS]
+    if number_fsr > 0:
+        names += ["fsr_total", "fsr_cop_x", "fsr_cop_y"]
+    return names
+
+def windows(values, size, step):
+    """(count, columns, size) view of the windows of rows, without copy"""
+    if len(values) < size:
+        return np.zeros((0, values.shape[1], size), dtype=values.dtype)
+    return sliding_window_view(values, size, axis=0)[::step]
+
+def window_count(rows, size, step):
+    return 0 if rows < size else (rows - size) // step + 1
+
+def centre_of_pressure(fsr, positions):
+    """Total pressure and centre of pressure (x, y) of rows of FSR values, (rows, 3)"""
+    total = fsr.sum(axis=-1)
+    # no pressure: centre of the seat rather than a division by zero
+    weight = np.divide(fsr, total[..., None], out=np.full(fsr.shape, 1 / fsr.shape[-1], dtype=np.float32), where=total[..., None] > 0)
+    return np.concatenate((total[..., None], weight @ positions), axis=-1)
+
+def window_features(values, size, step, imu_columns, positions):
+    """(windows, features) of rows of values, IMU columns first then FSRs"""
+    count = window_count(len(values), size, step)
+    number_fsr = values.shape[1] - imu_columns
+    features = np.empty((count, imu_columns * len(STATISTICS) + (3 if number_fsr > 0 else 0)), dtype=np.float32)
+    for start in range(0, count, BATCH_WINDOWS):
+        batch = windows(values, size, step)[start:start + BATCH_WINDOWS]
+        imu = batch[:, :imu_columns, :].astype(np.float32)
+        mean = imu.mean(axis=-1)
+        centred = imu - mean[..., None]
+        variance = (centred ** 2).mean(axis=-1)
+        rms = np.sqrt((imu ** 2).mean(axis=-1))
+        spectrum = np.abs(np.fft.rfft(centred, axis=-1)[..., 1:]) ** 2
+        energy = spectrum.sum(axis=-1) / size
+        # mean, var, rms, energy of each axis, in the order of feature_names()
+        features[start:start + len(batch), :imu_columns * len(STATISTICS)] = \
+            np.stack((mean, variance, rms, energy), axis=-1).reshape(len(batch), -1)
+        if number_fsr > 0:
+            fsr = np.swapaxes(batch[:, imu_columns:, :], 1, 2).astype(np.float32)
+            features[start:start + len(batch), -3:] = centre_of_pressure(fsr, positions).mean(axis=1)
+    return features
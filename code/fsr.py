@@ -1,40 +1,206 @@
-import RPi.GPIO as GPIO #GPIO for mux selection
-import Adafruit_ADS1x15 #AD converter
+"""
+Scan the FSRs through a 16-channel analog mux (4 select pins) and an
+ADS1115 AD converter.
+
+Channels are visited in Gray-code order, so that a single select pin
+changes between consecutive channels, and only the pins that change are
+written. Each sample is a single-shot conversion started once the mux is
+switched, so it never mixes two channels. Averaging several conversions
+at a high data rate (FSR_DATA_RATE, up to 860 samples/s) reduces the noise
+for less time than a single conversion at the default 128 samples/s.
+
+GPIO and ADC backends can be given to the constructor, otherwise they
+are taken from backends.py (the hardware, or simulators).
+
+FSRSampler scans in its own thread, at its own rate (FSR_SAMPLING_PERIOD),
+and publishes each complete scan as the latest snapshot. A slow scan
+never delays the IMU path, which reads the snapshot.
+"""
+
+import os, threading, time
+import numpy as np
+
+import backends
+from metrics import counter, histogram
+from ring import SampleRing
+from scheduler import DeadlineScheduler, Histogram
+
+# ADS1115 samples per second: 8, 16, 32, 64, 128, 250, 475 or 860
+FSR_DATA_RATE = int(os.getenv("FSR_DATA_RATE", 860))
+# conversions averaged per channel
+FSR_OVERSAMPLING = int(os.getenv("FSR_OVERSAMPLING", 1))
+# seconds to wait after switching the mux, before converting
+FSR_SETTLE = float(os.getenv("FSR_SETTLE", 0))
+# seconds between two scans of the sampler thread, 0 to scan inline in the aggregator
+FSR_SAMPLING_PERIOD = float(os.getenv("FSR_SAMPLING_PERIOD", 0.02))
+# scans kept at full rate by the sampler, 0 to keep only the latest
+FSR_HISTORY_ROWS = int(os.getenv("FSR_HISTORY_ROWS", 0))
+
+GAIN = 1 #pls check ADS1115
+
+def gray_order(number_fsr):
+    """Channels 0 to number_fsr-1 in an order where one select pin changes from one to the next
+    The Gray code of 16 channels, filtered, would not do with fewer: 4 to 9
+    changes 3 pins. Search the order instead, depth first with the lowest
+    pin first (which gives the Gray code for 16 channels), preferring a cycle
+    so that the next scan also starts one pin away from the last channel.
+    """
+    def search(order, visited, cycle):
+        if len(order) == number_fsr:
+            return not cycle or bin(order[-1] ^ order[0]).count("1") == 1
+        for pin_index in range(4):
+            chanel = order[-1] ^ (1 << pin_index)
+            if chanel < number_fsr and chanel not in visited:
+                order.append(chanel)
+                visited.add(chanel)
+                if search(order, visited, cycle):
+                    return True
+                order.pop()
+                visited.remove(chanel)
+        return False
+
+    for cycle in (True, False):
+        for first in range(number_fsr):
+            order = [first]
+            if search(order, {first}, cycle):
+                return order
+    return list(range(number_fsr))
 
 class FSR():
-    def __init__(self, number_fsr):
+    def __init__(self, number_fsr, gpio=None, adc=None, data_rate=FSR_DATA_RATE, oversampling=FSR_OVERSAMPLING, settle=FSR_SETTLE):
         self.number_fsr = number_fsr
         if number_fsr > 0:
-            # sensor value array
-            self.fsr_values = [0] * number_fsr
+            # sensor values, filled in place by each scan
+            self.fsr_values = np.zeros(number_fsr, dtype=np.float32)
             self.ad_chanel = 0 # ad chanel
             # we connect mux 4 pins to 5,6,14,19, feel free to change
             self.mux_pins = [5,6,14,19]
-            
-            # adc setup
-            self.adc = self.set_up_fsr()
-
-            # array for mux address, 4 pins, 16 channels 
-            self.mux_selection    = [[0,1,0,1,0,1,0,1,0,1,0,1,0,1,0,1]]*4 
-            self.mux_selection[1] =  [0,0,1,1,0,0,1,1,0,0,1,1,0,0,1,1] 
-            self.mux_selection[2] =  [0,0,0,0,1,1,1,1,0,0,0,0,1,1,1,1] 
-            self.mux_selection[3] =  [0,0,0,0,0,0,0,0,1,1,1,1,1,1,1,1] 
-    
+            self.data_rate = data_rate
+            self.settle = settle
+            # conversions per channel, a single value or one per channel
+            if isinstance(oversampling, int):
+                oversampling = [oversampling] * number_fsr
+            self.oversampling = oversampling
+            self.scan_order = gray_order(number_fsr)
+            # current level of each select pin, None until written
+            self.mux_state = [None] * 4
+            self.pin_writes = 0
+            self.scan_time = Histogram() # seconds per scan of all channels
+
+            self.gpio = gpio
+            self.adc = adc
+            self.set_up_fsr()
+
     def set_up_fsr(self):
-        self.adc = Adafruit_ADS1x15.ADS1115() #pls check ADS1115
-        GAIN = 1 #pls check ADS1115
-        self.adc.start_adc(self.ad_chanel, gain=GAIN) #pls check ADS1115
-        GPIO.setmode(GPIO.BCM)  # use BCM layout, check Raspberry Pi
-        GPIO.setwarnings(False) # disable warnings
+        # hardware or simulator, depending on HARDWARE_BACKEND
+        if self.gpio is None:
+            self.gpio = backends.gpio()
+        if self.adc is None:
+            self.adc = backends.adc(self.gpio, self.mux_pins)
+        self.gpio.setmode(self.gpio.BCM)  # use BCM layout, check Raspberry Pi
+        self.gpio.setwarnings(False) # disable warnings
         for each in self.mux_pins:   # all mux pin in output mode
-            GPIO.setup(each, GPIO.OUT)
+            self.gpio.setup(each, self.gpio.OUT)
         return self.adc # return the handle of adc
 
-    def read_fsrs(self):
-        fsr_values = [0]*self.number_fsr # array of fsr values
-        for chanel in range(0,self.number_fsr):  # for each chanel
-            for pin_index in range (0,4): # set the ri9ght selection
-                GPIO.output(self.mux_pins[pin_index], self.mux_selection[pin_index][chanel])
-            #time.sleep(0.001) # for stable input, you can also delete it
-            fsr_values[chanel] = self.adc.get_last_result() # AD converstion 
-        return fsr_values
\ No newline at end of file
+    def select(self, chanel):
+        """Switch the mux to a channel, writing only the select pins that change"""
+        for pin_index in range(0, 4):
+            level = (chanel >> pin_index) & 1
+            if self.mux_state[pin_index] != level:
+                self.gpio.output(self.mux_pins[pin_index], level)
+                self.mux_state[pin_index] = level
+                self.pin_writes += 1
+
+    def read_fsrs(self, out=None):
+        """Scan all channels, return their values
+        Values are written in out if given (e.g. a row of the aggregator block),
+        otherwise in an array reused by every scan.
+        """
+        values = self.fsr_values if out is None else out
+        start = time.monotonic()
+        for chanel in self.scan_order:
+            self.select(chanel)
+            if self.settle > 0:
+                time.sleep(self.settle)
+            count = self.oversampling[chanel]
+            total = 0
+            for i in range(count):
+                # single-shot conversion, waits for 1/data_rate seconds
+                total += self.adc.read_adc(self.ad_chanel, gain=GAIN, data_rate=self.data_rate)
+            values[chanel] = total / count
+        self.scan_time.observe(time.monotonic() - start)
+        return values
+
+    def metrics(self):
+        if self.number_fsr == 0:
+            return []
+        return [
+            histogram("fsr_scan_seconds", "Time to scan all the FSR channels", self.scan_time),
+            counter("fsr_pin_writes_total", "Writes of the mux select pins", self.pin_writes),
+        ]
+
+class FSRSampler(threading.Thread):
+    """ Scan the FSRs at a fixed rate, publishing complete scans as the latest snapshot """
+    def __init__(self, fsr: FSR, period=FSR_SAMPLING_PERIOD, history_rows=FSR_HISTORY_ROWS, policy="skip", queue_rows=0):
+        threading.Thread.__init__(self, name="FSR Sampler", daemon=True)
+        self.fsr = fsr
+        self.scheduler = DeadlineScheduler(period, policy)
+        self.lock = threading.Lock()
+        # double buffer: a scan fills the back buffer, swapped with the front once complete
+        self.front = np.zeros(fsr.number_fsr, dtype=np.float32)
+        self.back = np.zeros(fsr.number_fsr, dtype=np.float32)
+        self.timestamp = 0 # ms, time of the latest complete scan
+        self.scans = 0
+        # ring of the latest scans, at the full rate of the sampler
+        self.history_timestamps = np.zeros(history_rows, dtype=np.int64)
+        self.history_values = np.zeros((history_rows, fsr.number_fsr), dtype=np.float32)
+        # every scan, waiting to be drained by the aggregator (stream fusion)
+        self.ring = SampleRing(queue_rows) if queue_rows > 0 else None
+        self.enabled = True
+
+    def run(self):
+        while self.enabled:
+            self.scheduler.wait()
+            self.fsr.read_fsrs(self.back)
+            timestamp = round(time.time()*1000)
+            if self.ring is not None:
+                self.ring.push((timestamp, self.back.copy()))
+            with self.lock:
+                self.front, self.back = self.back, self.front
+                self.timestamp = timestamp
+                if len(self.history_timestamps) > 0:
+                    index = self.scans % len(self.history_timestamps)
+                    self.history_timestamps[index] = timestamp
+                    self.history_values[index] = self.front
+                self.scans += 1
+
+    def stop(self):
+        self.enabled = False
+
+    def metrics(self):
+        return [
+            histogram("fsr_sampling_lateness_seconds", "Delay of the FSR scans after their deadline", self.scheduler.lateness),
+            counter("fsr_skipped_scans_total", "FSR scans skipped to catch up with the deadlines", self.scheduler.skipped),
+        ]
+
+    def snapshot(self, out):
+        """Copy the latest complete scan into out, return its timestamp (0 before the first scan)"""
+        with self.lock:
+            out[:] = self.front
+            return self.timestamp
+
+    def drain(self):
+        """Scans queued since the last drain, oldest first: (timestamps, values)"""
+        scans = self.ring.drain() if self.ring is not None else []
+        timestamps = np.array([timestamp for timestamp, values in scans], dtype=np.int64)
+        values = np.array([values for timestamp, values in scans], dtype=np.float32).reshape(len(scans), self.fsr.number_fsr)
+        return timestamps, values
+
+    def history(self):
+        """Copies of the scans in the ring, oldest first: (timestamps, values)"""
+        with self.lock:
+            rows = len(self.history_timestamps)
+            count = min(self.scans, rows)
+            order = (np.arange(self.scans - count, self.scans) % rows) if rows > 0 else []
+            return self.history_timestamps[order], self.history_values[order]
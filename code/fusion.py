@@ -0,0 +1,122 @@
+"""
+Align independently timestamped streams (left IMU, right IMU, FSR scans)
+on a uniform time grid.
+
+Samples are added in blocks as they are drained from the devices. Grid
+points are emitted once all the samples around them have arrived, i.e.
+up to a watermark some delay behind the current time. Each stream is
+resampled on the grid, either by linear interpolation between the
+samples around each grid point, or by taking the nearest sample. A
+stream without a sample within the tolerance of a grid point leaves
+zeros in its columns (skipped on upload, as a disconnected device).
+
+The grid starts at the earliest sample of any stream added before the
+first grid points are emitted, whichever stream it comes from. After
+that, samples older than the emitted grid points can only serve the
+next grid points within the tolerance; the others are dropped.
+
+Environment variables:
+FUSION_PERIOD      grid period in ms, 0 to write samples as received (default)
+FUSION_TOLERANCE   maximum distance in ms between a grid point and a sample used for it
+FUSION_METHOD      "linear" or "nearest"
+FUSION_DELAY       ms to wait for late samples before emitting a grid point
+"""
+
+import os
+import numpy as np
+
+FUSION_PERIOD = int(os.getenv("FUSION_PERIOD", 0))
+FUSION_TOLERANCE = int(os.getenv("FUSION_TOLERANCE", 50))
+FUSION_METHOD = os.getenv("FUSION_METHOD", "linear")
+FUSION_DELAY = int(os.getenv("FUSION_DELAY", 100))
+
+def resample(timestamps, values, grid, out, tolerance, method="linear"):
+    """Write the values of a sorted stream at the grid timestamps into out"""
+    if len(timestamps) == 0 or len(grid) == 0:
+        return
+    # samples just before and just after each grid point
+    after = np.searchsorted(timestamps, grid)
+    before = np.clip(after - 1, 0, len(timestamps) - 1)
+    after = np.clip(after, 0, len(timestamps) - 1)
+    to_before = np.abs(grid - timestamps[before])
+    to_after = np.abs(timestamps[after] - grid)
+    nearest = np.where(to_before <= to_after, before, after)
+    valid = np.minimum(to_before, to_after) <= tolerance
+    out[valid] = values[nearest[valid]]
+    if method == "linear":
+        # interpolate where the grid point lies between two samples, both within the tolerance
+        span = (timestamps[after] - timestamps[before]).astype(np.float64)
+        between = (span > 0) & (to_before <= tolerance) & (to_after <= tolerance)
+        weight = ((grid[between] - timestamps[before[between]]) / span[between])[:, None]
+        out[between] = (1 - weight) * values[before[between]] + weight * values[after[between]]
+
+class StreamFusion:
+    """ Resample blocks of timestamped samples of several streams onto one grid
+    streams is a list of (name, columns), in the order of the output columns.
+    """
+    def __init__(self, streams, period=FUSION_PERIOD, tolerance=FUSION_TOLERANCE, method=FUSION_METHOD):
+        if method not in ("linear", "nearest"):
+            raise ValueError(f"Unknown fusion method {method}")
+        self.period = period
+        self.tolerance = tolerance
+        self.method = method
+        self.columns = {}
+        self.timestamps = {}
+        self.values = {}
+        offset = 0
+        for name, columns in streams:
+            self.columns[name] = slice(offset, offset + columns)
+            offset += columns
+        self.width = offset
+        self.reset()
+
+    def reset(self):
+        """Forget all samples, the grid starts again with the next ones"""
+        for name, columns in self.columns.items():
+            self.timestamps[name] = np.zeros(0, dtype=np.int64)
+            self.values[name] = np.zeros((0, columns.stop - columns.start), dtype=np.float32)
+        self.next_time = None # next grid timestamp to emit (ms)
+
+    def add(self, name, timestamps, values):
+        """Add a block of samples of one stream (timestamps in ms)"""
+        if len(timestamps) == 0:
+            return
+        timestamps = np.concatenate((self.timestamps[name], timestamps))
+        values = np.concatenate((self.values[name], values))
+        if np.any(np.diff(timestamps) < 0):
+            order = np.argsort(timestamps, kind="stable")
+            timestamps, values = timestamps[order], values[order]
+        self.timestamps[name] = timestamps
+        self.values[name] = values
+
+    def emit(self, until):
+        """Return (timestamps, values) of the grid points before until (ms)"""
+        if self.next_time is None:
+            firsts = [int(timestamps[0]) for timestamps in self.timestamps.values() if len(timestamps) > 0]
+            if len(firsts) > 0:
+                # first grid point: the first multiple of the period after the earliest sample
+                self.next_time = -(-min(firsts) // self.period) * self.period
+        if self.next_time is None or until <= self.next_time:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, self.width), dtype=np.float32)
+        grid = np.arange(self.next_time, until, self.period, dtype=np.int64)
+        values = np.zeros((len(grid), self.width), dtype=np.float32)
+        for name, columns in self.columns.items():
+            resample(self.timestamps[name], self.values[name], grid, values[:, columns], self.tolerance, self.method)
+        self.next_time = int(grid[-1]) + self.period
+        self.trim()
+        return grid, values
+
+    def flush(self):
+        """Emit the grid points up to the last sample of any stream"""
+        ends = [timestamps[-1] for timestamps in self.timestamps.values() if len(timestamps) > 0]
+        if len(ends) == 0:
+            return self.emit(0)
+        return self.emit(int(max(ends)) + 1)
+
+    def trim(self):
+        """Drop the samples no longer needed for the next grid points"""
+        for name, timestamps in self.timestamps.items():
+            # keep the last sample before the tolerance window, for interpolation
+            start = max(np.searchsorted(timestamps, self.next_time - self.tolerance) - 1, 0)
+            self.timestamps[name] = timestamps[start:]
+            self.values[name] = self.values[name][start:]
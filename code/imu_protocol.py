@@ -0,0 +1,194 @@
+"""
+Frame protocol between the IMU firmware (ble_imu.py) and the host (bluetooth.py).
+
+A binary frame carries one complete IMU sample:
+
+    magic    uint8   0xA5, never a valid first byte of the legacy text format
+    version  uint8   high nibble: protocol version, low nibble: encoding
+    seq      uint16  sample sequence number, wraps around
+    time     uint32  device time in milliseconds, wraps around
+    values   6 x float32 (ENCODING_FLOAT32) or 6 x int16 (ENCODING_INT16)
+             acc x, acc y, acc z (m/s^2), gyro x, gyro y, gyro z (rad/s)
+
+The int16 encoding scales accelerations by ACC_SCALE and angular rates by
+GYRO_SCALE. Its 20-byte frame fits the default BLE payload (MTU 23).
+
+The legacy text format sends one "index#value" notification per axis.
+It is still decoded for devices running older firmware.
+
+In buffered mode, the firmware packs several consecutive frames into one
+notification, up to the negotiated MTU.
+"""
+
+import struct, time
+from collections import namedtuple
+import numpy as np
+
+FRAME_MAGIC = 0xA5
+PROTOCOL_VERSION = 1
+
+ENCODING_FLOAT32 = 0x01
+ENCODING_INT16 = 0x02
+
+# int16 scaling: 0.01 m/s^2 and 0.001 rad/s per unit
+ACC_SCALE = 100.0
+GYRO_SCALE = 1000.0
+
+HEADER = struct.Struct("<BBHI")
+FLOAT32_FRAME = struct.Struct("<BBHI6f")
+INT16_FRAME = struct.Struct("<BBHI6h")
+
+FLOAT32_DTYPE = np.dtype([("magic", "u1"), ("version", "u1"), ("seq", "<u2"), ("time", "<u4"), ("values", "<f4", (6,))])
+INT16_DTYPE = np.dtype([("magic", "u1"), ("version", "u1"), ("seq", "<u2"), ("time", "<u4"), ("values", "<i2", (6,))])
+
+SCALES = np.array([ACC_SCALE] * 3 + [GYRO_SCALE] * 3, dtype=np.float32)
+
+# One decoded sample. Times in milliseconds, host time is the reception time.
+IMUSample = namedtuple("IMUSample", ["seq", "device_time", "host_time", "values"])
+
+
+def version_byte(encoding):
+    return (PROTOCOL_VERSION << 4) | encoding
+
+
+def frame_size(encoding):
+    if encoding == ENCODING_INT16:
+        return INT16_FRAME.size
+    return FLOAT32_FRAME.size
+
+
+def pack_frame(seq, time_ms, values, encoding=ENCODING_INT16):
+    """Pack one sample into a binary frame (host-side counterpart of ble_imu.py)"""
+    seq &= 0xFFFF
+    time_ms &= 0xFFFFFFFF
+    if encoding == ENCODING_INT16:
+        scaled = [max(-32768, min(32767, round(v * s))) for v, s in zip(values, SCALES)]
+        return INT16_FRAME.pack(FRAME_MAGIC, version_byte(encoding), seq, time_ms, *scaled)
+    return FLOAT32_FRAME.pack(FRAME_MAGIC, version_byte(encoding), seq, time_ms, *values)
+
+
+def unpack_frame(frame):
+    """Decode one binary frame with struct
+    Return (seq, device time, list of 6 values)
+    """
+    magic, version, seq, time_ms = HEADER.unpack_from(frame)
+    if magic != FRAME_MAGIC or version >> 4 != PROTOCOL_VERSION:
+        raise ValueError(f"Unknown IMU frame header {magic:#x}/{version:#x}")
+    if version & 0x0F == ENCODING_INT16:
+        fields = INT16_FRAME.unpack(frame)
+        values = [v / s for v, s in zip(fields[4:], (ACC_SCALE,) * 3 + (GYRO_SCALE,) * 3)]
+    else:
+        values = list(FLOAT32_FRAME.unpack(frame)[4:])
+    return seq, time_ms, values
+
+
+def unpack_frames(buffer, encoding):
+    """Decode consecutive frames of the same encoding with NumPy, without copy
+    Return (seq array, device time array, values array of shape (n, 6))
+    """
+    if encoding == ENCODING_INT16:
+        frames = np.frombuffer(buffer, dtype=INT16_DTYPE)
+        values = frames["values"] / SCALES
+    else:
+        frames = np.frombuffer(buffer, dtype=FLOAT32_DTYPE)
+        values = frames["values"]
+    if np.any(frames["magic"] != FRAME_MAGIC) or np.any(frames["version"] != version_byte(encoding)):
+        raise ValueError("Mixed or invalid IMU frames in block")
+    return frames["seq"], frames["time"], values
+
+
+def decode_text(value, imu_data):
+    """Decode one legacy "index#value" notification into imu_data"""
+    res = value.split(b"#")# split input
+    if len(res) == 2: #if there are two parts
+        index_string = res[0].decode("utf-8");index = int(index_string)  # first is index and value
+        value_string = res[1].decode("utf-8");value = float(value_string)# second is value
+        imu_data[index] = value
+    return imu_data
+
+
+class FrameParser:
+    """ Reassemble binary frames split or merged by the BLE link """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0 # decoded frames
+        self.errors = 0 # discarded bytes or invalid frames
+
+    def is_binary(self, value: bytes):
+        return len(self.buffer) > 0 or (len(value) > 0 and value[0] == FRAME_MAGIC)
+
+    def feed(self, value: bytes, host_time=None):
+        """Add received bytes, return the list of complete samples (IMUSample)"""
+        if host_time is None:
+            host_time = round(time.time()*1000)
+        self.buffer += value
+        samples = self.feed_block(host_time)
+        if samples is not None:
+            return samples
+        samples = []
+        while len(self.buffer) >= HEADER.size:
+            if self.buffer[0] != FRAME_MAGIC:
+                # Out of sync, drop bytes up to the next magic
+                start = self.buffer.find(FRAME_MAGIC)
+                self.errors += 1
+                if start < 0:
+                    self.buffer.clear()
+                    break
+                del self.buffer[:start]
+                continue
+            size = frame_size(self.buffer[1] & 0x0F)
+            if len(self.buffer) < size:
+                break
+            try:
+                seq, device_time, values = unpack_frame(bytes(self.buffer[:size]))
+                samples.append(IMUSample(seq, device_time, host_time, tuple(values)))
+                self.frames += 1
+            except ValueError:
+                self.errors += 1
+            del self.buffer[:size]
+        return samples
+
+    def feed_block(self, host_time):
+        """Fast path for notifications made of whole frames of one encoding (buffered mode)
+        Return None when the buffer needs the frame-by-frame path.
+        """
+        if len(self.buffer) < HEADER.size or self.buffer[0] != FRAME_MAGIC:
+            return None
+        encoding = self.buffer[1] & 0x0F
+        size = frame_size(encoding)
+        # a single frame is faster to decode with struct
+        if len(self.buffer) == size or len(self.buffer) % size != 0:
+            return None
+        try:
+            seqs, device_times, values = unpack_frames(bytes(self.buffer), encoding)
+        except ValueError:
+            return None
+        self.buffer.clear()
+        self.frames += len(seqs)
+        return [IMUSample(seq, device_time, host_time, tuple(v))
+                for seq, device_time, v in zip(seqs.tolist(), device_times.tolist(), values.tolist())]
+
+
+class SequenceTracker:
+    """ Count samples lost or repeated on the link, from their uint16 sequence numbers """
+    def __init__(self):
+        self.last = None
+        self.received = 0
+        self.dropped = 0    # sequence numbers skipped
+        self.duplicated = 0 # sequence numbers seen again, or older than the last one
+
+    def check(self, seq):
+        """Return True for a new sample, False for a duplicate to discard"""
+        if self.last is not None:
+            gap = (seq - self.last) & 0xFFFF
+            if gap == 0 or gap >= 0x8000:
+                self.duplicated += 1
+                return False
+            self.dropped += gap - 1
+        self.last = seq
+        self.received += 1
+        return True
+
+    def restart(self):
+        """Forget the last sequence number, e.g. when the device reconnects and counts from 0"""
+        self.last = None
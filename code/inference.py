@@ -0,0 +1,258 @@
+"""
+Sliding-window features and activity inference on the collected rows,
+in real time on the Raspberry Pi.
+
+The stage is fed every row of DataAggregator. Window statistics are
+updated in O(1) per row: running sums of the values and their squares
+give the mean, variance and RMS of each IMU axis, pushes are counted as
+they are detected and leave the count when they leave the window.
+Every INFERENCE_STEP rows, the features of the last INFERENCE_WINDOW rows
+are classified and the summary of the window (features and activity)
+is written to INFERENCE_SUMMARY_PATH, a few hundred bytes per window
+instead of every row. bucket_thing.py uploads them to the "Activity
+Summary" property when UPLOAD_SUMMARY_PATH is this folder.
+
+Feature names follow features.py, so that a classifier can be trained
+offline on the datasets of build_dataset.py (same window):
+
+    python inference.py dataset/ centroids.npz
+
+Environment variables:
+INFERENCE_WINDOW         rows per window, 0 to disable the stage (default)
+INFERENCE_STEP           rows between two windows
+INFERENCE_CLASSIFIER     "threshold" (still, moving, pushing), a model .npz saved by
+                         this script, or "module:factory" returning an object with
+                         labels and predict(features)
+INFERENCE_SUMMARY_PATH   folder of the summary segments, none by default
+PUSH_AXIS                gyroscope axis of the wheel rotation (0, 1 or 2 for x, y, z)
+PUSH_THRESHOLD           angular acceleration of a push, rad/s^2
+STILL_VARIANCE           accelerometer variance below which the wheelchair is still, (m/s^2)^2
+"""
+
+import importlib, json, logging, os, sys
+import numpy as np
+
+from devices import DEVICE_COLUMNS, DEVICES
+from features import AXES, centre_of_pressure, fsr_positions
+from metrics import counter
+
+INFERENCE_WINDOW = int(os.getenv("INFERENCE_WINDOW", 0))
+INFERENCE_STEP = int(os.getenv("INFERENCE_STEP", 100))
+INFERENCE_CLASSIFIER = os.getenv("INFERENCE_CLASSIFIER", "threshold")
+INFERENCE_SUMMARY_PATH = os.getenv("INFERENCE_SUMMARY_PATH", None)
+PUSH_AXIS = int(os.getenv("PUSH_AXIS", 2))
+PUSH_THRESHOLD = float(os.getenv("PUSH_THRESHOLD", 5))
+STILL_VARIANCE = float(os.getenv("STILL_VARIANCE", 0.05))
+
+# statistics of each IMU axis computed incrementally, a subset of features.STATISTICS
+STATISTICS = ["mean", "var", "rms"]
+# windows between two exact sums of the rows, to cancel the rounding errors of the updates
+RESYNC_WINDOWS = 64
+# summaries per chunk handed to the writer
+SUMMARY_ROWS = 60
+# label of the summary segments
+SUMMARY_LABEL = "summary"
+
+def summary_names(number_fsr, devices=DEVICES):
+    """Features of a window, in the order of the summary columns (the activity is the last one)"""
+    names = [f"{statistic}_{axis}_{device.name}" for device in devices for axis in AXES for statistic in STATISTICS]
+    names += [f"pushes_{device.name}" for device in devices]
+    if number_fsr > 0:
+        names += ["fsr_total", "fsr_cop_x", "fsr_cop_y"]
+    return names
+
+class RollingStats:
+    """ Mean, variance and RMS of the last size rows of some columns, updated in O(1) per row """
+    def __init__(self, size, columns):
+        self.size = size
+        self.rows = np.zeros((size, columns))
+        self.sum = np.zeros(columns)
+        self.squares = np.zeros(columns)
+        self.count = 0 # rows added
+
+    def add(self, row):
+        index = self.count % self.size
+        old = self.rows[index]
+        # the oldest row leaves the window (zeros until it is full)
+        self.sum += row - old
+        self.squares += row * row - old * old
+        self.rows[index] = row
+        self.count += 1
+        if self.count % (self.size * RESYNC_WINDOWS) == 0:
+            self.sum = self.rows.sum(axis=0)
+            self.squares = (self.rows ** 2).sum(axis=0)
+
+    def length(self):
+        return min(self.count, self.size)
+
+    def mean(self):
+        return self.sum / max(self.length(), 1)
+
+    def variance(self):
+        return np.maximum(self.squares / max(self.length(), 1) - self.mean() ** 2, 0)
+
+    def rms(self):
+        return np.sqrt(self.squares / max(self.length(), 1))
+
+class PushCounter:
+    """ Pushes on a wheel in the last size rows
+    A push starts when the angular acceleration of the wheel goes above the
+    threshold, the next one once it went back below half of it.
+    """
+    def __init__(self, size, threshold=PUSH_THRESHOLD):
+        self.events = np.zeros(size, dtype=bool)
+        self.threshold = threshold
+        self.count = 0 # rows added
+        self.pushes = 0 # in the window
+        self.previous = None # (timestamp, speed)
+        self.armed = True
+
+    def add(self, timestamp, speed):
+        push = False
+        if self.previous is not None and timestamp > self.previous[0]:
+            acceleration = (speed - self.previous[1]) * 1000 / (timestamp - self.previous[0])
+            if self.armed and acceleration > self.threshold:
+                push = True
+                self.armed = False
+            elif acceleration < self.threshold / 2:
+                self.armed = True
+        self.previous = (timestamp, speed)
+        index = self.count % len(self.events)
+        self.pushes += int(push) - int(self.events[index])
+        self.events[index] = push
+        self.count += 1
+
+class ThresholdClassifier:
+    """ Still, moving or pushing, from the variance of the accelerometers and the pushes """
+    labels = ["still", "moving", "pushing"]
+
+    def __init__(self, still_variance=STILL_VARIANCE):
+        self.still_variance = still_variance
+
+    def predict(self, features):
+        if sum(value for name, value in features.items() if name.startswith("pushes_")) > 0:
+            return "pushing"
+        variances = [value for name, value in features.items() if name.startswith("var_acc_")]
+        if len(variances) == 0 or max(variances) < self.still_variance:
+            return "still"
+        return "moving"
+
+class CentroidClassifier:
+    """ Nearest centroid of the standardised features of each activity, trained on a dataset of build_dataset.py """
+    def __init__(self, labels, names, centroids, offset, scale):
+        self.labels = list(labels)
+        self.names = list(names)
+        self.centroids = centroids
+        self.offset = offset
+        self.scale = scale
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as model:
+            return cls(model["labels"].tolist(), model["names"].tolist(), model["centroids"], model["offset"], model["scale"])
+
+    def save(self, path):
+        np.savez(path, labels=np.array(self.labels), names=np.array(self.names), centroids=self.centroids, offset=self.offset, scale=self.scale)
+
+    @classmethod
+    def fit(cls, folder, names):
+        """Train on the dataset in folder, with the features of names it contains"""
+        with open(os.path.join(folder, "dataset.json")) as file:
+            dataset = json.load(file)
+        columns = [dataset["features"].index(name) for name in names if name in dataset["features"]]
+        features = np.load(os.path.join(folder, "features.npy"), mmap_mode="r")[:dataset["windows"], columns]
+        labels = np.load(os.path.join(folder, "labels.npy"))[:dataset["windows"]]
+        offset = features.mean(axis=0)
+        scale = features.std(axis=0) + 1e-9
+        centroids = np.array([((features[labels == code] - offset) / scale).mean(axis=0) for code in range(len(dataset["labels"]))])
+        return cls(dataset["labels"], [dataset["features"][column] for column in columns], centroids, offset, scale)
+
+    def predict(self, features):
+        vector = (np.array([features[name] for name in self.names]) - self.offset) / self.scale
+        return self.labels[int(np.argmin(((self.centroids - vector) ** 2).sum(axis=1)))]
+
+def load_classifier(name=INFERENCE_CLASSIFIER):
+    if name == "threshold":
+        return ThresholdClassifier()
+    if name.endswith(".npz"):
+        return CentroidClassifier.load(name)
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+class InferenceStage:
+    """ Window features and activity of the rows of DataAggregator
+    Blocks of summaries are handed to output(timestamps, values), if given.
+    """
+    def __init__(self, devices, number_fsr, window=INFERENCE_WINDOW, step=INFERENCE_STEP, classifier=None, output=None):
+        self.devices = devices
+        self.imu_columns = DEVICE_COLUMNS * len(devices)
+        self.window = window
+        self.step = step
+        self.imu = RollingStats(window, self.imu_columns)
+        self.pushes = [PushCounter(window) for device in devices]
+        self.fsr = RollingStats(window, 3) if number_fsr > 0 else None
+        self.positions = fsr_positions(number_fsr) if number_fsr > 0 else None
+        self.names = summary_names(number_fsr, devices)
+        self.classifier = classifier if classifier is not None else load_classifier()
+        self.output = output
+        self.activity = None
+        self.windows = {label: 0 for label in self.classifier.labels}
+        self.summary_timestamps = []
+        self.summary_values = []
+
+    def add(self, timestamps, values):
+        """Add a block of rows"""
+        for timestamp, row in zip(timestamps.tolist(), values):
+            self.add_row(timestamp, row)
+
+    def add_row(self, timestamp, row):
+        row = row.astype(np.float64)
+        self.imu.add(row[:self.imu_columns])
+        for device, pushes in zip(self.devices, self.pushes):
+            pushes.add(timestamp, abs(row[device.columns][3 + PUSH_AXIS]))
+        if self.fsr is not None:
+            self.fsr.add(centre_of_pressure(row[self.imu_columns:], self.positions))
+        if self.imu.count >= self.window and (self.imu.count - self.window) % self.step == 0:
+            self.emit(timestamp)
+
+    def features(self):
+        """Features of the current window, by name"""
+        values = np.stack((self.imu.mean(), self.imu.variance(), self.imu.rms()), axis=-1).reshape(-1).tolist()
+        values += [pushes.pushes for pushes in self.pushes]
+        if self.fsr is not None:
+            values += self.fsr.mean().tolist()
+        return dict(zip(self.names, values))
+
+    def emit(self, timestamp):
+        features = self.features()
+        activity = self.classifier.predict(features)
+        if activity != self.activity:
+            logging.info(f"Activity: {activity}")
+        self.activity = activity
+        self.windows[activity] = self.windows.get(activity, 0) + 1
+        if self.output is not None:
+            # the activity is stored as its index in the labels of the classifier
+            self.summary_timestamps.append(timestamp)
+            self.summary_values.append(list(features.values()) + [self.classifier.labels.index(activity)])
+            if len(self.summary_timestamps) >= SUMMARY_ROWS:
+                self.flush()
+
+    def flush(self):
+        """Hand the pending summaries over to the output"""
+        if self.output is None or len(self.summary_timestamps) == 0:
+            return
+        self.output(np.array(self.summary_timestamps, dtype=np.int64), np.array(self.summary_values, dtype=np.float32))
+        self.summary_timestamps = []
+        self.summary_values = []
+
+    def metrics(self):
+        return [counter("inference_windows_total", "Windows classified, per activity",
+                        [({"activity": label}, count) for label, count in self.windows.items()])]
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        raise SystemExit("Usage: python inference.py dataset_folder model.npz")
+    # the features of the dataset also computed on the Raspberry Pi
+    model = CentroidClassifier.fit(sys.argv[1], summary_names(1))
+    model.save(sys.argv[2])
+    print(f"Centroids of {', '.join(model.labels)} on {len(model.names)} features saved to {sys.argv[2]}")
@@ -0,0 +1,48 @@
+"""
+Local journal of upload progress, so that an interrupted upload resumes
+from the last acknowledged row instead of row 0.
+
+For each data file and property, the journal records how many rows the
+server has acknowledged. It is a small SQLite database, updated after
+each acknowledged chunk and cleaned up when the file is archived.
+"""
+
+import sqlite3, threading
+
+class UploadJournal:
+    """ Acknowledged rows per file and per property """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # shared by the upload threads, access is serialised by the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS progress (
+                            file TEXT NOT NULL,
+                            property TEXT NOT NULL,
+                            rows INTEGER NOT NULL,
+                            PRIMARY KEY (file, property))""")
+        self.db.commit()
+
+    def acked(self, file_name, property_name):
+        """Number of rows of this file already acknowledged for this property"""
+        with self.lock:
+            row = self.db.execute("SELECT rows FROM progress WHERE file = ? AND property = ?",
+                                  (file_name, property_name)).fetchone()
+        return 0 if row is None else row[0]
+
+    def ack(self, file_name, property_name, rows):
+        """Record that the first rows of this file are on the server for this property"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO progress (file, property, rows) VALUES (?, ?, ?)",
+                            (file_name, property_name, rows))
+            self.db.commit()
+
+    def forget(self, file_name):
+        """The file is fully uploaded and archived"""
+        with self.lock:
+            self.db.execute("DELETE FROM progress WHERE file = ?", (file_name,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
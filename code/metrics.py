@@ -0,0 +1,175 @@
+"""
+Metrics of the collection and upload pipelines, in the Prometheus text format.
+
+Components keep their own counters and histograms, as for their stats().
+Their metrics() method turns them into metrics only when scraped, so the
+sampling path does no extra work. Each service registers the metrics()
+of its components under a name, a new component (e.g. an aggregator
+restarted after an error) replacing the previous one.
+
+The metrics are exposed on http://<raspberry pi>:<port>/metrics and/or
+written every METRICS_PERIOD seconds to <METRICS_TEXTFILE_DIR>/<service>.prom,
+for the textfile collector of the Prometheus node exporter.
+
+Environment variables:
+METRICS_TEXTFILE_DIR   folder of the .prom files, none by default
+METRICS_PERIOD         seconds between two writes of the .prom files
+The port of each service is set in its script (COLLECTION_METRICS_PORT, UPLOAD_METRICS_PORT).
+"""
+
+import http.server, logging, math, os, threading
+from collections import namedtuple
+
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR", None)
+METRICS_PERIOD = float(os.getenv("METRICS_PERIOD", 15))
+
+PREFIX = "wheelchair_"
+
+# samples is a list of (name suffix, labels, value)
+Metric = namedtuple("Metric", ["name", "kind", "help", "samples"])
+
+def counter(name, help, samples):
+    """A counter, samples is a number or a list of (labels, value)"""
+    return Metric(name, "counter", help, labelled(samples))
+
+def gauge(name, help, samples):
+    """A gauge, samples is a number or a list of (labels, value)"""
+    return Metric(name, "gauge", help, labelled(samples))
+
+def histogram(name, help, histograms):
+    """A histogram, from scheduler.Histogram or a list of (labels, Histogram)"""
+    if not isinstance(histograms, list):
+        histograms = [({}, histograms)]
+    samples = []
+    for labels, observed in histograms:
+        # Prometheus buckets are cumulative
+        total = 0
+        for bound, count in zip(observed.buckets, observed.counts):
+            total += count
+            samples.append(("_bucket", dict(labels, le=format_value(bound)), total))
+        samples.append(("_sum", labels, observed.sum))
+        samples.append(("_count", labels, observed.count))
+    return Metric(name, "histogram", help, samples)
+
+def labelled(samples):
+    if not isinstance(samples, list):
+        samples = [({}, samples)]
+    return [("", labels, value) for labels, value in samples]
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+def render(metrics):
+    """Text exposition format of a list of Metric"""
+    lines = []
+    for metric in metrics:
+        name = PREFIX + metric.name
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for suffix, labels, value in metric.samples:
+            lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+class Registry:
+    """ Collectors by name: functions returning a list of Metric """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = {}
+
+    def register(self, name, collector):
+        """Add a collector, replacing the one registered under the same name"""
+        with self.lock:
+            self.collectors[name] = collector
+
+    def unregister(self, name):
+        with self.lock:
+            self.collectors.pop(name, None)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors.items())
+        metrics = []
+        for name, collector in collectors:
+            try:
+                metrics.extend(collector())
+            except Exception as error:
+                # a failing component does not hide the others
+                logging.error(f"Metrics of {name}: {error}")
+        return metrics
+
+    def render(self):
+        return render(self.collect())
+
+REGISTRY = Registry()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve the metrics of the registry of the server on GET /metrics """
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no log line per scrape
+        pass
+
+def serve(port, registry=REGISTRY, host=""):
+    """Serve the metrics from a daemon thread, return the server"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    return server
+
+class TextfileExporter(threading.Thread):
+    """ Rewrite a .prom file every period, replaced atomically so it is never read half written """
+    def __init__(self, path, registry=REGISTRY, period=METRICS_PERIOD):
+        threading.Thread.__init__(self, name="Metrics textfile", daemon=True)
+        self.path = path
+        self.registry = registry
+        self.period = period
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self.write()
+
+    def write(self):
+        try:
+            with open(self.path + ".tmp", "w") as file:
+                file.write(self.registry.render())
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as error:
+            logging.error(f"Metrics textfile {self.path}: {error}")
+
+    def stop(self):
+        """Stop and write the last values"""
+        self.stopped.set()
+        self.write()
+
+def start(service, port=0, registry=REGISTRY, folder=METRICS_TEXTFILE_DIR):
+    """Start the exporters configured for a service: endpoint on port (if not 0) and textfile (if folder)"""
+    if port > 0:
+        serve(port, registry)
+        logging.info(f"Metrics served on port {port}")
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        exporter = TextfileExporter(os.path.join(folder, service + ".prom"), registry)
+        exporter.start()
+        logging.info(f"Metrics written to {exporter.path}")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+This script is a local stand-in for the Bucket HTTP API.
+It lets you run bucket_thing.py without a server or network connection,
+e.g. to check the uploader on a flaky link or to count requests.
+
+Usage:
+python mock_bucket.py [port]
+
+then run the uploader against it (any RSA private key will do):
+HTTP_API_URI=http://localhost:8000 THING_ID=dcd:things:mock python bucket_thing.py
+
+Environment variables:
+MOCK_LATENCY=0.05      seconds added to each property update
+MOCK_FAILURE_RATE=0.1  share of property updates answered with an error
+
+GET /stats returns the number of requests and values received per property.
+"""
+
+import json, os, random, sys, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0"))
+MOCK_FAILURE_RATE = float(os.getenv("MOCK_FAILURE_RATE", "0"))
+
+class MockBucket:
+    """ In-memory Things, properties and received values """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.properties = {} # per thing id, list of property json
+        self.requests = 0    # property updates received
+        self.failures = 0    # property updates answered with an error
+        self.values = {}     # values received per property name
+
+    def thing(self, thing_id):
+        with self.lock:
+            return {
+                "id": thing_id, "name": "Mock Thing", "description": "", "type": "GENERIC",
+                "createdAt": 0, "updatedAt": 0,
+                "properties": list(self.properties.get(thing_id, []))
+            }
+
+    def create_property(self, thing_id, body):
+        prop = {
+            "id": "dcd:properties:" + str(uuid.uuid4()), "name": body.get("name"), "description": "",
+            "typeId": body.get("typeId"), "type": {"id": body.get("typeId"), "dimensions": []}
+        }
+        with self.lock:
+            self.properties.setdefault(thing_id, []).append(prop)
+        return prop
+
+    def update_property(self, thing_id, property_id, body):
+        with self.lock:
+            self.requests += 1
+            if random.random() < MOCK_FAILURE_RATE:
+                self.failures += 1
+                return False
+            name = next((p["name"] for p in self.properties.get(thing_id, []) if p["id"] == property_id), property_id)
+            self.values[name] = self.values.get(name, 0) + len(body.get("values", []))
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "failures": self.failures, "values": dict(self.values)}
+
+bucket = MockBucket()
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def path_parts(self):
+        return [part for part in self.path.split("?")[0].split("/") if part != ""]
+
+    def do_GET(self):
+        parts = self.path_parts()
+        if parts == ["stats"]:
+            self.reply(200, bucket.stats())
+        elif len(parts) == 2 and parts[0] == "things":
+            self.reply(200, bucket.thing(parts[1]))
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def do_POST(self):
+        parts = self.path_parts()
+        if len(parts) == 3 and parts[0] == "things" and parts[2] == "properties":
+            self.reply(201, bucket.create_property(parts[1], self.read_body()))
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def do_PUT(self):
+        parts = self.path_parts()
+        if len(parts) == 4 and parts[0] == "things" and parts[2] == "properties":
+            body = self.read_body()
+            time.sleep(MOCK_LATENCY)
+            if bucket.update_property(parts[1], parts[3], body):
+                self.reply(200, {})
+            else:
+                self.reply(503, {"message": "Mock failure"})
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port=8000):
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    print(f"Mock Bucket API on http://localhost:{port}")
+    server.serve_forever()
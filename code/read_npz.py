@@ -1,18 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Inspect and query the data files, through the index of archive.py.
+The index is updated (new and changed files only) before each command.
+
+Usage:
+python read_npz.py                          labels, with their number of files, rows and time span
+python read_npz.py files [label] [--since T] [--until T]
+python read_npz.py rows label [--since T] [--until T] [--output rows.npz]
+python read_npz.py show file                all the rows of one file
+
+T is a timestamp in ms or an ISO date (e.g. 2021-03-01 or 2021-03-01T14:30).
+
+Authors: Wolf Song, Jacky Bourgeois
+License: MIT
+
+Environment variables (.env file):
+COMPLETE_DATA_PATH=/home/pi/wheelchair/data/
+ARCHIVE_PATH=/home/pi/wheelchair/archive/
+ARCHIVE_INDEX_PATH=/home/pi/wheelchair/archive-index.sqlite
+"""
+
+import argparse, time
+from datetime import datetime
 import numpy as np
-import os, glob
 
-path = os.path.abspath(os.getcwd())+'/data/' + '*.npz'
+# before the modules reading their settings from the environment
+from dotenv import load_dotenv
+load_dotenv()
+
+import datafile
+from archive import ArchiveIndex
+
+def parse_time(text):
+    """Timestamp in ms from a number of ms or an ISO date (local time)"""
+    if text.isdigit():
+        return int(text)
+    return round(datetime.fromisoformat(text).timestamp() * 1000)
 
-file_list = glob.glob(path)
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000).isoformat(sep=" ", timespec="seconds")
 
-print (file_list,path)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and query the data files")
+    commands = parser.add_subparsers(dest="command")
+    files = commands.add_parser("files", help="list the files of a label and time range")
+    files.add_argument("label", nargs="?")
+    rows = commands.add_parser("rows", help="rows of a label and time range")
+    rows.add_argument("label")
+    rows.add_argument("--output", help=".npz file to save the rows (timestamp, values)")
+    for command in (files, rows):
+        command.add_argument("--since", type=parse_time)
+        command.add_argument("--until", type=parse_time)
+    show = commands.add_parser("show", help="all the rows of one file")
+    show.add_argument("file")
+    arguments = parser.parse_args()
 
-for each in file_list:
-    
-    print ("==============================================")
-    
-    temp = np.load(each)
+    np.set_printoptions(suppress=True, linewidth=200)
 
-    data = temp['data']
+    if arguments.command == "show":
+        timestamps, values = datafile.load(arguments.file)
+        print(np.column_stack((timestamps, values)))
+    else:
+        index = ArchiveIndex()
+        start = time.monotonic()
+        indexed, removed = index.update()
+        print(f"Index updated in {time.monotonic() - start:.1f} s: {indexed} files indexed, {removed} removed")
 
-    print(data)
\ No newline at end of file
+        if arguments.command is None:
+            for label, count, number_rows, first, last in index.labels():
+                print(f"{label:<24} {count:>7} files {number_rows:>12} rows  {format_time(first)} - {format_time(last)}")
+        elif arguments.command == "files":
+            for entry in index.files(arguments.label, arguments.since, arguments.until):
+                print(f"{entry.name:<40} {entry.rows:>9} rows  {format_time(entry.first)} - {format_time(entry.last)}")
+        else:
+            start = time.monotonic()
+            timestamps, values = index.rows(arguments.label, arguments.since, arguments.until)
+            print(f"{len(timestamps)} rows read in {time.monotonic() - start:.1f} s")
+            if arguments.output:
+                np.savez(arguments.output, timestamp=timestamps, values=values)
+            else:
+                print(np.column_stack((timestamps, values)))
+        index.close()
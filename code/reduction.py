@@ -0,0 +1,189 @@
+"""
+Reduce the rows handed over by DataAggregator before they are stored
+(and uploaded), with a bound on the error of each channel.
+
+REDUCTION_METHOD selects how the rows of an active wheelchair are reduced:
+
+    none           every row is kept (default)
+    deadband       consecutive rows whose values stay within 2 x the tolerance
+                   of each channel become a single row holding the middle of
+                   their range: holding it until the next row is within the
+                   tolerance of every original value
+    swinging_door  rows are kept only where a straight line from the last
+                   kept row can no longer pass within the tolerance of all the
+                   rows since: interpolating linearly between the kept rows is
+                   within the tolerance of every original value
+
+Whatever the method, a wheelchair whose gyroscopes stay below IDLE_GYRO
+for IDLE_AFTER seconds is idle. Idle spans are collapsed into two rows
+(start and end of the span) holding the middle of the range of each
+channel, with a tolerance IDLE_FACTOR times larger. An idle span ends when
+a channel leaves its tolerance or after IDLE_PERIOD seconds. Both holding
+and interpolating the two rows are within the tolerance.
+
+A row is kept at least every REDUCTION_MAX_GAP seconds while active, so
+that a gap in the data still means a disconnection.
+
+Environment variables:
+REDUCTION_METHOD     none, deadband or swinging_door
+REDUCTION_ACC        tolerance of the accelerometers, m/s^2
+REDUCTION_GYRO       tolerance of the gyroscopes, rad/s
+REDUCTION_FSR        tolerance of the FSRs, ADC counts
+REDUCTION_MAX_GAP    seconds between two kept rows, at most, while active
+IDLE_GYRO            gyroscope level (rad/s, all axes and devices) below which the wheelchair is still
+IDLE_AFTER           seconds still before the wheelchair is idle
+IDLE_FACTOR          tolerance while idle, relative to the active one
+IDLE_PERIOD          seconds of an idle span, at most
+"""
+
+import os
+import numpy as np
+
+from devices import DEVICE_COLUMNS
+from metrics import counter, gauge
+
+REDUCTION_METHOD = os.getenv("REDUCTION_METHOD", "none")
+REDUCTION_ACC = float(os.getenv("REDUCTION_ACC", 0.05))
+REDUCTION_GYRO = float(os.getenv("REDUCTION_GYRO", 0.01))
+REDUCTION_FSR = float(os.getenv("REDUCTION_FSR", 20))
+REDUCTION_MAX_GAP = float(os.getenv("REDUCTION_MAX_GAP", 1))
+IDLE_GYRO = float(os.getenv("IDLE_GYRO", 0.05))
+IDLE_AFTER = float(os.getenv("IDLE_AFTER", 10))
+IDLE_FACTOR = float(os.getenv("IDLE_FACTOR", 5))
+IDLE_PERIOD = float(os.getenv("IDLE_PERIOD", 60))
+
+def tolerances(imu_columns, number_fsr, acc=REDUCTION_ACC, gyro=REDUCTION_GYRO, fsr=REDUCTION_FSR):
+    """Tolerance of each column: 3 acc and 3 gyro axes per device, then the FSRs"""
+    return np.concatenate((np.tile([acc] * 3 + [gyro] * 3, imu_columns // DEVICE_COLUMNS), [fsr] * number_fsr))
+
+class Reducer:
+    """ Keep the rows needed to rebuild every channel within its tolerance
+    Rows go in with reduce(), in blocks, and the kept rows come out as they
+    are decided, a few rows later. flush() returns the pending ones.
+    """
+    def __init__(self, imu_columns, number_fsr, method=REDUCTION_METHOD, tolerance=None, max_gap=REDUCTION_MAX_GAP,
+                 idle_gyro=IDLE_GYRO, idle_after=IDLE_AFTER, idle_factor=IDLE_FACTOR, idle_period=IDLE_PERIOD):
+        if method not in ("none", "deadband", "swinging_door"):
+            raise ValueError(f"Unknown reduction method {method}")
+        self.method = method
+        self.tolerance = tolerance if tolerance is not None else tolerances(imu_columns, number_fsr)
+        self.max_gap = max_gap * 1000
+        self.idle_tolerance = self.tolerance * idle_factor
+        self.idle_after = idle_after * 1000
+        self.idle_period = idle_period * 1000
+        self.idle_gyro = idle_gyro
+        # gyroscope columns of all the devices
+        self.gyro_columns = np.concatenate([np.arange(3, 6) + index * DEVICE_COLUMNS for index in range(imu_columns // DEVICE_COLUMNS)]).astype(int)
+        self.still_since = None # timestamp of the first row of the current still period
+        self.idle = False
+        self.span = None # [start, last timestamp, minimum, maximum] of the current deadband or idle span
+        self.door = None # [timestamp, values, lower slope, upper slope, last timestamp, last values] of the swinging door
+        self.rows_in = 0
+        self.rows_out = 0
+        self.idle_spans = 0
+        self.output = []
+
+    def reduce(self, timestamps, values):
+        """Add rows, return the (timestamps, values) of the rows kept so far"""
+        if self.method == "none":
+            self.rows_in += len(timestamps)
+            self.rows_out += len(timestamps)
+            return timestamps, values
+        for timestamp, row in zip(timestamps.tolist(), values.astype(np.float64)):
+            self.add(timestamp, row)
+        return self.take()
+
+    def flush(self):
+        """Close the current span, return the rows kept"""
+        self.close_span()
+        if self.door is not None:
+            self.keep(self.door[4], self.door[5])
+            self.door = None
+        return self.take()
+
+    def take(self):
+        timestamps = np.array([timestamp for timestamp, row in self.output], dtype=np.int64)
+        values = np.array([row for timestamp, row in self.output], dtype=np.float32).reshape(len(self.output), len(self.tolerance))
+        self.output = []
+        return timestamps, values
+
+    def keep(self, timestamp, row):
+        self.output.append((timestamp, row))
+        self.rows_out += 1
+
+    def add(self, timestamp, row):
+        self.rows_in += 1
+        still = len(self.gyro_columns) > 0 and np.all(np.abs(row[self.gyro_columns]) < self.idle_gyro)
+        if not still:
+            self.still_since = None
+        elif self.still_since is None:
+            self.still_since = timestamp
+        if self.idle and not still:
+            # moving again: the idle span ends with the previous row
+            self.close_span()
+            self.idle = False
+        elif not self.idle and still and timestamp - self.still_since >= self.idle_after:
+            self.close_span()
+            if self.door is not None:
+                self.keep(self.door[4], self.door[5])
+                self.door = None
+            self.idle = True
+            self.idle_spans += 1
+        if self.idle:
+            self.add_to_span(timestamp, row, self.idle_tolerance, self.idle_period, True)
+        elif self.method == "deadband":
+            self.add_to_span(timestamp, row, self.tolerance, self.max_gap, False)
+        else:
+            self.swing_door(timestamp, row)
+
+    def add_to_span(self, timestamp, row, tolerance, max_length, idle):
+        if self.span is not None:
+            start, last, minimum, maximum = self.span
+            minimum = np.minimum(minimum, row)
+            maximum = np.maximum(maximum, row)
+            if np.all(maximum - minimum <= 2 * tolerance) and timestamp - start < max_length:
+                self.span = [start, timestamp, minimum, maximum]
+                return
+            self.close_span(idle)
+        self.span = [timestamp, timestamp, row, row]
+
+    def close_span(self, idle=None):
+        """Keep the row of the current span: the middle of its range, at its start (and end if idle)"""
+        if self.span is None:
+            return
+        start, last, minimum, maximum = self.span
+        middle = (minimum + maximum) / 2
+        self.keep(start, middle)
+        if (self.idle if idle is None else idle) and last > start:
+            self.keep(last, middle)
+        self.span = None
+
+    def swing_door(self, timestamp, row):
+        if self.door is None:
+            # first row, or first after an idle span: always kept
+            self.keep(timestamp, row)
+            self.door = [timestamp, row, np.full(len(row), -np.inf), np.full(len(row), np.inf), timestamp, row]
+            return
+        start, origin, lower, upper, last, last_row = self.door
+        if timestamp <= last:
+            return
+        elapsed = timestamp - start
+        slope = (row - origin) / elapsed
+        # the line to this row passes within the tolerance of all the rows since the origin
+        if np.all((slope >= lower) & (slope <= upper)) and elapsed < self.max_gap:
+            lower = np.maximum(lower, (row - self.tolerance - origin) / elapsed)
+            upper = np.minimum(upper, (row + self.tolerance - origin) / elapsed)
+            self.door = [start, origin, lower, upper, timestamp, row]
+            return
+        # the door closed: keep the last row within it and open a new door from there
+        self.keep(last, last_row)
+        elapsed = timestamp - last
+        self.door = [last, last_row, (row - self.tolerance - last_row) / elapsed, (row + self.tolerance - last_row) / elapsed, timestamp, row]
+
+    def metrics(self):
+        return [
+            counter("reduction_input_rows_total", "Rows before reduction", self.rows_in),
+            counter("reduction_output_rows_total", "Rows kept by the reduction", self.rows_out),
+            counter("reduction_idle_spans_total", "Idle periods detected", self.idle_spans),
+            gauge("reduction_idle", "1 while the wheelchair is idle", int(self.idle)),
+        ]
@@ -0,0 +1,31 @@
+class SampleRing:
+    """ Fixed-size ring between one producer thread and one consumer thread, without lock
+    Only the producer writes head and only the consumer writes tail. Under
+    the GIL, reading or assigning an attribute is atomic, and head is moved
+    only once the slot is written.
+    When the ring is full, new items are dropped and counted.
+    """
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0 # items pushed
+        self.tail = 0 # items drained
+        self.overflows = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push(self, item):
+        if self.head - self.tail >= self.capacity:
+            self.overflows += 1
+            return False
+        self.slots[self.head % self.capacity] = item
+        self.head += 1
+        return True
+
+    def drain(self):
+        """Return all the items pushed since the last drain, oldest first"""
+        head = self.head
+        items = [self.slots[i % self.capacity] for i in range(self.tail, head)]
+        self.tail = head
+        return items
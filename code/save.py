@@ -1,18 +1,54 @@
-import logging, threading, time
+import glob, logging, os, queue, threading, time
+from collections import deque, namedtuple
 import numpy as np
 
+import compact, datafile
+from buffer import BlockBuffer
+from scheduler import DeadlineScheduler, Histogram
+from segment import SegmentWriter
 from timekeeper import TimerKeeper
-from fsr import FSR
-from bluetooth import BLE_Devices
+from fsr import FSR, FSRSampler, FSR_SAMPLING_PERIOD
+from fusion import StreamFusion, FUSION_PERIOD, FUSION_DELAY
+from bluetooth import BLE_Devices, SAMPLE_BUFFER
+from devices import DEVICE_COLUMNS
+from inference import InferenceStage, INFERENCE_WINDOW, INFERENCE_SUMMARY_PATH, SUMMARY_LABEL
+from reduction import Reducer, REDUCTION_METHOD
+from metrics import counter, gauge, histogram
+
+# rows per block, appended to the segment in continuous collection
+CHUNK_ROWS = 100
+# seconds between two logs of the sampling rate and jitter
+STATS_PERIOD = 60
+
+# chunks waiting to be written, and what to do when the queue is full:
+# "block" the aggregator, "drop_oldest" chunk, or "spill" chunks to WRITER_SPILL_PATH
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", 32))
+WRITER_POLICY = os.getenv("WRITER_POLICY", "block")
+WRITER_SPILL_PATH = os.getenv("WRITER_SPILL_PATH", None)
+
+# A block of rows to write. Streamed chunks are appended to the segment of their label,
+# others are written to their own file <label>-<start_time>.npz.
+# The first imu_columns columns of the values are IMU values, the others FSRs.
+Chunk = namedtuple("Chunk", ["label", "start_time", "timestamps", "values", "stream", "imu_columns"])
 
 class DataAggregator(threading.Thread):
     """ A parallel thread to merge data from IMUs and FSRs """
-    def __init__(self, threadID, name, counter, fsr: FSR, ble_devices: BLE_Devices, folder, frequency, timeKeeper: TimerKeeper):
+    def __init__(self, threadID, name, counter, fsr: FSR, ble_devices: BLE_Devices, folder, frequency, timeKeeper: TimerKeeper, policy="skip", writer=None):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
         self.counter = counter
         self.fsr: FSR = fsr
+        # streams aligned on a grid of FUSION_PERIOD ms, unless it is 0
+        self.fusion = None
+        if FUSION_PERIOD > 0:
+            streams = [(device.name, DEVICE_COLUMNS) for device in ble_devices.devices]
+            self.fusion = StreamFusion(streams + [("fsr", fsr.number_fsr)], FUSION_PERIOD)
+        # FSRs are scanned in their own thread, unless FSR_SAMPLING_PERIOD is 0
+        self.fsr_sampler = None
+        if fsr.number_fsr > 0 and FSR_SAMPLING_PERIOD > 0:
+            # the fusion takes every scan, not only the latest
+            self.fsr_sampler = FSRSampler(fsr, FSR_SAMPLING_PERIOD, queue_rows=SAMPLE_BUFFER if self.fusion is not None else 0)
         self.ble_devices: BLE_Devices = ble_devices
         self.timeKeeper: TimerKeeper = timeKeeper
         if self.timeKeeper is not None:
@@ -22,72 +58,344 @@ class DataAggregator(threading.Thread):
             self.start_time = round(time.time()*1000)
         self.folder = folder
         self.frequency = frequency
+        # frequency is the sampling period in seconds, missed ticks are skipped or caught up
+        self.scheduler = DeadlineScheduler(frequency, policy)
+        # a writer shared with other aggregators stays open when this one stops
+        self.own_writer = writer is None
+        self.writer = writer if writer is not None else Writer(folder)
+        # window features and activity of the rows, unless INFERENCE_WINDOW is 0
+        self.inference = None
+        self.summary_writer = None
+        if INFERENCE_WINDOW > 0:
+            output = None
+            if INFERENCE_SUMMARY_PATH:
+                if os.path.realpath(INFERENCE_SUMMARY_PATH) == os.path.realpath(folder):
+                    # summaries would be uploaded as sensor rows
+                    raise ValueError("INFERENCE_SUMMARY_PATH must not be the data folder")
+                os.makedirs(INFERENCE_SUMMARY_PATH, exist_ok=True)
+                # summaries are not sensor values, they are kept in float32
+                self.summary_writer = Writer(INFERENCE_SUMMARY_PATH, encoding="float32")
+                output = lambda timestamps, values: self.summary_writer.put(Chunk(SUMMARY_LABEL, None, timestamps, values, True, 0))
+            self.inference = InferenceStage(ble_devices.devices, fsr.number_fsr, output=output)
+        # continuous collection only keeps the rows needed within the tolerances of REDUCTION_METHOD,
+        # activity recordings stay at the full rate for the datasets
+        self.reducer = None
+        if self.timeKeeper is None and REDUCTION_METHOD != "none":
+            self.reducer = Reducer(DEVICE_COLUMNS * len(ble_devices.devices), fsr.number_fsr)
+        self.imu_columns = DEVICE_COLUMNS * len(ble_devices.devices)
+        self.rows = 0 # rows handed to the writer
         self.enabled = True
 
     def run(self):
+        if self.own_writer:
+            self.writer.start()
+        if self.fsr_sampler is not None:
+            self.fsr_sampler.start()
+        if self.summary_writer is not None:
+            self.summary_writer.start()
         self.update_data()
+        if self.fsr_sampler is not None:
+            self.fsr_sampler.stop()
+            self.fsr_sampler.join()
+        if self.summary_writer is not None:
+            self.inference.flush()
+            self.summary_writer.stop()
+        if self.own_writer:
+            self.writer.stop()
 
     def stop_collection(self):
         self.enabled = False
 
     # update data at a frequency 
     def update_data(self):
-        output_data = []
+        # output = timestamp + 6 per device + all pressures
+        devices = self.ble_devices.devices
+        imu_columns = DEVICE_COLUMNS * len(devices)
+        columns = imu_columns + self.fsr.number_fsr
+        if self.timeKeeper is None:
+            rows = CHUNK_ROWS
+        else:
+            # one file per activity, large enough for the whole recording
+            period = FUSION_PERIOD / 1000 if self.fusion is not None else self.frequency
+            rows = int(self.timeKeeper.period / 1000 / period) + CHUNK_ROWS
+        block = BlockBuffer(rows, columns)
+        fsr_values = np.zeros(self.fsr.number_fsr, dtype=np.float32)
+        # samples received before this recording, e.g. between two activities of a session
+        self.ble_devices.drain()
         logging.info('Recording...')
+        stats_time = time.monotonic() + STATS_PERIOD
         while self.enabled:
+            # Wait for the next tick, on a fixed grid of the sampling period
+            self.scheduler.wait()
+            # Every IMU sample received since the last tick, none is lost between ticks
+            samples = self.ble_devices.drain()
+            scans = self.drain_fsr() if self.fusion is not None else None
             # If no timekeeper, collect forever
             if self.timeKeeper is None or self.timeKeeper.start_recording:
-                # output = timestamp + 6 left + 6 right + all pressures
-                temp = [None] * ( 1 + 6 + 6 + self.fsr.number_fsr)
-                temp[0]    = round(time.time()*1000) #timestamp
-                temp[1:7]  = self.ble_devices.imu_left
-                temp[7:13] = self.ble_devices.imu_right
-                if self.fsr.number_fsr > 0:
-                    temp[13:13+self.fsr.number_fsr] = self.fsr.read_fsrs()
-                output_data.append(temp)
-            
-            # If no timekeeper, save in chuncks of 1000 records
-            if self.timeKeeper is None:
-                if len(output_data) == 100:
-                    to_save = output_data
-                    output_data = []
-                    save = Save(0, "Save", 0, to_save, self.label, self.start_time, self.folder)
-                    save.start()
-                    self.start_time = round(time.time()*1000)
-
-            elif self.timeKeeper.stop_recording:
+                if self.fusion is not None:
+                    self.fuse(samples, scans)
+                    # grid points are emitted once late samples had time to arrive
+                    block = self.write_rows(block, *self.fusion.emit(round(time.time()*1000) - FUSION_DELAY), columns)
+                else:
+                    # one FSR scan per tick, copied into every row of the tick
+                    if self.fsr_sampler is not None:
+                        self.fsr_sampler.snapshot(fsr_values)
+                    elif self.fsr.number_fsr > 0:
+                        self.fsr.read_fsrs(fsr_values)
+                    # the i-th samples of each device share a row
+                    for i in range(max(max(len(received) for received in samples.values()) if samples else 0, 1)):
+                        row_samples = [(device, samples[device.name][i]) for device in devices if i < len(samples[device.name])]
+                        times = [sample.host_time for device, sample in row_samples]
+                        timestamp = min(times) if len(times) > 0 else round(time.time()*1000)
+                        row = block.next_row(timestamp)
+                        self.rows += 1
+                        # blocks start zeroed: devices without a sample stay at zero, and are skipped on upload
+                        for device, sample in row_samples:
+                            row[device.columns] = sample.values
+                        row[imu_columns:] = fsr_values
+                        if self.inference is not None:
+                            self.inference.add_row(timestamp, row)
+                        block = self.hand_over(block, columns)
+
+            if self.timeKeeper is not None and self.timeKeeper.stop_recording:
                 self.enabled = False
-            # Frequency, now 10 hz
-            time.sleep(self.frequency)
+            if time.monotonic() > stats_time:
+                logging.info('Sampling: ' + self.scheduler.summary())
+                if self.fsr_sampler is not None:
+                    logging.info('FSR sampling: ' + self.fsr_sampler.scheduler.summary())
+                logging.info(f'IMU samples: {self.ble_devices.stats()}')
+                logging.info(f'Writer: {self.writer.stats()}')
+                stats_time += STATS_PERIOD
         # Flush remaining data
-        if self.timeKeeper is not None:
+        if self.fusion is not None:
+            block = self.write_rows(block, *self.fusion.flush(), columns)
+        if self.timeKeeper is None:
+            self.writer.put(Chunk(self.label, None, *self.reduce(*block.rows(), True), True, self.imu_columns))
+        elif not block.is_empty():
             self.start_time = self.timeKeeper.start_time
-        save = Save(0, "Save", 0, output_data, self.label, self.start_time, self.folder)
-        save.start()
+            self.writer.put(Chunk(self.label, self.start_time, *block.rows(), False, self.imu_columns))
 
-class Save(threading.Thread):
-    """ Save data in file """
-    def __init__(self, threadID, name, counter, data, label, start_time, folder):
-        threading.Thread.__init__(self)
-        self.threadID = threadID
-        self.name = name
-        self.counter = counter
-        self.data = data
-        self.label = label
-        self.start_time = start_time
+    def metrics(self):
+        metrics = [
+            histogram("sampling_lateness_seconds", "Delay of the aggregator ticks after their deadline", self.scheduler.lateness),
+            histogram("sampling_jitter_seconds", "Deviation of the interval between ticks from the period", self.scheduler.jitter),
+            counter("sampling_skipped_ticks_total", "Aggregator ticks skipped to catch up with the deadlines", self.scheduler.skipped),
+            gauge("sampling_effective_rate", "Aggregator ticks per second since the start", self.scheduler.effective_rate()),
+            counter("aggregator_rows_total", "Rows of sensor values recorded", self.rows),
+        ]
+        if self.fsr_sampler is not None:
+            metrics += self.fsr_sampler.metrics()
+        if self.inference is not None:
+            metrics += self.inference.metrics()
+        if self.reducer is not None:
+            metrics += self.reducer.metrics()
+        return metrics + self.fsr.metrics()
+
+    def drain_fsr(self):
+        """FSR scans since the last tick, as (timestamps, values)"""
+        if self.fsr_sampler is not None:
+            return self.fsr_sampler.drain()
+        if self.fsr.number_fsr == 0:
+            return None
+        return np.array([round(time.time()*1000)], dtype=np.int64), self.fsr.read_fsrs()[None, :].copy()
+
+    def fuse(self, samples, scans):
+        """Add the samples drained on this tick to the stream fusion"""
+        for name, received in samples.items():
+            if len(received) > 0:
+                self.fusion.add(name, np.array([sample.host_time for sample in received], dtype=np.int64),
+                                np.array([sample.values for sample in received], dtype=np.float32))
+        if scans is not None:
+            self.fusion.add("fsr", *scans)
+
+    def write_rows(self, block, timestamps, values, columns):
+        """Copy rows into the block, handing over the blocks filled on the way"""
+        if self.inference is not None:
+            self.inference.add(timestamps, values)
+        while len(timestamps) > 0:
+            count = block.extend(timestamps, values)
+            self.rows += count
+            timestamps, values = timestamps[count:], values[count:]
+            block = self.hand_over(block, columns)
+        return block
+
+    def reduce(self, timestamps, values, last=False):
+        """Rows kept by the reduction, with the pending ones if last"""
+        if self.reducer is None:
+            return timestamps, values
+        timestamps, values = self.reducer.reduce(timestamps, values)
+        if last:
+            pending_timestamps, pending_values = self.reducer.flush()
+            timestamps, values = np.concatenate((timestamps, pending_timestamps)), np.concatenate((values, pending_values))
+        return timestamps, values
+
+    def hand_over(self, block, columns):
+        """Return the block to fill next, handing over a full one"""
+        if not block.is_full():
+            return block
+        # If no timekeeper, hand over chunks of CHUNK_ROWS records to append to the segment
+        if self.timeKeeper is None:
+            self.writer.put(Chunk(self.label, None, *self.reduce(*block.rows()), True, self.imu_columns))
+            return BlockBuffer(CHUNK_ROWS, columns)
+        block.grow()
+        return block
+
+class Writer(threading.Thread):
+    """ A single long-lived thread writing chunks from a bounded queue """
+    def __init__(self, folder, queue_size=WRITER_QUEUE_SIZE, policy=WRITER_POLICY, spill_folder=WRITER_SPILL_PATH, encoding=compact.DATA_ENCODING):
+        threading.Thread.__init__(self, name="Writer", daemon=True)
+        if policy not in ("block", "drop_oldest", "spill"):
+            raise ValueError(f"Unknown writer policy {policy}")
         self.folder = folder
+        self.encoding = encoding
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.spill_folder = spill_folder if spill_folder is not None else os.path.join(folder, "spill")
+        # paths of spilled chunks, oldest first, including the ones left by a previous run
+        self.spilled = deque(sorted(glob.glob(os.path.join(self.spill_folder, "*.npz"))))
+        # spills interrupted while written were never queued, their chunk is lost
+        for path in glob.glob(os.path.join(self.spill_folder, "*.npz.part")):
+            os.remove(path)
+        self.lock = threading.Lock()
+        self.segments = {} # label -> SegmentWriter
+        self.write_latency = Histogram()
+        self.dropped_chunks = 0
+        self.spilled_chunks = 0
+        self.written_rows = 0
+        self.written_bytes = 0
+
+    def queue_depth(self):
+        return self.queue.qsize() + len(self.spilled)
+
+    def put(self, chunk: Chunk):
+        """Queue a chunk, applying the backpressure policy if the queue is full"""
+        if len(chunk.timestamps) == 0:
+            return
+        if self.policy == "block":
+            self.queue.put(chunk)
+            return
+        with self.lock:
+            # once spilling, keep spilling until the writer caught up, to keep the order
+            if self.policy == "spill" and len(self.spilled) > 0:
+                self.spill(chunk)
+                return
+            try:
+                self.queue.put_nowait(chunk)
+            except queue.Full:
+                if self.policy == "spill":
+                    self.spill(chunk)
+                else:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.dropped_chunks += 1
+                    except queue.Empty:
+                        pass
+                    self.queue.put_nowait(chunk)
+
+    def spill(self, chunk: Chunk):
+        os.makedirs(self.spill_folder, exist_ok=True)
+        path = os.path.join(self.spill_folder, f"{time.time_ns()}.npz")
+        # written under a temporary name, a power cut never leaves a torn spill file
+        with open(path + ".part", "wb") as file:
+            np.savez(file, timestamp=chunk.timestamps, values=chunk.values, label=chunk.label,
+                     start_time=-1 if chunk.start_time is None else chunk.start_time, stream=chunk.stream,
+                     imu_columns=chunk.imu_columns)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".part", path)
+        self.spilled.append(path)
+        self.spilled_chunks += 1
+
+    def unspill(self):
+        """Next spilled chunk, once the queue is empty"""
+        while True:
+            with self.lock:
+                if len(self.spilled) == 0 or not self.queue.empty():
+                    return None
+                path = self.spilled.popleft()
+            try:
+                with np.load(path) as content:
+                    start_time = int(content["start_time"])
+                    # spills of older versions have the IMU columns of the registry
+                    imu_columns = int(content["imu_columns"]) if "imu_columns" in content else compact.IMU_COLUMNS
+                    chunk = Chunk(str(content["label"]), None if start_time < 0 else start_time,
+                                  content["timestamp"], content["values"], bool(content["stream"]), imu_columns)
+            except Exception as error:
+                # e.g. a file left by an older version at a power cut: kept aside, the next one is read
+                logging.error(f"Cannot read spilled chunk {path}: {error}")
+                os.replace(path, path + ".bad")
+                continue
+            os.remove(path)
+            return chunk
 
     def run(self):
-        self.save_data_to_file()
+        while True:
+            chunk = self.unspill()
+            if chunk is None:
+                chunk = self.queue.get()
+                self.queue.task_done()
+                if chunk is None:
+                    # stop() was called, everything queued before is written
+                    break
+            self.write(chunk)
+        while True:
+            chunk = self.unspill()
+            if chunk is None:
+                break
+            self.write(chunk)
+        for segment in self.segments.values():
+            segment.close()
 
-    def save_data_to_file(self):
-        logging.info('Saving...')
+    def write(self, chunk: Chunk):
+        start = time.monotonic()
         try:
-            timestr_filename = f"{self.label}-{self.start_time}.npz" #create a file name
-            #timestr_filename = time.strftime(activity_name+"-%Y%m%d-%H%M%S", start_time)+".npz" #create a file name
-            data = np.array(self.data) # change data to numpy
-            data[:,0] = data[:,0] - data[0,0] 
-            np.savez(self.folder + timestr_filename, data = data) # save npz file
-            logging.info("Data saved into file: " + timestr_filename)
+            if chunk.stream:
+                # continuous collection goes to append-only segments, rolled over by size or age
+                segment = self.segments.get(chunk.label)
+                if segment is not None and (segment.columns, segment.imu_columns) != (chunk.values.shape[1], chunk.imu_columns):
+                    # another layout of the same label (e.g. devices added) starts a new segment
+                    segment.close()
+                    segment = None
+                if segment is None:
+                    self.segments[chunk.label] = SegmentWriter(self.folder, chunk.label, chunk.values.shape[1],
+                                                               encoding=self.encoding, imu_columns=chunk.imu_columns)
+                self.written_bytes += self.segments[chunk.label].append(chunk.timestamps, chunk.values)
+            else:
+                timestr_filename = f"{chunk.label}-{chunk.start_time}.npz" #create a file name
+                timestamps = chunk.timestamps - chunk.timestamps[0] # relative to the first row
+                path = os.path.join(self.folder, timestr_filename)
+                datafile.write(path, timestamps, chunk.values, self.encoding, imu_columns=chunk.imu_columns)
+                self.written_bytes += os.path.getsize(path)
+                logging.info("Data saved into file: " + timestr_filename)
+            self.written_rows += len(chunk.timestamps)
         except Exception as error:
-            logging.error(error)
\ No newline at end of file
+            logging.error(error)
+        self.write_latency.observe(time.monotonic() - start)
+
+    def stop(self, timeout=None):
+        """Write everything queued, close the segments and end the thread"""
+        self.queue.put(None)
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "written_rows": self.written_rows,
+            "written_bytes": self.written_bytes,
+            "dropped_chunks": self.dropped_chunks,
+            "spilled_chunks": self.spilled_chunks,
+            "write_latency_p50": self.write_latency.quantile(0.5),
+            "write_latency_p99": self.write_latency.quantile(0.99),
+            "write_latency_max": self.write_latency.max,
+        }
+
+    def metrics(self):
+        return [
+            histogram("writer_latency_seconds", "Time to write a chunk", self.write_latency),
+            counter("writer_rows_total", "Rows written", self.written_rows),
+            counter("writer_bytes_total", "Bytes written to the data files", self.written_bytes),
+            gauge("writer_queue_depth", "Chunks waiting to be written, queued or spilled", self.queue_depth()),
+            counter("writer_dropped_chunks_total", "Chunks dropped on a full queue", self.dropped_chunks),
+            counter("writer_spilled_chunks_total", "Chunks spilled to disk on a full queue", self.spilled_chunks),
+        ]
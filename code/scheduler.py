@@ -0,0 +1,108 @@
+"""
+Pace the sampling loop on monotonic deadlines.
+
+Sleeping a fixed period after the work makes every tick late by the time
+spent working, so the effective rate is always below the target. Here,
+tick n is due at start + n * period whatever the work took. When the loop
+falls behind, missed ticks are either run back to back ("catch_up") or
+dropped ("skip").
+
+Lateness of each tick and jitter of the interval between ticks are kept
+in histograms, to check the effective rate in production.
+"""
+
+import bisect, time
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, float("inf")]
+
+class Histogram:
+    """ Count of observations per bucket, with sum and maximum """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (at most the maximum)"""
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target and total > 0:
+                return min(bound, self.max)
+        return 0.0
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else 0.0
+
+class DeadlineScheduler:
+    """ Wait for the next tick of a fixed period, without drift """
+    def __init__(self, period, policy="skip"):
+        if policy not in ("skip", "catch_up"):
+            raise ValueError(f"Unknown scheduling policy {policy}")
+        self.period = period
+        self.policy = policy
+        self.next_tick = None
+        self.start = None
+        self.last_tick = None
+        self.ticks = 0
+        self.skipped = 0
+        self.lateness = Histogram() # time between deadline and actual tick
+        self.jitter = Histogram()   # |interval between ticks - period|
+
+    def wait(self):
+        """Sleep until the next deadline, return the lateness of this tick in seconds"""
+        now = time.monotonic()
+        if self.next_tick is None:
+            self.start = self.next_tick = now
+        delay = self.next_tick - now
+        if delay > 0:
+            time.sleep(delay)
+            now = time.monotonic()
+        lateness = now - self.next_tick
+        self.lateness.observe(lateness)
+        if self.last_tick is not None:
+            self.jitter.observe(abs(now - self.last_tick - self.period))
+        self.last_tick = now
+        self.ticks += 1
+
+        self.next_tick += self.period
+        if self.policy == "skip" and now > self.next_tick:
+            missed = int((now - self.next_tick) // self.period) + 1
+            self.skipped += missed
+            self.next_tick += missed * self.period
+        return lateness
+
+    def effective_rate(self):
+        """Ticks per second since the first tick"""
+        if self.ticks < 2:
+            return 0.0
+        return (self.ticks - 1) / (self.last_tick - self.start)
+
+    def stats(self):
+        return {
+            "target_rate": 1 / self.period,
+            "effective_rate": self.effective_rate(),
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "lateness_p50": self.lateness.quantile(0.5),
+            "lateness_p99": self.lateness.quantile(0.99),
+            "lateness_max": self.lateness.max,
+            "jitter_p50": self.jitter.quantile(0.5),
+            "jitter_p99": self.jitter.quantile(0.99),
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"{stats['effective_rate']:.1f}/{stats['target_rate']:.1f} Hz, {stats['skipped']} skipped, "
+                f"lateness p50 {stats['lateness_p50']*1000:g} ms p99 {stats['lateness_p99']*1000:g} ms "
+                f"max {stats['lateness_max']*1000:.1f} ms, jitter p99 {stats['jitter_p99']*1000:g} ms")
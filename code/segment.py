@@ -0,0 +1,146 @@
+"""
+Append-only segment files for continuous collection.
+
+A segment is named <label>-<start timestamp>.seg and made of a header
+followed by fixed-size records:
+
+    header   magic b"WCHSEG", version uint16, columns uint16,
+             header size uint16, start timestamp int64 (ms),
+             record size uint32, encoding uint8, IMU columns uint16,
+             padded to HEADER_SIZE bytes
+    records  timestamp int64 (absolute, ms) + columns x float32
+             or, compact encoding (see compact.py):
+             timestamp int64 + IMU columns x int16 + FSR columns x uint16
+
+Readers map the records with np.memmap, without copy. Float32 values
+are used as mapped, compact records are decoded into a new array.
+
+While it is written, a segment is named .seg.part. It is rolled over
+(fsynced and renamed to .seg) once it reaches a maximum size or age.
+After a crash, recover() truncates a torn tail (a partial record, or
+records never written and left as zeros) and finalises the segment.
+"""
+
+import logging, glob, os, struct, time
+import numpy as np
+
+import compact
+
+MAGIC = b"WCHSEG"
+VERSION = 1
+HEADER = struct.Struct("<6sHHHqIBH")
+HEADER_SIZE = 32
+
+ENCODING_FLOAT32 = 0
+ENCODING_COMPACT = 1
+
+SEGMENT_MAX_BYTES = int(os.getenv("SEGMENT_MAX_BYTES", 8 * 1024 * 1024))
+SEGMENT_MAX_AGE = float(os.getenv("SEGMENT_MAX_AGE", 300))
+
+def record_dtype(columns, encoding=ENCODING_FLOAT32, imu_columns=0):
+    if encoding == ENCODING_COMPACT:
+        return np.dtype([("timestamp", "<i8"), ("imu", "<i2", (imu_columns,)), ("fsr", "<u2", (columns - imu_columns,))])
+    return np.dtype([("timestamp", "<i8"), ("values", "<f4", (columns,))])
+
+def write_header(file, columns, start_timestamp, encoding, imu_columns):
+    header = HEADER.pack(MAGIC, VERSION, columns, HEADER_SIZE, start_timestamp,
+                         record_dtype(columns, encoding, imu_columns).itemsize, encoding, imu_columns)
+    file.write(header.ljust(HEADER_SIZE, b"\0"))
+
+def read_header(path):
+    """Return (record dtype, header size, start timestamp, record size, IMU columns)"""
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) < HEADER.size:
+        raise ValueError(f"Truncated segment header in {path}")
+    magic, version, columns, header_size, start_timestamp, record_size, encoding, imu_columns = HEADER.unpack_from(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a segment file: {path}")
+    return record_dtype(columns, encoding, imu_columns), header_size, start_timestamp, record_size, imu_columns
+
+def open_segment(path):
+    """Map the records of a segment, return (start timestamp, structured records)"""
+    dtype, header_size, start_timestamp, record_size, imu_columns = read_header(path)
+    count = (os.path.getsize(path) - header_size) // record_size
+    if count == 0:
+        return start_timestamp, np.zeros(0, dtype=dtype)
+    return start_timestamp, np.memmap(path, dtype=dtype, mode="r", offset=header_size, shape=(count,))
+
+def recover(folder, label=None):
+    """Finalise the segments left open by a crash (of one label, or all), dropping their torn tail"""
+    pattern = "*.seg.part" if label is None else glob.escape(label) + "-*.seg.part"
+    for path in glob.glob(os.path.join(folder, pattern)):
+        try:
+            dtype, header_size, start_timestamp, record_size, imu_columns = read_header(path)
+            count = (os.path.getsize(path) - header_size) // record_size
+            if count > 0:
+                timestamps = np.memmap(path, dtype=dtype, mode="r", offset=header_size, shape=(count,))["timestamp"]
+                # records allocated by the file system but never written read as zeros
+                valid = np.flatnonzero(timestamps > 0)
+                count = 0 if len(valid) == 0 else valid[-1] + 1
+                del timestamps
+            if count == 0:
+                os.remove(path)
+                continue
+            with open(path, "r+b") as file:
+                file.truncate(header_size + count * record_size)
+                os.fsync(file.fileno())
+            os.rename(path, path[:-len(".part")])
+            logging.info(f"Recovered {count} records from {path}")
+        except (OSError, ValueError) as error:
+            logging.error(f"Cannot recover {path}: {error}")
+
+class SegmentWriter:
+    """ Append blocks of rows to the current segment, rolling over by size or age """
+    def __init__(self, folder, label, columns, max_bytes=SEGMENT_MAX_BYTES, max_age=SEGMENT_MAX_AGE,
+                 encoding=compact.DATA_ENCODING, imu_columns=compact.IMU_COLUMNS):
+        self.folder = folder
+        self.label = label
+        self.columns = columns
+        self.encoding = ENCODING_COMPACT if encoding == "compact" else ENCODING_FLOAT32
+        self.imu_columns = imu_columns
+        self.dtype = record_dtype(columns, self.encoding, imu_columns)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.file = None
+        self.path = None
+        self.opened = 0
+        # only the segments of this label: another writer may share the folder
+        recover(folder, label)
+
+    def open(self, start_timestamp):
+        self.path = os.path.join(self.folder, f"{self.label}-{start_timestamp}.seg")
+        self.file = open(self.path + ".part", "wb")
+        write_header(self.file, self.columns, start_timestamp, self.encoding, self.imu_columns)
+        self.opened = time.monotonic()
+
+    def append(self, timestamps, values):
+        """Append rows (absolute timestamps in ms, float32 values), return the number of bytes written"""
+        if len(timestamps) == 0:
+            return 0
+        if values.shape[1] != self.columns:
+            raise ValueError(f"Rows of {values.shape[1]} values appended to a segment of {self.columns} columns")
+        if self.file is None:
+            self.open(int(timestamps[0]))
+        records = np.empty(len(timestamps), dtype=self.dtype)
+        records["timestamp"] = timestamps
+        if self.encoding == ENCODING_COMPACT:
+            records["imu"], records["fsr"] = compact.encode(values, self.imu_columns)
+        else:
+            records["values"] = values
+        self.file.write(records.tobytes())
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes or time.monotonic() - self.opened >= self.max_age:
+            self.close()
+        return records.nbytes
+
+    def close(self):
+        """Complete the current segment: fsync and rename it for the uploader"""
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.path + ".part", self.path)
+        logging.info("Data saved into file: " + os.path.basename(self.path))
+        self.file = None
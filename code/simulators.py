@@ -0,0 +1,151 @@
+"""
+Stand-ins for the hardware, to run and measure the collection pipeline
+on any machine.
+
+FakeGPIO mimics the subset of RPi.GPIO used by fsr.py, FakeADS1115 the
+single-shot conversions of Adafruit_ADS1x15.ADS1115. The ADC reads the
+channel selected on the mux pins of the fake GPIO.
+
+FakeIMUDevice is an IMU sending binary frames, which can go in and out
+of range. FakeBLE builds BLE_interface stand-ins connecting to them:
+BLE_Devices(devices, interface=FakeBLE(fakes)). See backends.py to run
+the pipeline on them.
+"""
+
+import asyncio, time
+import numpy as np
+
+from imu_protocol import pack_frame
+
+class FakeGPIO:
+    """ Record the level of each output pin and count the writes """
+    BCM = "BCM"
+    OUT = "OUT"
+
+    def __init__(self):
+        self.pins = {}
+        self.writes = 0
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins[pin] = 0
+
+    def output(self, pin, value):
+        self.pins[pin] = value
+        self.writes += 1
+
+class FakeADS1115:
+    """ Convert the value of the channel selected on the mux, with Gaussian noise
+    Like the real driver, a conversion takes 1/data_rate seconds (unless
+    realtime is False) and the noise is higher at high data rates.
+    """
+    # input-referred noise in ADC counts per data rate, roughly as in the ADS1115 datasheet at gain 1
+    NOISE = {8: 1, 16: 1, 32: 1, 64: 1, 128: 1.5, 250: 2, 475: 3, 860: 4}
+
+    def __init__(self, gpio: FakeGPIO, mux_pins, pressure, realtime=True, seed=0, rate=None):
+        self.gpio = gpio
+        self.mux_pins = mux_pins
+        # ADC counts per mux channel, or rows of them replayed at rate rows per second
+        self.pressure = np.atleast_2d(np.asarray(pressure, dtype=np.float64))
+        self.rate = rate
+        self.start = time.monotonic()
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.conversions = 0
+
+    def selected_channel(self):
+        return sum(self.gpio.pins.get(pin, 0) << index for index, pin in enumerate(self.mux_pins))
+
+    def read_adc(self, channel, gain=1, data_rate=None):
+        data_rate = data_rate or 128
+        if self.realtime:
+            time.sleep(1.0 / data_rate + 0.0001)
+        self.conversions += 1
+        row = 0 if self.rate is None else int((time.monotonic() - self.start) * self.rate) % len(self.pressure)
+        channel = self.selected_channel()
+        level = self.pressure[row, channel] if channel < self.pressure.shape[1] else 0
+        value = level + self.rng.normal(0, self.NOISE.get(data_rate, 4))
+        return int(round(value))
+
+class FakeIMUDevice:
+    """ An IMU sampling every period while connected, sending frames_per_packet frames per notification
+    It sends values, rows of acc x, y, z and gyro x, y, z (e.g. replayed from a recording), in a loop,
+    or a constant signal.
+    """
+    def __init__(self, period=0.01, connect_time=0.1, frames_per_packet=1, values=None):
+        self.period = period
+        self.connect_time = connect_time
+        self.frames_per_packet = frames_per_packet
+        self.values = np.asarray(values).tolist() if values is not None else [[0, 0, 9.81, 0, 0, 0.01]]
+        self.in_range = True
+        self.connected = False
+        self.sent = 0
+
+class FakeBLEInterface:
+    """ Same methods as ble_serial's BLE_interface, used by BLE_Devices """
+    def __init__(self, devices):
+        self.devices = devices
+        self.device = None
+        self.callback = None
+        self.stopped = False
+
+    def set_receiver(self, callback):
+        self.callback = callback
+
+    async def connect(self, mac, address_type, timeout):
+        device = self.devices.get(mac)
+        await asyncio.sleep(device.connect_time if device is not None and device.in_range else timeout)
+        if device is None or not device.in_range:
+            raise TimeoutError(f"Device with address {mac} was not found")
+        self.device = device
+        device.connected = True
+
+    async def setup_chars(self, write_uuid, read_uuid, mode):
+        pass
+
+    async def send_loop(self):
+        # the firmware counts frames from 0 on each connection
+        seq = 0
+        start = time.monotonic()
+        packet = self.device.frames_per_packet
+        while not self.stopped and self.device.in_range:
+            # sleep until the last frame of the next packet is sampled
+            await asyncio.sleep(max(0, start + (seq + packet) * self.device.period - time.monotonic()))
+            values = self.device.values
+            self.callback(b"".join(pack_frame((seq + i) & 0xFFFF, round((seq + i) * self.device.period * 1000), values[(seq + i) % len(values)])
+                                   for i in range(packet)))
+            self.device.sent += packet
+            seq += packet
+
+    def stop_loop(self):
+        self.stopped = True
+
+    async def disconnect(self):
+        if self.device is not None:
+            self.device.connected = False
+
+class FakeBLE:
+    """ Build fake BLE interfaces, for BLE_Devices(..., interface=FakeBLE(devices))
+    Unknown MAC addresses get a new device from create_device(index), if given.
+    """
+    def __init__(self, devices, create_device=None):
+        self.devices = FakeDevices(devices, create_device) # mac -> FakeIMUDevice
+
+    def __call__(self, adapter, service_uuid):
+        return FakeBLEInterface(self.devices)
+
+class FakeDevices(dict):
+    """ Devices in range of the fake adapter, by MAC address """
+    def __init__(self, devices, create_device=None):
+        dict.__init__(self, devices)
+        self.create_device = create_device
+
+    def get(self, mac, default=None):
+        if mac not in self and self.create_device is not None:
+            self[mac] = self.create_device(len(self))
+        return dict.get(self, mac, default)
@@ -0,0 +1,10 @@
+"""
+The scripts of code/ import each other as top-level modules.
+
+Run the tests from the repository root:
+python -m pytest code/tests
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
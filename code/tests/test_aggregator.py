@@ -0,0 +1,58 @@
+"""
+Rows of DataAggregator of save.py, with scripted IMU samples and the fake FSR mux
+"""
+
+import numpy as np
+
+import save
+from devices import make_devices
+from fsr import FSR
+from imu_protocol import IMUSample
+from save import DataAggregator
+from simulators import FakeADS1115, FakeGPIO
+
+class ScriptedDevices:
+    """ BLE_Devices stand-in, draining a list of ticks of samples then stopping the aggregator """
+    def __init__(self, ticks):
+        self.devices = make_devices([("left", "mac-left"), ("right", "mac-right")])
+        self.ticks = ticks
+        self.aggregator = None
+
+    def drain(self):
+        if len(self.ticks) == 0:
+            self.aggregator.stop_collection()
+            return {device.name: [] for device in self.devices}
+        return self.ticks.pop(0)
+
+class ListWriter:
+    """ Writer stand-in keeping the chunks """
+    def __init__(self):
+        self.chunks = []
+
+    def put(self, chunk):
+        self.chunks.append(chunk)
+
+def sample(host_time, value):
+    return IMUSample(0, 0, host_time, [value] * 6)
+
+def test_every_row_of_a_tick_has_the_fsr_scan(monkeypatch):
+    # inline scans, no sampler thread
+    monkeypatch.setattr(save, "FSR_SAMPLING_PERIOD", 0)
+    pressure = [1000, 2000, 3000, 4000]
+    gpio = FakeGPIO()
+    fsr = FSR(4, gpio, FakeADS1115(gpio, [5, 6, 14, 19], pressure, realtime=False))
+    # the first drain empties what came before the recording
+    ticks = [{"left": [], "right": []},
+             {"left": [sample(1000, 1), sample(1010, 2), sample(1020, 3)], "right": [sample(1001, 4), sample(1011, 5)]},
+             {"left": [sample(1030, 6)], "right": [sample(1031, 7), sample(1041, 8)]}]
+    devices = ScriptedDevices(ticks)
+    writer = ListWriter()
+    aggregator = DataAggregator(1, "test", 1, fsr, devices, "unused", 0.001, None, writer=writer)
+    devices.aggregator = aggregator
+    aggregator.update_data()
+    values = np.concatenate([chunk.values for chunk in writer.chunks])
+    # a row per sample of the most active device, and one for the FSRs on the last tick
+    assert list(values[:, 0]) == [1, 2, 3, 6, 0, 0]
+    assert list(values[:, 6]) == [4, 5, 0, 7, 8, 0]
+    # no row left with zero FSRs between two scans
+    assert np.all(np.abs(values[:, 12:] - pressure) < 30)
@@ -0,0 +1,100 @@
+"""
+Index of archive.py: build, incremental updates and queries by label and time
+"""
+
+import os
+import numpy as np
+import pytest
+
+import datafile
+from archive import ArchiveIndex
+from segment import SegmentWriter
+
+START = 1700000000000
+
+def values(rows, first, columns=16):
+    """Rows holding their index from first, in every column (within the compact range)"""
+    return np.tile((first + np.arange(rows, dtype=np.float32))[:, None] / 100, (1, columns))
+
+def write_file(folder, label, start, rows=100, encoding="compact", columns=16):
+    """File of rows rows every 10 ms from start"""
+    path = str(folder / f"{label}-{start}.npz")
+    datafile.write(path, np.arange(rows, dtype=np.int64) * 10, values(rows, 0, columns), encoding)
+    return path
+
+@pytest.fixture
+def folders(tmp_path):
+    archive, data = tmp_path / "archive", tmp_path / "data"
+    archive.mkdir()
+    data.mkdir()
+    # 3 rolling files of 1 s, one still being uploaded, and a pushing segment in between
+    write_file(archive, "rolling", START)
+    write_file(archive, "rolling", START + 1000, encoding="float32")
+    write_file(data, "rolling", START + 3000)
+    writer = SegmentWriter(str(archive), "pushing", 16, encoding="compact", imu_columns=12)
+    writer.append(START + 2000 + np.arange(50, dtype=np.int64) * 10, values(50, 0))
+    writer.close()
+    return archive, data
+
+def make_index(tmp_path, folders):
+    return ArchiveIndex(str(tmp_path / "index.sqlite"), [str(folder) for folder in folders])
+
+def test_index_is_built_from_all_the_folders(tmp_path, folders):
+    index = make_index(tmp_path, folders)
+    assert index.update() == (4, 0)
+    assert index.labels() == [("pushing", 1, 50, START + 2000, START + 2490),
+                              ("rolling", 3, 300, START, START + 3990)]
+    entry = index.files("pushing")[0]
+    assert (entry.rows, entry.columns) == (50, 16)
+    assert entry.minimum == pytest.approx([0] * 16)
+    # FSRs are stored as whole ADC counts
+    assert entry.maximum == pytest.approx([0.49] * 12 + [0] * 4, abs=0.01)
+
+def test_update_only_reads_new_and_changed_files(tmp_path, folders):
+    archive, data = folders
+    index = make_index(tmp_path, folders)
+    index.update()
+    assert index.update() == (0, 0)
+    # uploaded: moved to the archive, unchanged, not read again
+    os.rename(str(data / f"rolling-{START + 3000}.npz"), str(archive / f"rolling-{START + 3000}.npz"))
+    assert index.update() == (0, 0)
+    assert index.files(since=START + 3000)[0].path == str(archive / f"rolling-{START + 3000}.npz")
+    # a new file and a rewritten one
+    write_file(data, "rolling", START + 4000)
+    write_file(archive, "rolling", START, rows=200)
+    assert index.update() == (2, 0)
+    assert index.labels()[1] == ("rolling", 4, 500, START, START + 4990)
+    os.remove(str(archive / f"rolling-{START}.npz"))
+    assert index.update() == (0, 1)
+    assert [entry.start for entry in index.files("rolling")] == [START + 1000, START + 3000, START + 4000]
+
+def test_files_by_label_and_time(tmp_path, folders):
+    index = make_index(tmp_path, folders)
+    index.update()
+    assert [entry.start for entry in index.files()] == [START, START + 1000, START + 2000, START + 3000]
+    assert [entry.start for entry in index.files("rolling", since=START + 500, until=START + 3000)] == [START, START + 1000]
+    # until is excluded, since is included
+    assert [entry.start for entry in index.files(since=START + 1990, until=START + 2000)] == [START + 1000]
+    assert index.files("sitting") == []
+
+def test_rows_of_a_time_range(tmp_path, folders):
+    index = make_index(tmp_path, folders)
+    index.update()
+    timestamps, rows = index.rows("rolling", since=START + 950, until=START + 1050)
+    assert list(timestamps) == list(range(START + 950, START + 1050, 10))
+    assert rows[:, 0] == pytest.approx([0.95, 0.96, 0.97, 0.98, 0.99, 0, 0.01, 0.02, 0.03, 0.04], abs=0.001)
+    # only the records within the range are read from the segment
+    timestamps, rows = index.rows("pushing", since=START + 2100, until=START + 2130)
+    assert list(timestamps) == [START + 2100, START + 2110, START + 2120]
+    assert rows[:, 0] == pytest.approx([0.1, 0.11, 0.12], abs=0.001)
+    blocks = list(index.blocks(since=START + 990, until=START + 2010))
+    assert [len(block_timestamps) for block_timestamps, block_values in blocks] == [1, 100, 1]
+
+def test_rows_of_files_with_different_columns_are_refused(tmp_path, folders):
+    archive, data = folders
+    write_file(archive, "rolling", START + 5000, columns=14)
+    index = make_index(tmp_path, folders)
+    index.update()
+    with pytest.raises(ValueError):
+        index.rows("rolling")
+    assert len(index.rows("rolling", until=START + 5000)[0]) == 300
@@ -0,0 +1,90 @@
+"""
+BLE_Devices of bluetooth.py over the fake BLE interface of simulators.py
+"""
+
+import asyncio
+import pytest
+
+import bluetooth
+from bluetooth import BLE_Devices, IMUStream
+from devices import make_devices
+from imu_protocol import pack_frame
+from simulators import FakeBLE, FakeIMUDevice
+
+VALUES = [[0.5, -1.25, 9.81, 0.1, -0.2, 0.003], [1, 2, 3, -0.4, 0.5, -0.006]]
+
+@pytest.fixture(autouse=True)
+def fast_reconnection(monkeypatch):
+    monkeypatch.setattr(bluetooth, "BLE_CONNECT_TIMEOUT", 0.05)
+    monkeypatch.setattr(bluetooth, "BLE_RECONNECT_MIN", 0.05)
+    monkeypatch.setattr(bluetooth, "BLE_RECONNECT_MAX", 0.1)
+
+def run(ble_devices, scenario):
+    """Run the connections while the scenario coroutine runs, then stop them"""
+    async def main():
+        connections = asyncio.ensure_future(ble_devices.connect())
+        await scenario()
+        ble_devices.stop()
+        await connections
+    asyncio.run(main())
+
+def test_frames_are_parsed_across_notifications():
+    stream = IMUStream()
+    frames = b"".join(pack_frame(seq, seq * 10, VALUES[seq % 2]) for seq in range(4))
+    # split in the middle of a frame, then a repeated frame
+    stream.receive(frames[:30], host_time=1000)
+    stream.receive(frames[30:], host_time=1040)
+    stream.receive(pack_frame(3, 30, VALUES[1]), host_time=1050)
+    samples = stream.drain()
+    assert [sample.seq for sample in samples] == [0, 1, 2, 3]
+    for sample in samples:
+        assert sample.values == pytest.approx(VALUES[sample.seq % 2], abs=1e-3)
+    assert stream.stats()["duplicated"] == 1
+    assert stream.stats()["dropped"] == 0
+
+def test_legacy_text_notifications_make_one_sample():
+    stream = IMUStream()
+    for index, value in enumerate(VALUES[0]):
+        stream.receive(f"{index}#{value}".encode())
+    samples = stream.drain()
+    assert len(samples) == 1
+    assert list(samples[0].values) == pytest.approx(VALUES[0])
+
+def test_both_devices_stream_every_sample():
+    fakes = {"mac-left": FakeIMUDevice(0.01, 0.01, 2, VALUES), "mac-right": FakeIMUDevice(0.01, 0.01, 2, VALUES)}
+    ble_devices = BLE_Devices(make_devices([("left", "mac-left"), ("right", "mac-right")]), FakeBLE(fakes))
+    run(ble_devices, lambda: asyncio.sleep(0.3))
+    samples = ble_devices.drain()
+    for name, fake in (("left", fakes["mac-left"]), ("right", fakes["mac-right"])):
+        assert len(samples[name]) == fake.sent > 0
+        assert [sample.seq for sample in samples[name]] == list(range(fake.sent))
+        assert samples[name][1].values == pytest.approx(VALUES[1], abs=1e-3)
+        assert ble_devices.stats()[name]["dropped"] == 0
+
+def test_lost_device_reconnects_on_its_own():
+    left, right = FakeIMUDevice(0.01, 0.01), FakeIMUDevice(0.01, 0.01)
+    ble_devices = BLE_Devices(make_devices([("left", "mac-left"), ("right", "mac-right")]),
+                              FakeBLE({"mac-left": left, "mac-right": right}))
+    async def scenario():
+        await asyncio.sleep(0.2)
+        right.in_range = False
+        await asyncio.sleep(0.2)
+        assert not ble_devices.connected["right"]
+        assert ble_devices.connected["left"]
+        right.in_range = True
+        await asyncio.sleep(0.3)
+    run(ble_devices, scenario)
+    stats = ble_devices.stats()
+    # the right device reconnected, the left one was never interrupted
+    assert stats["right"]["connections"] == 2
+    assert stats["left"]["connections"] == 1
+    assert stats["left"]["received"] == left.sent
+    # the device counts its frames from 0 again: not a gap, nor duplicates
+    assert stats["right"]["received"] == right.sent
+    assert stats["right"]["duplicated"] == 0
+
+def test_device_without_mac_is_not_connected():
+    ble_devices = BLE_Devices(make_devices([("left", "mac-left"), ("frame", None)]), FakeBLE({"mac-left": FakeIMUDevice()}))
+    run(ble_devices, lambda: asyncio.sleep(0.1))
+    assert ble_devices.stats()["frame"]["connections"] == 0
+    assert ble_devices.stats()["left"]["connections"] == 1
@@ -0,0 +1,68 @@
+"""
+Gray-code scan of fsr.py over the fake GPIO and ADC of simulators.py
+"""
+
+import numpy as np
+
+from fsr import FSR, gray_order
+from simulators import FakeADS1115, FakeGPIO
+
+MUX_PINS = [5, 6, 14, 19]
+
+def make_fsr(number_fsr, pressure, **options):
+    gpio = FakeGPIO()
+    adc = FakeADS1115(gpio, MUX_PINS, pressure, realtime=False)
+    return FSR(number_fsr, gpio, adc, **options), gpio, adc
+
+def one_pin(a, b):
+    return bin(a ^ b).count("1") == 1
+
+def test_gray_order_changes_one_pin_at_a_time():
+    assert gray_order(16) == [i ^ (i >> 1) for i in range(16)]
+    for number_fsr in range(1, 17):
+        order = gray_order(number_fsr)
+        # with fewer FSRs, only their channels are visited
+        assert sorted(order) == list(range(number_fsr))
+        assert all(one_pin(a, b) for a, b in zip(order, order[1:]))
+
+def test_gray_order_of_10_channels_is_a_cycle():
+    order = gray_order(10)
+    assert one_pin(order[-1], order[0])
+
+def test_each_channel_reads_its_own_sensor():
+    pressure = np.arange(16) * 1000 + 500
+    fsr, gpio, adc = make_fsr(16, pressure)
+    values = fsr.read_fsrs()
+    # the noise of the fake ADC at 860 samples/s is a few counts
+    assert np.all(np.abs(values - pressure) < 30)
+
+def test_only_the_changing_pins_are_written():
+    fsr, gpio, adc = make_fsr(16, [1000] * 16)
+    fsr.read_fsrs()
+    # 4 pins for the first channel, then one per channel
+    assert gpio.writes == 4 + 15
+    fsr.read_fsrs()
+    # back to the first channel: the last one of the Gray code is one pin away from it
+    assert gpio.writes == 4 + 15 + 16
+
+def test_only_the_changing_pins_are_written_with_10_fsrs():
+    fsr, gpio, adc = make_fsr(10, [1000] * 10)
+    fsr.read_fsrs()
+    fsr.read_fsrs()
+    assert gpio.writes == 4 + 9 + 10
+
+def test_oversampling_averages_conversions():
+    pressure = [20000] * 10
+    single, gpio, adc = make_fsr(10, pressure, oversampling=1)
+    averaged, gpio, averaged_adc = make_fsr(10, pressure, oversampling=16)
+    single_scans = np.array([single.read_fsrs().copy() for i in range(50)])
+    averaged_scans = np.array([averaged.read_fsrs().copy() for i in range(50)])
+    assert averaged_adc.conversions == 16 * 10 * 50
+    assert averaged_scans.std() < single_scans.std() / 2
+
+def test_scan_writes_into_a_row():
+    fsr, gpio, adc = make_fsr(4, [100, 200, 300, 400])
+    row = np.zeros(16, dtype=np.float32)
+    fsr.read_fsrs(row[12:])
+    assert np.all(row[:12] == 0)
+    assert np.all(np.abs(row[12:] - [100, 200, 300, 400]) < 30)
@@ -0,0 +1,64 @@
+"""
+Grid alignment of fusion.py
+"""
+
+import numpy as np
+import pytest
+
+from fusion import StreamFusion
+
+def ramp(timestamps, slope=1.0):
+    """One column worth slope times the timestamp"""
+    return (np.array(timestamps, dtype=np.float32) * slope)[:, None]
+
+def test_grid_is_aligned_on_the_period():
+    fusion = StreamFusion([("left", 1), ("right", 1)], period=10)
+    fusion.add("left", np.array([1003, 1017, 1031]), ramp([1003, 1017, 1031]))
+    fusion.add("right", np.array([1005, 1025]), ramp([1005, 1025], 2))
+    grid, values = fusion.emit(1030)
+    assert list(grid) == [1010, 1020]
+    # both streams interpolated at the grid timestamps
+    assert values[:, 0] == pytest.approx([1010, 1020])
+    assert values[:, 1] == pytest.approx([2020, 2040])
+
+def test_grid_starts_at_the_earliest_stream():
+    fusion = StreamFusion([("left", 1), ("right", 1)], period=10)
+    fusion.add("left", np.array([1100, 1110, 1120]), ramp([1100, 1110, 1120]))
+    # the right device was drained later, its samples are older
+    fusion.add("right", np.array([1000, 1010, 1020]), ramp([1000, 1010, 1020]))
+    grid, values = fusion.emit(1130)
+    assert grid[0] == 1000
+    assert values[grid == 1010, 1] == pytest.approx([1010])
+    # nothing of the left stream that far from its samples
+    assert values[grid == 1010, 0] == [0]
+
+def test_grid_points_are_emitted_once():
+    fusion = StreamFusion([("left", 1)], period=10)
+    fusion.add("left", np.arange(1000, 1100, 5), ramp(np.arange(1000, 1100, 5)))
+    first, values = fusion.emit(1050)
+    second, values = fusion.emit(1050)
+    third, values = fusion.emit(1100)
+    assert list(first) == list(range(1000, 1050, 10))
+    assert len(second) == 0
+    assert list(third) == list(range(1050, 1100, 10))
+
+def test_late_samples_only_fill_the_next_grid_points():
+    fusion = StreamFusion([("left", 1), ("right", 1)], period=10, tolerance=20)
+    fusion.add("left", np.arange(1000, 1200, 10), ramp(np.arange(1000, 1200, 10)))
+    grid, values = fusion.emit(1100)
+    assert np.all(values[:, 1] == 0)
+    # right samples from before the emitted grid points, arriving late
+    fusion.add("right", np.arange(1000, 1100, 10), ramp(np.arange(1000, 1100, 10), 2))
+    grid, values = fusion.emit(1200)
+    assert grid[0] == 1100
+    # the last late sample is within the tolerance of the first next grid points only
+    assert values[grid == 1100, 1] == pytest.approx([2 * 1090])
+    assert values[grid == 1110, 1] == pytest.approx([2 * 1090])
+    assert np.all(values[grid >= 1120, 1] == 0)
+
+def test_flush_emits_up_to_the_last_sample():
+    fusion = StreamFusion([("left", 1), ("right", 1)], period=10)
+    fusion.add("left", np.array([1000, 1020]), ramp([1000, 1020]))
+    fusion.add("right", np.array([1000, 1045]), ramp([1000, 1045]))
+    grid, values = fusion.flush()
+    assert list(grid) == [1000, 1010, 1020, 1030, 1040]
@@ -0,0 +1,99 @@
+"""
+Error bounds of the reductions of reduction.py: the rows kept rebuild
+every channel within its tolerance
+"""
+
+import numpy as np
+import pytest
+
+from reduction import Reducer, tolerances
+
+IMU_COLUMNS, NUMBER_FSR = 12, 4
+TOLERANCE = tolerances(IMU_COLUMNS, NUMBER_FSR)
+
+def level(gyro):
+    """Row of two devices at gravity, with a constant rotation, and FSRs under load"""
+    return np.array([0, 0, 9.81, gyro, gyro, gyro] * 2 + [20000] * NUMBER_FSR)
+
+def moving(rows, seed):
+    """Random walk of every channel, every 10 ms, gyroscopes well above the idle level"""
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 1, (rows, IMU_COLUMNS + NUMBER_FSR)) * TOLERANCE / 2
+    values = np.cumsum(steps, axis=0) + level(1)
+    return 1700000000000 + np.arange(rows, dtype=np.int64) * 10, values.astype(np.float32)
+
+def still(rows, start):
+    """Wheelchair at rest: sensor noise only"""
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 0.0005, (rows, IMU_COLUMNS + NUMBER_FSR)) + level(0)
+    return start + np.arange(rows, dtype=np.int64) * 10, values.astype(np.float32)
+
+def reduce(reducer, timestamps, values, block=97):
+    """Rows kept, fed in blocks as by the aggregator"""
+    kept = [reducer.reduce(timestamps[start:start + block], values[start:start + block]) for start in range(0, len(timestamps), block)]
+    kept.append(reducer.flush())
+    return np.concatenate([k[0] for k in kept]), np.concatenate([k[1] for k in kept])
+
+def hold(kept_timestamps, kept_values, timestamps):
+    """Value of the last row kept at or before each timestamp"""
+    return kept_values[np.searchsorted(kept_timestamps, timestamps, side="right") - 1]
+
+def interpolate(kept_timestamps, kept_values, timestamps):
+    return np.stack([np.interp(timestamps, kept_timestamps, kept_values[:, column]) for column in range(kept_values.shape[1])], axis=1)
+
+def max_error(rebuilt, values):
+    # float32 storage of the kept rows adds its own rounding
+    return (np.abs(rebuilt - values) - np.abs(values) * 1e-6).max(axis=0)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_deadband_holds_every_channel_within_its_tolerance(seed):
+    timestamps, values = moving(3000, seed)
+    kept_timestamps, kept_values = reduce(Reducer(IMU_COLUMNS, NUMBER_FSR, "deadband"), timestamps, values)
+    assert kept_timestamps[0] == timestamps[0]
+    assert np.all(max_error(hold(kept_timestamps, kept_values, timestamps), values) <= TOLERANCE)
+    assert len(kept_timestamps) < len(timestamps)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_swinging_door_interpolates_every_channel_within_its_tolerance(seed):
+    timestamps, values = moving(3000, seed)
+    kept_timestamps, kept_values = reduce(Reducer(IMU_COLUMNS, NUMBER_FSR, "swinging_door"), timestamps, values)
+    assert (kept_timestamps[0], kept_timestamps[-1]) == (timestamps[0], timestamps[-1])
+    assert np.all(max_error(interpolate(kept_timestamps, kept_values, timestamps), values) <= TOLERANCE)
+    assert len(kept_timestamps) < len(timestamps)
+
+@pytest.mark.parametrize("method", ["deadband", "swinging_door"])
+def test_a_row_is_kept_every_max_gap(method):
+    # a constant signal would otherwise be a single row
+    timestamps = 1700000000000 + np.arange(500, dtype=np.int64) * 10
+    values = np.tile(level(1), (500, 1)).astype(np.float32)
+    kept_timestamps, kept_values = reduce(Reducer(IMU_COLUMNS, NUMBER_FSR, method, max_gap=1), timestamps, values)
+    assert np.all(np.diff(kept_timestamps) <= 1000)
+
+@pytest.mark.parametrize("method", ["deadband", "swinging_door"])
+def test_idle_span_collapses_to_two_rows(method):
+    timestamps, values = moving(500, 0)
+    # 30 s at rest, idle after 10 s, then moving again
+    rest_timestamps, rest_values = still(3000, int(timestamps[-1]) + 10)
+    again_timestamps, again_values = moving(100, 1)
+    again_timestamps += int(rest_timestamps[-1]) + 10 - again_timestamps[0]
+    timestamps = np.concatenate((timestamps, rest_timestamps, again_timestamps))
+    values = np.concatenate((values, rest_values, again_values))
+    reducer = Reducer(IMU_COLUMNS, NUMBER_FSR, method, idle_after=10, idle_period=60)
+    kept_timestamps, kept_values = reduce(reducer, timestamps, values)
+    assert reducer.idle_spans == 1
+    idle_start = rest_timestamps[0] + 10000
+    idle = (kept_timestamps >= idle_start) & (kept_timestamps <= rest_timestamps[-1])
+    assert list(kept_timestamps[idle]) == [idle_start, rest_timestamps[-1]]
+    # both rows rebuild the idle span within the idle tolerance
+    span = (timestamps >= idle_start) & (timestamps <= rest_timestamps[-1])
+    for rebuild in (hold, interpolate):
+        rebuilt = rebuild(kept_timestamps, kept_values, timestamps[span])
+        assert np.all(max_error(rebuilt, values[span]) <= TOLERANCE * 5)
+
+def test_idle_span_ends_after_idle_period():
+    timestamps, values = still(9000, 1700000000000)
+    reducer = Reducer(IMU_COLUMNS, NUMBER_FSR, "deadband", idle_after=10, idle_period=30)
+    kept_timestamps, kept_values = reduce(reducer, timestamps, values)
+    # 90 s at rest: 10 s before the wheelchair is idle, then two idle spans of 30 s and one of 20 s
+    idle = kept_timestamps >= timestamps[0] + 10000
+    assert len(kept_timestamps[idle]) == 2 * 3
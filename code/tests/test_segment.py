@@ -0,0 +1,128 @@
+"""
+Append-only segments of segment.py: read-back, rollover and crash recovery
+"""
+
+import glob, os
+import numpy as np
+import pytest
+
+import datafile, segment
+from segment import SegmentWriter, recover
+
+START = 1700000000000
+
+def rows(count, start=START, columns=16):
+    timestamps = start + np.arange(count, dtype=np.int64) * 10
+    # within the range of the compact encoding (32.767 rad/s)
+    values = (np.tile(np.arange(columns, dtype=np.float32), (count, 1)) + np.arange(count, dtype=np.float32)[:, None]) / 10
+    # FSRs are ADC counts
+    values[:, 12:] = np.rint(values[:, 12:] * 100)
+    return timestamps, values
+
+def segments(folder, suffix=".seg"):
+    return sorted(glob.glob(os.path.join(folder, "*" + suffix)))
+
+@pytest.mark.parametrize("encoding", ["float32", "compact"])
+def test_records_are_read_back(tmp_path, encoding):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding=encoding, imu_columns=12)
+    timestamps, values = rows(50)
+    writer.append(timestamps[:20], values[:20])
+    writer.append(timestamps[20:], values[20:])
+    writer.close()
+    [path] = segments(tmp_path)
+    assert os.path.basename(path) == f"rolling-{START}.seg"
+    start_timestamp, records = segment.open_segment(path)
+    assert start_timestamp == START
+    assert list(records["timestamp"]) == list(timestamps)
+    content = datafile.read(path)
+    assert list(content.timestamps) == list(timestamps - START)
+    assert content.imu_columns == 12
+    # compact IMU values are rounded to 0.01 m/s^2 and 0.001 rad/s
+    assert content.values == pytest.approx(values, abs=0.01)
+
+def test_float32_records_are_memory_mapped(tmp_path):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding="float32")
+    writer.append(*rows(10))
+    writer.close()
+    start_timestamp, records = segment.open_segment(segments(tmp_path)[0])
+    assert isinstance(records, np.memmap)
+    # values are a view of the file, not a copy
+    assert isinstance(datafile.load(segments(tmp_path)[0])[1], np.memmap)
+
+def test_rollover_by_size(tmp_path):
+    record_size = segment.record_dtype(16).itemsize
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, max_bytes=segment.HEADER_SIZE + 25 * record_size, encoding="float32")
+    timestamps, values = rows(100)
+    for start in range(0, 100, 10):
+        writer.append(timestamps[start:start + 10], values[start:start + 10])
+    writer.close()
+    paths = segments(tmp_path)
+    # a segment is closed once it holds 25 records or more, after a block of 10
+    assert [len(segment.open_segment(path)[1]) for path in paths] == [30, 30, 30, 10]
+    assert [segment.open_segment(path)[0] for path in paths] == [START, START + 300, START + 600, START + 900]
+    assert segments(tmp_path, ".seg.part") == []
+
+def test_rollover_by_age(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(segment.time, "monotonic", lambda: now[0])
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, max_age=60, encoding="float32")
+    timestamps, values = rows(30)
+    writer.append(timestamps[:10], values[:10])
+    now[0] += 30
+    writer.append(timestamps[10:20], values[10:20])
+    assert segments(tmp_path) == []
+    now[0] += 30
+    writer.append(timestamps[20:], values[20:])
+    # 60 s after it was opened, the segment is complete
+    assert len(segments(tmp_path)) == 1
+    assert len(segment.open_segment(segments(tmp_path)[0])[1]) == 30
+
+@pytest.mark.parametrize("encoding", ["float32", "compact"])
+def test_torn_tail_is_dropped_on_recovery(tmp_path, encoding):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding=encoding, imu_columns=12)
+    timestamps, values = rows(20)
+    writer.append(timestamps, values)
+    writer.file.close() # crash: the segment is left open
+    [part] = segments(tmp_path, ".seg.part")
+    record_size = writer.dtype.itemsize
+    # half of the last record made it to the disk
+    with open(part, "r+b") as file:
+        file.truncate(segment.HEADER_SIZE + 19 * record_size + record_size // 2)
+    recover(str(tmp_path))
+    [path] = segments(tmp_path)
+    assert os.path.getsize(path) == segment.HEADER_SIZE + 19 * record_size
+    assert list(datafile.read(path).timestamps) == list(timestamps[:19] - START)
+
+def test_records_never_written_are_dropped_on_recovery(tmp_path):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding="float32")
+    timestamps, values = rows(5)
+    writer.append(timestamps, values)
+    writer.file.close()
+    [part] = segments(tmp_path, ".seg.part")
+    # blocks allocated by the file system, but not written, read as zeros
+    with open(part, "ab") as file:
+        file.write(bytes(3 * writer.dtype.itemsize))
+    recover(str(tmp_path))
+    assert len(segment.open_segment(segments(tmp_path)[0])[1]) == 5
+
+def test_empty_segment_is_removed_on_recovery(tmp_path):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding="float32")
+    writer.open(START)
+    writer.file.close()
+    recover(str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+def test_writer_recovers_only_its_label(tmp_path):
+    for label in ("rolling", "summary"):
+        writer = SegmentWriter(str(tmp_path), label, 16, encoding="float32")
+        writer.append(*rows(5))
+        writer.file.close()
+    # the summary writer of the same folder may still be writing its segment
+    SegmentWriter(str(tmp_path), "rolling", 16, encoding="float32")
+    assert [os.path.basename(path) for path in segments(tmp_path)] == [f"rolling-{START}.seg"]
+    assert [os.path.basename(path) for path in segments(tmp_path, ".seg.part")] == [f"summary-{START}.seg.part"]
+
+def test_rows_of_another_width_are_refused(tmp_path):
+    writer = SegmentWriter(str(tmp_path), "rolling", 16, encoding="float32")
+    with pytest.raises(ValueError):
+        writer.append(*rows(5, columns=12))
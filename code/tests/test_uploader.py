@@ -0,0 +1,196 @@
+"""
+Uploader of bucket_thing.py against the local stand-in of mock_bucket.py
+"""
+
+import logging, os, random
+from collections import deque
+import numpy as np
+import pytest
+import requests
+
+import bucket_thing, datafile, mock_bucket
+from bucket_thing import Uploader, run_length, take
+from dcd.bucket.properties.property import Property
+from journal import UploadJournal
+from segment import SegmentWriter
+
+SENSORS = ["acc_left", "gyro_left", "acc_right", "gyro_right"]
+
+class FakeHTTP:
+    """ The property update of the dcd SDK, without authentication """
+    def __init__(self, url):
+        self.url = url
+        self.sent = {} # property name -> values sent
+
+    def update_property(self, prop):
+        self.sent.setdefault(prop.name, []).extend(prop.values)
+        return requests.put(f"{self.url}/things/mock/properties/{prop.property_id}", json=prop.to_json()).status_code
+
+class FakeThing:
+    def __init__(self, url):
+        self.id = "dcd:things:mock"
+        self.http = FakeHTTP(url)
+        self.logger = logging.getLogger("thing")
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(mock_bucket, "bucket", mock_bucket.MockBucket())
+    monkeypatch.setattr(mock_bucket, "MOCK_LATENCY", 0)
+    server = mock_bucket.serve(0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    data, archive = tmp_path / "data", tmp_path / "archive"
+    data.mkdir()
+    archive.mkdir()
+    monkeypatch.setattr(bucket_thing, "ARCHIVE_PATH", str(archive) + "/")
+    return data, archive
+
+def make_uploader(server, tmp_path, names=SENSORS + ["label"], **options):
+    thing = FakeThing(f"http://localhost:{server.server_address[1]}")
+    properties = {}
+    for name in names:
+        prop = mock_bucket.bucket.create_property("mock", {"name": name, "typeId": "TEST"})
+        properties[name] = Property(property_id=prop["id"], name=name, type_id="TEST", values=[], thing=thing)
+    return Uploader(thing, properties, UploadJournal(str(tmp_path / "journal.sqlite")), **options)
+
+def write_files(folder, count, rows=100, label="rolling"):
+    """count files of rows rows at 10 Hz, one after the other"""
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        path = str(folder / f"{label}-{1700000000000 + index * rows * 100}.npz")
+        datafile.write(path, np.arange(rows, dtype=np.int64) * 100, rng.normal(1, 0.1, (rows, 12)).astype(np.float32))
+        paths.append(path)
+    return paths
+
+def received():
+    return mock_bucket.bucket.stats()["values"]
+
+def test_take_splits_the_last_piece():
+    pieces = deque([("a", 3, [1, 2, 3]), ("b", 5, [4, 5, 6, 7, 8])])
+    assert take(pieces, 4) == [("a", 3, [1, 2, 3]), ("b", 1, [4])]
+    assert list(pieces) == [("b", 5, [5, 6, 7, 8])]
+
+def test_run_length_keeps_the_ends_of_each_run():
+    rows = [[0, "a"], [10, "a"], [20, "a"], [30, "b"], [40, "b"], [200, "b"]]
+    assert run_length(rows, 50) == [[0, "a"], [20, "a"], [30, "b"], [40, "b"], [200, "b"]]
+
+def test_files_are_uploaded_together_and_archived(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 20)
+    uploader = make_uploader(server, tmp_path, chunk_rows=500)
+    uploader.upload_files(paths)
+    stats = mock_bucket.bucket.stats()
+    # 2000 rows in 4 requests per sensor property, the labels of all the files in one
+    assert stats["requests"] == 4 * len(SENSORS) + 1
+    assert stats["values"] == {**{name: 2000 for name in SENSORS}, "label": 2}
+    assert sorted(os.listdir(archive)) == sorted(os.path.basename(path) for path in paths)
+    assert os.listdir(data) == []
+
+def test_batches_are_bounded_by_rows(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 20)
+    uploader = make_uploader(server, tmp_path, batch_rows=250)
+    uploader.upload_files(paths)
+    # batches of 3 files, one request per property each
+    assert mock_bucket.bucket.stats()["requests"] == 7 * (len(SENSORS) + 1)
+    assert received()["acc_left"] == 2000
+    assert len(os.listdir(archive)) == 20
+
+def test_failed_uploads_resume_without_duplicates(server, folders, tmp_path, monkeypatch):
+    data, archive = folders
+    write_files(data, 20)
+    monkeypatch.setattr(mock_bucket, "MOCK_FAILURE_RATE", 0.3)
+    random.seed(1)
+    uploader = make_uploader(server, tmp_path, chunk_rows=300)
+    for attempt in range(20):
+        remaining = [str(data / name) for name in os.listdir(data)]
+        if len(remaining) == 0:
+            break
+        uploader.upload_files(remaining)
+    assert mock_bucket.bucket.stats()["failures"] > 0
+    assert len(os.listdir(archive)) == 20
+    # rows acknowledged before a failure are not sent again
+    assert all(received()[name] == 2000 for name in SENSORS)
+
+def test_archive_failure_leaves_the_file_for_the_next_check(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 3)
+    archive.rmdir()
+    uploader = make_uploader(server, tmp_path)
+    uploader.upload_files(paths)
+    requests_sent = mock_bucket.bucket.stats()["requests"]
+    assert len(os.listdir(data)) == 3
+    archive.mkdir()
+    uploader.upload_files(paths)
+    # every row was acknowledged, the files are only archived
+    assert mock_bucket.bucket.stats()["requests"] == requests_sent
+    assert len(os.listdir(archive)) == 3
+
+def test_labels_may_contain_dashes(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 2, label="push-fast")
+    uploader = make_uploader(server, tmp_path)
+    uploader.upload_files(paths)
+    assert datafile.parse_file_name(paths[0]) == ("push-fast", 1700000000000)
+    assert received()["label"] == 2
+    assert len(os.listdir(archive)) == 2
+
+def test_badly_named_file_is_set_aside(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 2)
+    bad = str(data / "rolling.npz")
+    os.rename(paths.pop(), bad)
+    uploader = make_uploader(server, tmp_path)
+    uploader.upload_files([bad] + paths)
+    # the other files are uploaded, the bad one is no longer a data file
+    assert received()["acc_left"] == 100
+    assert os.listdir(data) == ["rolling.npz.invalid"]
+
+@pytest.mark.parametrize("encoding", ["compact", "float32"])
+def test_file_of_another_device_layout_is_rejected(server, folders, tmp_path, encoding):
+    data, archive = folders
+    # one device and 10 FSRs, 16 columns, while the registry has two devices (12 IMU columns)
+    path = str(data / "rolling-1700000000000.npz")
+    values = np.hstack((np.ones((100, 6)), np.full((100, 10), 500))).astype(np.float32)
+    datafile.write(path, np.arange(100, dtype=np.int64) * 100, values, encoding, imu_columns=6)
+    assert datafile.layout(path) == 6
+    uploader = make_uploader(server, tmp_path)
+    uploader.upload_files([path])
+    assert mock_bucket.bucket.stats()["requests"] == 0
+    assert os.listdir(data) == ["rolling-1700000000000.npz.rejected"]
+
+@pytest.mark.parametrize("encoding, decimals", [("compact", 3), ("float32", None)])
+def test_only_compact_values_are_rounded(server, folders, tmp_path, encoding, decimals):
+    data, archive = folders
+    path = str(data / "rolling-1700000000000.npz")
+    values = np.full((10, 12), 0.123456, dtype=np.float32)
+    datafile.write(path, np.arange(10, dtype=np.int64) * 100, values, encoding)
+    uploader = make_uploader(server, tmp_path)
+    uploader.upload_files([path])
+    sent = uploader.thing.http.sent["gyro_left"][0][1]
+    stored = datafile.load(str(archive / "rolling-1700000000000.npz"))[1][0, 3]
+    # compact: the stored value without float32 noise, float32: as stored
+    assert sent == (round(float(stored), decimals) if decimals is not None else float(stored))
+
+def test_summaries_are_uploaded_without_the_raw_rows(server, folders, tmp_path):
+    data, archive = folders
+    paths = write_files(data, 2)
+    summaries = tmp_path / "summary"
+    summaries.mkdir()
+    # window summaries of inference.py: 20 features and the activity
+    writer = SegmentWriter(str(summaries), "summary", 21, encoding="float32", imu_columns=0)
+    writer.append(1700000000000 + np.arange(30, dtype=np.int64) * 1000, np.ones((30, 21), dtype=np.float32))
+    writer.close()
+    summary_paths = [str(summaries / name) for name in os.listdir(summaries)]
+    uploader = make_uploader(server, tmp_path, SENSORS + ["label", "summary"], upload_raw=False)
+    uploader.upload_files(paths + summary_paths)
+    assert received() == {"label": 2, "summary": 30}
+    assert uploader.thing.http.sent["summary"][0] == [1700000000000] + [1.0] * 21
+    # summaries are archived apart, out of the index of archive.py
+    assert sorted(os.listdir(archive)) == sorted([os.path.basename(path) for path in paths] + ["summary"])
+    assert os.listdir(archive / "summary") == [os.path.basename(summary_paths[0])]
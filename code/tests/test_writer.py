@@ -0,0 +1,101 @@
+"""
+Backpressure policies of the Writer of save.py, and spills across restarts
+"""
+
+import glob, os, threading, time
+import numpy as np
+
+import datafile
+from save import Chunk, Writer
+
+START = 1700000000000
+
+def chunk(index, rows=10):
+    """index-th chunk of continuous collection, its rows all hold index"""
+    timestamps = START + (index * rows + np.arange(rows, dtype=np.int64)) * 10
+    return Chunk("continuous", None, timestamps, np.full((rows, 16), index, dtype=np.float32), True, 12)
+
+def written(folder):
+    """Chunk index of every row written in the segments of folder, in order"""
+    values = [datafile.load(path)[1] for path in sorted(glob.glob(os.path.join(folder, "*.seg")))]
+    if len(values) == 0:
+        return []
+    return [int(row[0]) for row in np.concatenate(values)]
+
+def make_writer(tmp_path, **options):
+    os.makedirs(tmp_path / "data", exist_ok=True)
+    return Writer(str(tmp_path / "data"), spill_folder=str(tmp_path / "spill"), encoding="float32", **options)
+
+def test_block_waits_for_room_and_writes_everything(tmp_path):
+    writer = make_writer(tmp_path, queue_size=2, policy="block")
+    for index in range(2):
+        writer.put(chunk(index))
+    producer = threading.Thread(target=writer.put, args=(chunk(2),))
+    producer.start()
+    time.sleep(0.1)
+    # the queue is full, the producer waits
+    assert producer.is_alive()
+    writer.start()
+    producer.join(5)
+    for index in range(3, 20):
+        writer.put(chunk(index))
+    writer.stop(5)
+    assert written(tmp_path / "data") == [index for index in range(20) for row in range(10)]
+    assert writer.stats()["dropped_chunks"] == 0
+
+def test_drop_oldest_keeps_the_latest_chunks(tmp_path):
+    writer = make_writer(tmp_path, queue_size=2, policy="drop_oldest")
+    for index in range(5):
+        writer.put(chunk(index))
+    assert writer.stats()["dropped_chunks"] == 3
+    writer.start()
+    writer.stop(5)
+    assert written(tmp_path / "data") == [index for index in (3, 4) for row in range(10)]
+
+def test_spill_keeps_every_chunk_in_order(tmp_path):
+    writer = make_writer(tmp_path, queue_size=2, policy="spill")
+    for index in range(6):
+        writer.put(chunk(index))
+    assert writer.stats()["spilled_chunks"] == 4
+    assert len(glob.glob(str(tmp_path / "spill" / "*.npz"))) == 4
+    writer.start()
+    writer.stop(5)
+    assert written(tmp_path / "data") == [index for index in range(6) for row in range(10)]
+    assert os.listdir(tmp_path / "spill") == []
+
+def test_spilled_chunks_are_written_after_a_restart(tmp_path):
+    writer = make_writer(tmp_path, queue_size=1, policy="spill")
+    for index in range(4):
+        writer.put(chunk(index))
+    # the service stops before writing: the queued chunk is lost, the spilled ones are on disk
+    restarted = make_writer(tmp_path, queue_size=1, policy="spill")
+    assert restarted.queue_depth() == 3
+    restarted.start()
+    restarted.stop(5)
+    assert written(tmp_path / "data") == [index for index in (1, 2, 3) for row in range(10)]
+
+def test_torn_spills_are_set_aside(tmp_path):
+    spill = tmp_path / "spill"
+    spill.mkdir()
+    # a spill of an older version cut while written, and one interrupted before its rename
+    (spill / "1.npz").write_bytes(b"PK\x03\x04 torn")
+    (spill / "2.npz.part").write_bytes(b"PK\x03\x04 torn")
+    writer = make_writer(tmp_path, queue_size=1, policy="spill")
+    writer.put(chunk(0))
+    writer.put(chunk(1))
+    writer.start()
+    writer.stop(5)
+    assert written(tmp_path / "data") == [index for index in (0, 1) for row in range(10)]
+    assert sorted(os.listdir(spill)) == ["1.npz.bad"]
+
+def test_stop_writes_the_queued_chunks(tmp_path):
+    writer = make_writer(tmp_path, queue_size=50, policy="block")
+    for index in range(30):
+        writer.put(chunk(index))
+    writer.start()
+    # as on SIGINT in data_collection.py
+    writer.stop(5)
+    assert not writer.is_alive()
+    assert len(written(tmp_path / "data")) == 300
+    # the segment is complete, nothing left open
+    assert glob.glob(str(tmp_path / "data" / "*.part")) == []
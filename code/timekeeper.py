@@ -4,7 +4,7 @@ from bluetooth import BLE_Devices
 
 class TimerKeeper(threading.Thread):
     """ A parallel thread to keep track of time """
-    def __init__(self, threadID, name, counter, period: int, activity: str, ble_devices: BLE_Devices):
+    def __init__(self, threadID, name, counter, period: int, activity: str, ble_devices: BLE_Devices = None):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.name = name
@@ -14,6 +14,7 @@ class TimerKeeper(threading.Thread):
         self.start_time = 0
         self.period = period*1000
         self.activity = activity
+        # devices to disconnect at the end, None to keep them for the next activity
         self.ble_devices: BLE_Devices = ble_devices
 
     def run(self):
@@ -30,7 +31,8 @@ class TimerKeeper(threading.Thread):
             if self.start_time > 0 and time_left < 0:
                 print(f"\r{colors.WARNING}Stop recording !{colors.ENDC}{(' ' * 50)}")
                 self.stop_recording = True
-                self.ble_devices.stop()
+                if self.ble_devices is not None:
+                    self.ble_devices.stop()
                 break
             elif self.start_time > 0:
                 total = self.period
@@ -0,0 +1,92 @@
+"""
+Watch the data folder for complete files to upload.
+
+On Linux, the folder is watched with inotify (through ctypes, no extra
+module needed): a file is reported as soon as it is renamed into the
+folder or closed after writing. Elsewhere, or if inotify is not available,
+the folder is scanned at a fixed period as before.
+
+Writers must create files under a temporary name and rename them once
+complete (see Save in save.py), so that only finished files are reported.
+"""
+
+import ctypes, ctypes.util, glob, logging, os, select, struct, time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT = struct.Struct("iIII") # wd, mask, cookie, len, followed by the name
+
+class PollingWatcher:
+    """ Scan the folder every period seconds """
+    def __init__(self, folder, suffixes=(".npz",)):
+        self.folder = folder
+        self.suffixes = suffixes
+        self.first = True
+        self.last_scan = 0
+
+    def scan(self):
+        """All complete files currently in the folder"""
+        self.last_scan = time.monotonic()
+        files = []
+        for suffix in self.suffixes:
+            files.extend(glob.glob(os.path.join(self.folder, '*' + suffix)))
+        return sorted(files)
+
+    def wait(self, period):
+        """Return the files to upload, after waiting period seconds (except the first time)"""
+        if self.first:
+            self.first = False
+            return self.scan()
+        time.sleep(period)
+        return self.scan()
+
+    def close(self):
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    """ React to files renamed into or written in the folder
+    Every period seconds, fall back to a full scan so that files left
+    in place (e.g. failed uploads) are tried again.
+    """
+    def __init__(self, folder, suffixes=(".npz",)):
+        super().__init__(folder, suffixes)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Cannot watch {folder}")
+
+    def wait(self, period):
+        if self.first:
+            self.first = False
+            return self.scan()
+        timeout = max(0, self.last_scan + period - time.monotonic())
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return self.scan()
+        files = []
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset + EVENT.size <= len(buffer):
+            _, mask, _, length = EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0").decode()
+            offset += EVENT.size + length
+            if name.endswith(self.suffixes):
+                path = os.path.join(self.folder, name)
+                if path not in files and os.path.exists(path):
+                    files.append(path)
+        return files
+
+    def close(self):
+        os.close(self.fd)
+
+def create_watcher(folder, suffixes=(".npz",)):
+    """inotify watcher when available, polling otherwise"""
+    try:
+        return InotifyWatcher(folder, suffixes)
+    except (OSError, AttributeError, TypeError) as error:
+        logging.warning(f"inotify not available ({error}), scanning {folder} periodically.")
+        return PollingWatcher(folder, suffixes)